@@ -1,22 +1,79 @@
+import json
+import time
+import socket
 import requests
 import argparse
 from datetime import datetime
 
 
-def run(args):
+def create_alert(args, i=0):
     duration = int(args.duration) * 1000**3
+    hostname = args.hostname
+    if args.count > 1:
+        # Spread the alerts over a set of hosts
+        hostname = "%s-%d" % (args.hostname, i % 100)
+
+    return {"id": hostname + " " + args.test,
+            "message": hostname + " " + args.test +
+            " - This is a generated test message, please ignore",
+            "duration": duration,
+            "level": args.level.upper(),
+            "previousLevel": args.plevel.upper(),
+            "time": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            "data": {"series": [{"tags": {'Environment': args.environ,
+                                          "host": hostname}}]}}
+
+
+def processed():
+    '''Number of alerts KAP has processed so far'''
+    res = requests.get("http://localhost:9095/kap/queue")
+    return res.json()['processed']
+
+
+def wait_processed(target, timeout=600):
+    '''Wait until KAP has processed target alerts, the socket listener and
+    the ingest queue accept alerts before they are processed'''
+    deadline = time.time() + timeout
+    while processed() < target:
+        if time.time() > deadline:
+            print("Timed out waiting for the alerts to be processed")
+            return
+        time.sleep(0.05)
 
-    json_body = {"id": args.hostname + " " + args.test,
-                 "message": args.hostname + " " + args.test +
-                 " - This is a generated test message, please ignore",
-                 "duration": duration,
-                 "level": args.level.upper(),
-                 "previousLevel": args.plevel.upper(),
-                 "time": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-                 "data": {"series": [{"tags": {'Environment': args.environ,
-                                               "host": args.hostname}}]}}
 
-    requests.post(url="http://localhost:9095/kap/alert", json=json_body)
+def send_http(args):
+    session = requests.Session()
+    for i in range(args.count):
+        session.post(url="http://localhost:9095/kap/alert",
+                     json=create_alert(args, i))
+
+
+def send_socket(args):
+    if args.socket.startswith("/"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args.socket)
+    else:
+        host, port = args.socket.rsplit(":", 1)
+        sock = socket.create_connection((host, int(port)))
+    with sock:
+        for i in range(args.count):
+            sock.sendall(json.dumps(create_alert(args, i)).encode() + b"\n")
+
+
+def run(args):
+    before = processed() if args.count > 1 else 0
+    start = time.time()
+    if args.socket:
+        send_socket(args)
+    else:
+        send_http(args)
+    if args.count > 1:
+        sent = time.time() - start
+        wait_processed(before + args.count)
+        elapsed = time.time() - start
+        print("Sent %d alerts in %.2f secs, processed in %.2f secs, "
+              "%.0f alerts/sec" % (args.count, sent, elapsed,
+                                   args.count / elapsed))
 
 
 if __name__ == '__main__':
@@ -27,5 +84,9 @@ if __name__ == '__main__':
     parser.add_argument("-p", default="ok", dest="plevel")
     parser.add_argument("-e", default="test", dest="environ")
     parser.add_argument("-d", default=0, dest="duration", type=int)
+    # Number of alerts to send, prints alerts/sec when more than one
+    parser.add_argument("-c", default=1, dest="count", type=int)
+    # Send to the socket listener, host:port or path to unix socket
+    parser.add_argument("-s", default="", dest="socket")
     options = parser.parse_args()
     run(options)
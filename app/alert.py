@@ -6,25 +6,145 @@ Created: 17.Apr.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 '''
 import hashlib
+import itertools
+from collections import namedtuple
+
+
+Tag = namedtuple('Tag', ['key', 'value'])
+
+
+class Tags():
+    """Immutable, hashable set of alert tags
+
+    Iterating gives Tag(key, value) tuples, duplicates removed: the first
+    value of each key in the order added, then the other values of keys
+    given more than once. get(key) is a dict lookup, and as_dicts gives
+    the old list of {'key': ..., 'value': ...} dicts.
+    """
+    __slots__ = ('_first', '_more', '_hash')
+
+    def __init__(self, pairs=()):
+        if not isinstance(pairs, (list, tuple)):
+            pairs = list(pairs)
+        # A dict of strings only is not tracked by the garbage collector,
+        # unlike a tuple per tag, which made building many alerts slow
+        first = dict(pairs)
+        more = None
+        if len(first) != len(pairs):
+            # A key was given more than once
+            first = {}
+            more = []
+            for pair in dict.fromkeys(map(tuple, pairs)):
+                if pair[0] in first:
+                    more.append(pair)
+                else:
+                    first[pair[0]] = pair[1]
+            more = tuple(more) or None
+        self._first = first
+        self._more = more
+        self._hash = None
+
+    @classmethod
+    def from_dicts(cls, tags):
+        return cls([(t['key'], t['value']) for t in tags])
+
+    def as_dicts(self):
+        return [{'key': k, 'value': v} for k, v in self._pairs()]
+
+    def _pairs(self):
+        if self._more is None:
+            return iter(self._first.items())
+        return itertools.chain(self._first.items(), self._more)
+
+    def get(self, key, default=None):
+        '''Value of the first tag with this key'''
+        return self._first.get(key, default)
+
+    def getall(self, key):
+        return [v for k, v in self._pairs() if k == key]
+
+    def with_tag(self, key, value):
+        '''Copy where the tags with this key are replaced by key=value'''
+        return Tags([(k, v) for k, v in self._pairs() if k != key] +
+                    [(key, value)])
+
+    def __iter__(self):
+        return map(Tag._make, self._pairs())
+
+    def __len__(self):
+        return len(self._first) + len(self._more or ())
+
+    def __contains__(self, key):
+        return key in self._first
+
+    def __eq__(self, other):
+        if not isinstance(other, Tags):
+            return NotImplemented
+        if self._more is None and other._more is None:
+            return self._first == other._first
+        return frozenset(self._pairs()) == frozenset(other._pairs())
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self._pairs()))
+        return self._hash
+
+    def __repr__(self):
+        return "Tags({})".format(list(self))
 
 
 class Alert():
+    __slots__ = ('id', '_alhash', 'duration', 'message', 'level',
+                 'previouslevel', 'time', 'tags', 'pd_incident_key',
+                 'jira_issue', 'grafana_url', 'state_duration', 'sent')
+
     def __init__(self, alertid, duration, message,
-                 level, previouslevel, alerttime, tags):
+                 level, previouslevel, alerttime, tags, alhash=None):
         self.id = alertid
-        self.alhash = hashlib.sha256(alertid.encode()).hexdigest()
+        # Alerts loaded from the database already know their hash
+        self._alhash = alhash
         self.duration = duration
         self.message = message
         self.level = level
         self.previouslevel = previouslevel
         self.time = alerttime
-        self.tags = tags
+        # Lists of {'key': ..., 'value': ...} dicts are still accepted
+        self.tags = tags if isinstance(tags, Tags) else Tags.from_dicts(tags)
         self.pd_incident_key = None
         self.jira_issue = None
         self.grafana_url = None
         self.state_duration = False
         self.sent = False
 
+    @property
+    def alhash(self):
+        if self._alhash is None:
+            self._alhash = hashlib.sha256(self.id.encode()).hexdigest()
+        return self._alhash
+
+    def to_dict(self):
+        '''The alert as a JSON serializable dict'''
+        return {'id': self.id, 'alhash': self.alhash,
+                'duration': self.duration, 'message': self.message,
+                'level': self.level, 'previouslevel': self.previouslevel,
+                'time': self.time, 'tags': self.tags.as_dicts(),
+                'pd_incident_key': self.pd_incident_key,
+                'jira_issue': self.jira_issue,
+                'grafana_url': self.grafana_url,
+                'state_duration': self.state_duration, 'sent': self.sent}
+
+    @classmethod
+    def from_dict(cls, d):
+        '''The alert from to_dict'''
+        al = cls(d['id'], d['duration'], d['message'], d['level'],
+                 d['previouslevel'], d['time'], d['tags'], alhash=d['alhash'])
+        al.pd_incident_key = d['pd_incident_key']
+        al.jira_issue = d['jira_issue']
+        al.grafana_url = d['grafana_url']
+        al.state_duration = d['state_duration']
+        al.sent = d['sent']
+        return al
+
     def __repr__(self):
         return ("Alert(id={}, duration={}, message={}, level={}, "
                 "previouslevel={}, time={}, tags={}, "
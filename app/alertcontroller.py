@@ -8,46 +8,97 @@ Created by: Morten Hersson, <mhersson@gmail.com>
 '''
 import os
 import re
+import json
+import codecs
+import functools
 import time
+import threading
 import subprocess
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, Future
 
 from app import app, LOGGER
-from app.alert import Alert
-from app.targets.slack import Slack
+from app import routing, ratelimit, circuitbreaker
+from app.alert import Alert, Tags
+from app.targets import slack
+from app.targets.slack import Slack, SlackDigest
 from app.targets.jira import Incident
-from app.targets.pagerduty import Pagerduty
+from app.targets.pagerduty import Pagerduty, PagerdutyV2
 from app.dbcontroller import DBController
 from app.influxdbcontroller import InfluxDBController
 
 
+# Shared by all controllers, notifications to the targets of an alert are
+# sent in parallel
+_dispatch_pool = ThreadPoolExecutor(max_workers=app.config['DISPATCH_WORKERS'],
+                                    thread_name_prefix="dispatch")
+
+# Targets notified of every alert, KAOS gets periodic reports instead
+_OUTBOX_TARGETS = routing.SLACK | routing.PAGERDUTY | routing.JIRA
+
+# Notifications held back until the batch of this thread is committed
+_batch = threading.local()
+
+# The last Pagerduty v2 send of each alert hash. Nothing waits for them,
+# so each send waits for the one before it, and a resolve can not get
+# ahead of its trigger
+_pd_lanes = {}
+_pd_lanes_lock = threading.Lock()
+
+
+class DeliveryError(Exception):
+    """A target did not accept a delivery"""
+
+
 class AlertController():
     """Main controller class for all incoming alerts """
 
     def __init__(self):
         self._db = DBController()
         self._influx = InfluxDBController()
-        self.slack = Slack(url=app.config['SLACK_URL'],
-                           channel=app.config['SLACK_CHANNEL'],
-                           username=app.config['SLACK_USERNAME'])
-        self.pagerduty = Pagerduty(
-            url=app.config['PAGERDUTY_URL'],
-            service_key=app.config['PAGERDUTY_SERVICE_KEY'])
+        if app.config['SLACK_DIGEST_ENABLED']:
+            self.slack = slack.digest(
+                url=app.config['SLACK_URL'],
+                channel=app.config['SLACK_CHANNEL'],
+                username=app.config['SLACK_USERNAME'],
+                window=app.config['SLACK_DIGEST_WINDOW'],
+                max_lines=app.config['SLACK_DIGEST_MAX_LINES'],
+                rate=app.config['SLACK_RATE_LIMIT'],
+                burst=app.config['SLACK_RATE_BURST'],
+                critical_bypass=app.config['SLACK_DIGEST_CRITICAL_BYPASS'])
+        else:
+            self.slack = Slack(url=app.config['SLACK_URL'],
+                               channel=app.config['SLACK_CHANNEL'],
+                               username=app.config['SLACK_USERNAME'])
+        if app.config['PAGERDUTY_API_VERSION'] == 2:
+            self.pagerduty = PagerdutyV2(
+                url=app.config['PAGERDUTY_V2_URL'],
+                routing_key=app.config['PAGERDUTY_SERVICE_KEY'])
+        else:
+            self.pagerduty = Pagerduty(
+                url=app.config['PAGERDUTY_URL'],
+                service_key=app.config['PAGERDUTY_SERVICE_KEY'])
         self.jira = Incident(server=app.config['JIRA_SERVER'],
                              username=app.config['JIRA_USERNAME'],
                              password=app.config['JIRA_PASSWORD'],
                              project_key=app.config['JIRA_PROJECT_KEY'],
-                             assignee=app.config['JIRA_ASSIGNEE'])
+                             assignee=app.config['JIRA_ASSIGNEE'],
+                             transition_ttl=app.config[
+                                 'JIRA_TRANSITION_CACHE_TTL'])
+        self.router = routing.TargetRouter(app.config)
+        # Alerts processed, queued ones included once they are done
+        self.processed = 0
+        self._processed_lock = threading.Lock()
 
     def create_alert(self, content):
         LOGGER.info("Creating alert")
-        tags = []
+        pairs = []
         for s in content['data']['series']:
             try:
-                tags.extend([{'key': k, 'value': v}
-                             for k, v in s['tags'].items()])
+                pairs.extend(s['tags'].items())
             except KeyError:
                 continue
+        tags = Tags(pairs)
 
         al = Alert(alertid=content['id'],
                    duration=content['duration'] // (10 ** 9),
@@ -70,6 +121,181 @@ class AlertController():
                 al.tags = modified_tags
         return al
 
+    @staticmethod
+    def validate(content):
+        """Check that content looks like a kapacitor alert"""
+        try:
+            for key in ('id', 'message', 'level', 'previousLevel', 'time'):
+                if not isinstance(content[key], str):
+                    return False
+            return (isinstance(content['duration'], int) and
+                    isinstance(content['data']['series'], list))
+        except (KeyError, TypeError):
+            return False
+
+    def process(self, content):
+        try:
+            al = self.create_alert(content)
+            if al is not None:
+                self.process_alert(al)
+        finally:
+            with self._processed_lock:
+                self.processed += 1
+
+    def process_batch(self, contents):
+        '''Process alerts in one database transaction and one InfluxDB
+        write. Returns the result for each alert in the order received.
+        Notifications are sent after the transaction is committed, so the
+        database is not locked while the targets are waited on'''
+        results = []
+        pending = []
+        _batch.notifications = pending
+        try:
+            with self._db.transaction(), self._influx.batch():
+                for i, content in enumerate(contents):
+                    if not self.validate(content):
+                        results.append({'index': i, 'Success': False,
+                                        'error': "Invalid alert"})
+                        continue
+                    mark = len(pending)
+                    try:
+                        with self._db.savepoint():
+                            self.process(content)
+                        results.append({'index': i, 'Success': True})
+                    except Exception as err:  # pylint: disable=W0703
+                        LOGGER.exception("Failed processing alert in batch")
+                        del pending[mark:]
+                        results.append({'index': i, 'Success': False,
+                                        'error': str(err)})
+        finally:
+            _batch.notifications = None
+        self.notify_pending(pending)
+        return results
+
+    def notify_pending(self, pending):
+        '''Send the notifications held back by a batch in order, and store
+        the incident keys and issues they return'''
+        tickets = {}
+        for al, targets in pending:
+            # The ticket may have been opened by an earlier alert of the
+            # batch, after this one was processed
+            pd_key, issue = tickets.get(al.alhash, (None, None))
+            al.pd_incident_key = al.pd_incident_key or pd_key
+            al.jira_issue = al.jira_issue or issue
+            before = (al.pd_incident_key, al.jira_issue)
+            self.notify_targets(al, targets)
+            tickets[al.alhash] = (al.pd_incident_key, al.jira_issue)
+            if al.level == 'OK':
+                continue
+            if al.pd_incident_key and al.pd_incident_key != before[0]:
+                self._db.update_ticket(al.alhash, 'pagerduty',
+                                       al.pd_incident_key)
+            if al.jira_issue and al.jira_issue != before[1]:
+                self._db.update_ticket(al.alhash, 'jira', al.jira_issue)
+
+    @staticmethod
+    def parse_batch(chunks):
+        '''Parse newline delimited JSON or a JSON array of alerts, from
+        str or bytes chunks of any size, e.g. blocks of the request body.
+        Yields one alert at the time, or None if it can not be parsed.
+        Only the chunk and alert being parsed are held in memory'''
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder('utf-8')()
+        chunks = iter(chunks)
+        data = ''
+        pos = 0
+        array = None
+
+        def more():
+            # Drop what has been parsed, and add the next chunk
+            nonlocal data, pos
+            for chunk in chunks:
+                if isinstance(chunk, bytes):
+                    chunk = utf8.decode(chunk)
+                if chunk:
+                    data = data[pos:] + chunk
+                    pos = 0
+                    return True
+            return False
+
+        while True:
+            # Commas separate the elements of an array
+            skip = ' \t\r\n,' if array else ' \t\r\n'
+            while pos < len(data) and data[pos] in skip:
+                pos += 1
+            if pos >= len(data):
+                if not more():
+                    return
+                continue
+            if array is None:
+                array = data[pos] == '['
+                if array:
+                    pos += 1
+                continue
+            if array:
+                if data[pos] == ']':
+                    return
+                try:
+                    content, end = decoder.raw_decode(data, pos)
+                except ValueError:
+                    # Cut short by the end of the chunk, or invalid
+                    if more():
+                        continue
+                    yield None
+                    return
+                if (end == len(data) and data[end - 1].isdigit() and
+                        more()):
+                    # A number may go on in the next chunk
+                    continue
+                pos = end
+                yield content
+                continue
+            end = data.find('\n', pos)
+            if end < 0 and more():
+                continue
+            if end < 0:
+                end = len(data)
+            line = data[pos:end]
+            pos = end + 1
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+    def process_alert(self, al):
+        al = self._db.get_tickets_and_keys(al)
+        if not al.grafana_url:
+            al.grafana_url = self.add_grafana_url(al)
+        LOGGER.info("Alert info:\n%s\n%s -> %s, Duration: %d\n"
+                    "State duration: %s, Sent: %s\nJIRA: %s, PD: %s",
+                    al.id, al.previouslevel, al.level, al.duration,
+                    al.state_duration, al.sent,
+                    al.jira_issue, al.pd_incident_key)
+        if al.sent:
+            if al.level != al.previouslevel:
+                LOGGER.info("State has changed, notify targets")
+                self.dispatch_and_update_status(al)
+            else:
+                LOGGER.info("No change, updating existing alert")
+                self.dispatch_and_update_status(al, dispatch=False)
+        elif app.config['FLAPPING_DETECTION_ENABLED'] and \
+                self._db.is_flapping(al):
+            LOGGER.info("Alert is flapping")
+            al.message = "Flapping! " + al.message
+            self.dispatch_and_update_status(al, dispatch=False)
+        elif al.state_duration:
+            LOGGER.info("Alert delayed by state duration, no dispatch")
+            self.dispatch_and_update_status(al, dispatch=False)
+        elif al.duration < app.config['ALERTING_DELAY']:
+            LOGGER.info("Alert delayed, no dispatch")
+            self.dispatch_and_update_status(al, dispatch=False)
+        elif al.level == 'OK':
+            LOGGER.info("Alert OK without being sent, no dispatch")
+            self.dispatch_and_update_status(al, dispatch=False)
+        else:
+            LOGGER.info("New alert, notify targets")
+            self.dispatch_and_update_status(al)
+
     def check_instance_tags(self, instance_tags):
         # Try to find out if alert is from a normal ec2 instance or autoscaling
         # instance, and then suppress alerts from terminated autoscaling
@@ -80,44 +306,38 @@ class AlertController():
         instance_info = self.update_aws_instance_info()
         try:
             LOGGER.info("Checking incoming host tag")
-            x = [tag['value'] for tag in instance_tags if tag['key'] == 'host']
+            x = instance_tags.get('host')
             url = False  # Needed if host/url not in instance_info (f.ex ELB)
-            if not x:
+            if x is None:
                 # Telegraf input plugin ping uses tag url
                 # and net_response uses server and not host
                 # so try and use that if host does not exist
-                x = [tag['value'] for tag in instance_tags
-                     if tag['key'] in ['url', 'server']]
-                if not x:
+                x = instance_tags.get('url', instance_tags.get('server'))
+                if x is None:
                     raise KeyError
                 # if the url or server is in fact url
-                if x[0].startswith("http"):
+                if x.startswith("http"):
                     url = True  # Mark as url to raise KeyError if not found
                     # First remove http or https prefix, then split on : or /
                     # to get the hostname
-                    x[0] = re.split(":|/", re.sub(r"http[s]?://", "", x[0]))[0]
+                    x = re.split(":|/", re.sub(r"http[s]?://", "", x))[0]
                 LOGGER.info("Using url as host tag")
-                instance_tags.append({'key': 'host', 'value': x[0]})
-            LOGGER.info("Host tag, %s", x[0])
+                instance_tags = instance_tags.with_tag('host', x)
+            LOGGER.info("Host tag, %s", x)
             if instance_info:
-                if (x[0] in instance_info and
-                        instance_info[x[0]]['state'] in [16, 64, 80]):
+                if (x in instance_info and
+                        instance_info[x]['state'] in [16, 64, 80]):
                     LOGGER.info("Instance Name exists and status code is "
-                                "valid, %s - %d", x[0],
-                                instance_info[x[0]]['state'])
-                    env = [tag['value'] for tag in instance_tags
-                           if tag['key'] == 'Environment']
-                    if not env or env == ['']:
-                        # Remove the old Environment tag if env == ['']
-                        tags = [tag for tag in instance_tags
-                                if tag['key'] != 'Environment']
+                                "valid, %s - %d", x,
+                                instance_info[x]['state'])
+                    if not instance_tags.get('Environment'):
+                        # Replaces an empty Environment tag
                         LOGGER.info("Adding missing Environment tag")
-                        tags.append({'key': 'Environment',
-                                     'value': instance_info[x[0]]['env']})
-                        return False, tags
-                elif x[0] not in instance_info and url:
+                        return False, instance_tags.with_tag(
+                            'Environment', instance_info[x]['env'])
+                elif x not in instance_info and url:
                     raise KeyError
-                elif x[0] not in instance_info:
+                elif x not in instance_info:
                     LOGGER.error("Instance host tag not in instance list, "
                                  "suppressing alert")
                     return True, None
@@ -128,20 +348,26 @@ class AlertController():
         except KeyError:
             LOGGER.info(
                 "Alert is not instance specific or host tag is missing")
-        finally:
-            if not url:
-                self.remove_stale_alerts(instance_info)
-        return False, None
+        return False, instance_tags
 
     def dispatch_and_update_status(self, al, dispatch=True):
         if dispatch:
             LOGGER.info("Dispatch to all targets")
-            mrules = self._db.get_active_maintenance_rules()
-            if not self.affected_by_mrules(mrules, al):
+            mindex = self._db.get_maintenance_index()
+            if not self.affected_by_mrules(mindex, al):
                 al.sent = True
-                self.run_slack(al)
-                al.pd_incident_key = self.run_pagerduty(al)
-                al.jira_issue = self.run_jira(al)
+                targets = self.router.targets(al)
+                if (targets & routing.PAGERDUTY and al.level == 'CRITICAL' and
+                        isinstance(self.pagerduty, PagerdutyV2)):
+                    # Known before sending, nothing waits for Pagerduty
+                    al.pd_incident_key = self.pagerduty.incident_key(al)
+                if app.config['OUTBOX_ENABLED']:
+                    self._db.add_deliveries(
+                        al, routing.names(targets & _OUTBOX_TARGETS))
+                elif getattr(_batch, 'notifications', None) is not None:
+                    _batch.notifications.append((al, targets))
+                else:
+                    self.notify_targets(al, targets)
             else:
                 LOGGER.info("Alert is in maintenance, no notifications sent")
         self.update_active_alerts(al)
@@ -158,33 +384,129 @@ class AlertController():
         if al.level != al.previouslevel:
             self._db.log_alert(al)
 
-    def run_slack(self, al):
-        if app.config['SLACK_ENABLED']:
-            if not self.contains_excluded_tags(
-                    app.config['SLACK_EXCLUDED_TAGS'], al.tags):
-                self.slack.post(al)
-
-    def run_pagerduty(self, al):
-        if app.config['PAGERDUTY_ENABLED']:
-            if self.contains_excluded_tags(
-                    app.config['PAGERDUTY_EXCLUDED_TAGS'], al.tags):
-                return al.pd_incident_key
-            if self.excluded_tick(al, app.config['PAGERDUTY_EXCLUDED_TICKS']):
-                return al.pd_incident_key
-            al.pd_incident_key = self.pagerduty.post(al)
+    def notify_targets(self, al, targets):
+        '''Send to all targets in parallel and wait for the incident key and
+        issue, at most TARGET_DEADLINES seconds per target'''
+        start = time.monotonic()
+        deadlines = app.config['TARGET_DEADLINES']
+        futures = []
+        for name in routing.names(targets & _OUTBOX_TARGETS):
+            if (name == 'pagerduty' and
+                    isinstance(self.pagerduty, PagerdutyV2)):
+                # The incident key is the dedup key, no need to wait
+                self._submit_pagerduty_v2(al).add_done_callback(
+                    self._log_pagerduty_failure)
+            else:
+                futures.append(
+                    (name, _dispatch_pool.submit(self.deliver, name, al)))
+        results = {}
+        for name, future in futures:
+            timeout = max(0, start + deadlines[name] - time.monotonic())
+            try:
+                results[name] = future.result(timeout=timeout)
+            except TimeoutError:
+                LOGGER.error("No answer from %s within %d seconds",
+                             name, deadlines[name])
+                if name in ('pagerduty', 'jira') and al.level != 'OK':
+                    future.add_done_callback(functools.partial(
+                        self._store_late_ticket, al, name))
+            except circuitbreaker.CircuitOpen as err:
+                LOGGER.warning("Alert not sent: %s", err)
+            except Exception:  # pylint: disable=W0703
+                LOGGER.exception("Failed sending alert to %s", name)
+        if 'pagerduty' in results:
+            al.pd_incident_key = results['pagerduty']
             LOGGER.info("Pagerduty incident key: %s", al.pd_incident_key)
-        return al.pd_incident_key
-
-    def run_jira(self, al):
-        if app.config['JIRA_ENABLED']:
-            if self.contains_excluded_tags(
-                    app.config['JIRA_EXCLUDED_TAGS'], al.tags):
-                return al.jira_issue
-            al.jira_issue = self.jira.post(al)
+        if 'jira' in results:
+            al.jira_issue = results['jira']
             LOGGER.info("JIRA issue: %s", al.jira_issue)
-            if al.jira_issue and al.level == 'CRITICAL':
-                self.post_jira_url_to_slack(al.jira_issue)
-        return al.jira_issue
+
+    def _submit_pagerduty_v2(self, al):
+        '''Send to Pagerduty once the previous send of the same alert
+        is done. The send is only handed to the pool then, so no worker
+        waits for it'''
+        future = Future()
+        with _pd_lanes_lock:
+            previous = _pd_lanes.get(al.alhash)
+            _pd_lanes[al.alhash] = future
+        future.add_done_callback(
+            functools.partial(self._end_pd_lane, al.alhash))
+
+        def start(_previous=None):
+            _dispatch_pool.submit(self._deliver_into, future, 'pagerduty', al)
+
+        if previous is None:
+            start()
+        else:
+            previous.add_done_callback(start)
+        return future
+
+    def _deliver_into(self, future, target, al):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(self.deliver(target, al))
+        except Exception as err:  # pylint: disable=W0703
+            future.set_exception(err)
+
+    @staticmethod
+    def _end_pd_lane(alhash, future):
+        with _pd_lanes_lock:
+            if _pd_lanes.get(alhash) is future:
+                del _pd_lanes[alhash]
+
+    def _store_late_ticket(self, al, target, future):
+        '''Store an incident key or issue that came after the deadline,
+        so the alert can still be resolved'''
+        if future.cancelled() or future.exception() is not None:
+            return
+        key = future.result()
+        if key is None:
+            return
+        LOGGER.info("Late answer from %s for %s: %s", target, al.id, key)
+        # In case the alert is not stored yet
+        if target == 'pagerduty':
+            al.pd_incident_key = key
+        else:
+            al.jira_issue = key
+        self._db.update_ticket(al.alhash, target, key)
+
+    @staticmethod
+    def _log_pagerduty_failure(future):
+        err = future.exception()
+        if isinstance(err, circuitbreaker.CircuitOpen):
+            LOGGER.warning("Alert not sent: %s", err)
+        elif err is not None:
+            LOGGER.error("Failed sending alert to pagerduty: %s", err)
+
+    def deliver(self, target, al):
+        '''Send the alert to one target. Returns the incident key or issue,
+        raises if the target did not accept it, and CircuitOpen without
+        trying if the target has been failing'''
+        limit = app.config['TARGET_RATE_LIMITS'].get(target)
+        if target == 'slack' and isinstance(self.slack, SlackDigest):
+            # Most alerts are only added to the digest, the digest
+            # limits its own posts
+            limit = None
+        if limit and not ratelimit.bucket(target, *limit).acquire(
+                timeout=app.config['TARGET_DEADLINES'][target]):
+            raise DeliveryError("Rate limit for %s reached" % target)
+        return circuitbreaker.breaker(target).call(self._send, target, al)
+
+    def _send(self, target, al):
+        if target == 'slack':
+            if not self.slack.post(al):
+                raise DeliveryError("Slack did not accept the alert")
+            return None
+        if target == 'pagerduty':
+            return self.pagerduty.send(al)
+        issue = self.jira.post(al)
+        if al.level == 'CRITICAL':
+            if issue is None:
+                raise DeliveryError("No JIRA ticket was created")
+            # The ticket has to exist before its url is posted
+            self.post_jira_url_to_slack(issue)
+        return issue
 
     def post_jira_url_to_slack(self, ticket):
         if app.config['SLACK_ENABLED'] and app.config['JIRA_URL_TO_SLACK']:
@@ -208,8 +530,7 @@ class AlertController():
                 stoptime = int(time.time()) * 1000
             urlvars = []
             for var in app.config['GRAFANA_URL_VARS']:
-                urlvars.extend(
-                    [tag['value'] for tag in al.tags if tag['key'] == var])
+                urlvars.extend(al.tags.getall(var))
             if len(urlvars) != len(app.config['GRAFANA_URL_VARS']):
                 LOGGER.error("Failed setting Grafana url, missing variables")
                 return None
@@ -218,33 +539,36 @@ class AlertController():
             return url
         return None
 
-    def remove_stale_alerts(self, aws_instances):
+    def get_stale_alerts(self, aws_instances):
+        '''Active alerts from hosts that are terminated or no longer in
+        the aws instance list'''
         LOGGER.info("Checking for stale alerts from terminated instances")
-        # Remove old stale alerts from terminated instances
+        stale = []
         for al in self._db.get_active_alerts():
-            x = [tag['value'] for tag in al.tags if tag['key'] == 'host']
-            if not x:
+            host = al.tags.get('host')
+            if host is None:
                 # Alert does not have host tag set, nothing to do
                 continue
-            else:
-                if not (x[0] in aws_instances and
-                        aws_instances[x[0]]['state'] in [16, 64, 80]):
-                    LOGGER.info(
-                        "Stale alert found, host not in aws instance list")
-                    LOGGER.info("Removing stale alert")
-                    self._db.deactivate_alert(al)
-                    self._db.log_alert(al)
-                    self._influx.delete_active(al)
-                    LOGGER.info(
-                        "Cleaning up existing Pagerduty or JIRA tickets")
-                    al.level = "OK"
-                    if al.pd_incident_key:
-                        self.pagerduty.post(alert=al)
-                    if al.jira_issue:
-                        self.jira.post(alert=al)
+            if not (host in aws_instances and
+                    aws_instances[host]['state'] in [16, 64, 80]):
+                LOGGER.info("Stale alert found, %s not in aws instance list",
+                            host)
+                stale.append(al)
+        return stale
+
+    def remove_stale_alerts(self, stale):
+        '''Deactivate and log the alerts in one transaction and set them to
+        OK. Their Pagerduty and JIRA tickets are left to the caller'''
+        LOGGER.info("Removing %d stale alerts", len(stale))
+        with self._db.transaction(), self._influx.batch():
+            for al in stale:
+                self._db.deactivate_alert(al)
+                self._db.log_alert(al)
+                self._influx.delete_active(al)
+                al.level = "OK"
 
     @staticmethod
-    def affected_by_mrules(mrules, al):
+    def affected_by_mrules(mindex, al):
         # LOGGER.info("Checking maintenance")
         # If this is an alert OK with an existing ticket, override maintenace
         if ((al.previouslevel != 'OK' and al.level == 'OK') and
@@ -252,50 +576,7 @@ class AlertController():
             LOGGER.info(
                 "Running maintenance override to clear existing ticket")
         else:
-            for mrule in mrules:
-                mrv = mrule['value']
-                v = [tag['value']
-                     for tag in al.tags if tag['key'] == mrule['key']]
-                if mrv in v:
-                    return True
-                if mrv[0] == '*' and v[0].endswith(mrv[1:]):
-                    return True
-                if mrv[-1] == '*' and v[0].startswith(mrv[:-1]):
-                    return True
-                if mrule['key'] == 'id':
-                    if mrule['value'] in al.id:
-                        return True
-        return False
-
-    @staticmethod
-    def contains_excluded_tags(excluded, tags):
-        x = [t for t in tags if t in excluded]
-        if x:
-            LOGGER.info("One or more tags in exclude list: %s", str(x))
-            return True
-        # MonGroup is a special tag we use
-        # that can have mulitple pipe separated values
-        x = [t['value'] for t in excluded if t['key'] == 'MonGroup']
-        if x:
-            # There is a MonGroup in the exclude list, so get tag MonGroup
-            y = [t['value'] for t in tags if t['key'] == 'MonGroup']
-            if y:
-                # y should always have length 1 here if exists
-                # Split the value and
-                # create a new list to compare with the exclude list
-                if not set(x).isdisjoint(y[0].split("|")):
-                    LOGGER.info("Excluded MonGroup: %s", y[0])
-                    return True
-        return False
-
-    @staticmethod
-    def excluded_tick(al, excluded_ticks):
-        # This only works if {{ .TaskName }} is the last element of the al.id
-        LOGGER.info("Check for excluded tick script")
-        tn = al.id.split()[-1]
-        if tn in excluded_ticks:
-            LOGGER.info("Tick %s is excluded", tn)
-            return True
+            return mindex.matches(al)
         return False
 
     @staticmethod
@@ -0,0 +1,63 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: alertstore.py
+
+In-memory copy of the active alerts, kept in sync with SQLite by DBController
+'''
+import threading
+
+
+class ActiveAlertStore():
+    """Active alerts and flapping alerts keyed by alert hash
+
+    Each active alert is a dict with the columns of the active_alerts
+    table, plus its tags. The store is empty until load is called.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._alerts = None
+        self._flapping = None
+
+    @property
+    def loaded(self):
+        return self._alerts is not None
+
+    @property
+    def lock(self):
+        return self._lock
+
+    def load(self, alerts, flapping):
+        with self._lock:
+            self._alerts = {a['hash']: a for a in alerts}
+            self._flapping = set(flapping)
+
+    def get(self, alhash):
+        with self._lock:
+            a = self._alerts.get(alhash)
+            return dict(a) if a else None
+
+    def all(self):
+        with self._lock:
+            return [dict(a) for a in self._alerts.values()]
+
+    def contains(self, alhash):
+        return alhash in self._alerts
+
+    def put(self, alert):
+        with self._lock:
+            self._alerts[alert['hash']] = alert
+
+    def remove(self, alhash):
+        with self._lock:
+            self._alerts.pop(alhash, None)
+
+    def is_flapping(self, alhash):
+        return alhash in self._flapping
+
+    def set_flapping(self, alhash, flapping=True):
+        with self._lock:
+            if flapping:
+                self._flapping.add(alhash)
+            else:
+                self._flapping.discard(alhash)
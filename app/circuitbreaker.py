@@ -0,0 +1,151 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: circuitbreaker.py
+
+Circuit breakers that stop calls to a target while it is failing or slow
+'''
+import time
+import threading
+from collections import deque
+
+from app import app, LOGGER
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+_breakers = {}
+_lock = threading.Lock()
+
+
+class CircuitOpen(Exception):
+    """The circuit of the target is open, the call was not made"""
+
+
+class CircuitBreaker():
+    """Track the last window calls to a target
+
+    The circuit opens when at least min_calls were made and error_rate of
+    them failed or took slow_call seconds or more. While open, calls are
+    rejected. After open_time seconds the circuit is half-open, and one
+    call is let through: if it succeeds the circuit closes again,
+    otherwise it stays open for another open_time seconds.
+    """
+
+    def __init__(self, name, window, min_calls, error_rate, slow_call,
+                 open_time):
+        self.name = name
+        self._min_calls = min_calls
+        self._error_rate = error_rate
+        self._slow_call = slow_call
+        self._open_time = open_time
+        # True for every failed or slow call
+        self._results = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened = 0
+        self._probing = False
+        self._rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if (self._state == OPEN and
+                    time.monotonic() - self._opened >= self._open_time):
+                return HALF_OPEN
+            return self._state
+
+    def allow(self):
+        '''True if a call can be made now'''
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if time.monotonic() - self._opened < self._open_time:
+                    self._rejected += 1
+                    return False
+                self._state = HALF_OPEN
+                self._probing = False
+            if self._probing:
+                self._rejected += 1
+                return False
+            self._probing = True
+            return True
+
+    def retry_in(self):
+        '''Seconds until the circuit is half-open, 0 if it is not open'''
+        with self._lock:
+            if self._state != OPEN:
+                return 0
+            return max(0, self._opened + self._open_time - time.monotonic())
+
+    def record(self, elapsed, ok):
+        failed = not ok or elapsed >= self._slow_call
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probing = False
+                if failed:
+                    self._open()
+                else:
+                    LOGGER.info("Circuit for %s closed", self.name)
+                    self._state = CLOSED
+                    self._results.clear()
+                return
+            if self._state == OPEN:
+                # A call made before the circuit opened
+                return
+            self._results.append(failed)
+            if (len(self._results) >= self._min_calls and
+                    sum(self._results) >= self._error_rate *
+                    len(self._results)):
+                self._open()
+
+    def _open(self):
+        LOGGER.warning("Circuit for %s opened for %d seconds",
+                       self.name, self._open_time)
+        self._state = OPEN
+        self._opened = time.monotonic()
+        self._results.clear()
+
+    def call(self, func, *args, **kwargs):
+        '''Call func if the circuit allows it, raises CircuitOpen if not'''
+        if not self.allow():
+            raise CircuitOpen("Circuit for %s is open" % self.name)
+        start = time.monotonic()
+        try:
+            res = func(*args, **kwargs)
+        except Exception:
+            self.record(time.monotonic() - start, False)
+            raise
+        self.record(time.monotonic() - start, True)
+        return res
+
+    def status(self):
+        state = self.state
+        with self._lock:
+            calls = len(self._results)
+            res = {'state': state, 'calls': calls,
+                   'failed': sum(self._results), 'rejected': self._rejected}
+        if state == OPEN:
+            res['retry_in'] = round(self.retry_in(), 1)
+        return res
+
+
+def breaker(name):
+    '''The circuit breaker of a target, created on first use'''
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(
+                name,
+                window=app.config['CIRCUIT_BREAKER_WINDOW'],
+                min_calls=app.config['CIRCUIT_BREAKER_MIN_CALLS'],
+                error_rate=app.config['CIRCUIT_BREAKER_ERROR_RATE'],
+                slow_call=app.config['CIRCUIT_BREAKER_SLOW_CALL'],
+                open_time=app.config['CIRCUIT_BREAKER_OPEN_TIME'])
+        return _breakers[name]
+
+
+def status():
+    with _lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.status() for b in breakers}
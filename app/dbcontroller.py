@@ -7,10 +7,59 @@ Created: 20.Dec.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 '''
 import os
+import json
 import time
+import queue
 import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from app import app, INSTALLDIR, LOGGER
-from app.alert import Alert
+from app.alert import Alert, Tags
+from app.alertstore import ActiveAlertStore
+from app.logarchive import LogArchive
+from app.maintenance import MaintenanceIndex, ExpiryTimer
+
+
+# One connection per thread, shared by all DBController instances
+_local = threading.local()
+# Connections given back by finished request threads, for the next ones
+_pool = queue.LifoQueue(maxsize=app.config['SQLITE_POOL_SIZE'])
+# Active alerts are read from memory, and written through to SQLite
+_store = ActiveAlertStore()
+
+
+class _LRUCache():
+    def __init__(self, size):
+        self._size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self._size:
+                self._data.popitem(last=False)
+
+
+# Ids of interned tag keys and values, {(table, text): id}
+_tag_ids = _LRUCache(app.config['TAG_CACHE_SIZE'])
+# Active maintenance rules compiled for matching. Rebuilt when the rules
+# change, which bumps the generation, or when the first of them expires
+_maintenance = {'index': None, 'expires': 0, 'generation': 0}
+_maintenance_lock = threading.Lock()
+# Bumped when maintenance schedules are added or deleted
+_schedules = {'generation': 0}
+# Deletes maintenance rules when they expire
+_expiry = ExpiryTimer(lambda rule: DBController().expire_maintenance(rule))
 
 
 class DBController():
@@ -22,51 +71,221 @@ class DBController():
         super(DBController, self).__init__()
         self.db = os.path.join(INSTALLDIR, 'db/kap.db')
         self.flapping_window = app.config['FLAPPING_WINDOW']
+        self.log_archive = LogArchive(
+            os.path.join(INSTALLDIR, app.config['LOG_ARCHIVE_DIR']))
 
-    def create_tables(self):
-        LOGGER.info("Creating database tables")
-        con = sqlite3.connect(self.db)
-        with con:
-            cur = con.cursor()
-            cur.executescript(CREATE_TABLES_SQL)
-
-    def select(self, query, fetchone=True, use_column_name=False):
-        con = sqlite3.connect(self.db)
-        with con:
-            if use_column_name:
-                con.row_factory = sqlite3.Row
-            cur = con.cursor()
-            cur.execute(query)
-            if fetchone:
-                res = cur.fetchone()
+    def migrate(self):
+        '''Bring the database schema up to date'''
+        con = self._connect()
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+        for i, sql in enumerate(MIGRATIONS[version:], start=version + 1):
+            LOGGER.info("Migrating database to version %d", i)
+            try:
+                con.executescript("BEGIN;\n%s\nPRAGMA user_version = %d;\n"
+                                  "COMMIT;" % (sql, i))
+            except sqlite3.Error:
+                if con.in_transaction:
+                    con.execute("ROLLBACK")
+                LOGGER.exception("Database migration %d failed", i)
+                raise
+
+    def _connect(self):
+        con = getattr(_local, 'con', None)
+        if con is None:
+            try:
+                con = _pool.get_nowait()
+            except queue.Empty:
+                # Autocommit, transactions are started explicitly
+                # with transaction() when needed. A connection is only
+                # used by one thread at the time, but may move between
+                # threads through the pool
+                con = sqlite3.connect(self.db, isolation_level=None,
+                                      cached_statements=256,
+                                      check_same_thread=False)
+                con.execute("PRAGMA journal_mode=WAL")
+                con.execute("PRAGMA synchronous=NORMAL")
+                con.execute("PRAGMA cache_size=%d" %
+                            app.config['SQLITE_CACHE_SIZE'])
+            _local.con = con
+        return con
+
+    @staticmethod
+    def release():
+        '''Give the connection of this thread back to the pool. Called
+        at the end of every request, since each request gets a new thread'''
+        con = getattr(_local, 'con', None)
+        if con is None:
+            return
+        _local.con = None
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        try:
+            _pool.put_nowait(con)
+        except queue.Full:
+            con.close()
+
+    def _tag_id(self, table, text):
+        '''Id of a tag key or value, added to the dictionary if new'''
+        if text is None:
+            return None
+        tag_id = _tag_ids.get((table, text))
+        if tag_id is None:
+            new_tags = getattr(_local, 'new_tags', None)
+            if new_tags and (table, text) in new_tags:
+                return new_tags[(table, text)]
+            column = {'tag_keys': 'key', 'tag_values': 'value'}[table]
+            con = self._connect()
+            con.execute("INSERT OR IGNORE INTO %s (%s) VALUES (?)" %
+                        (table, column), (text,))
+            tag_id = con.execute("SELECT id FROM %s WHERE %s = ?" %
+                                 (table, column), (text,)).fetchone()[0]
+            if new_tags is not None:
+                # A new id can still be rolled back, it is cached
+                # when the transaction commits
+                new_tags[(table, text)] = tag_id
             else:
-                res = cur.fetchall()
-            if res:
-                return res
+                _tag_ids.put((table, text), tag_id)
+        return tag_id
+
+    @contextmanager
+    def transaction(self):
+        '''Run every query made by this thread in a single transaction'''
+        con = self._connect()
+        if con.in_transaction:
+            yield
+            return
+        _local.touched = set()
+        _local.new_tags = {}
+        con.execute("BEGIN")
+        try:
+            yield
+            con.execute("COMMIT")
+        except BaseException:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            # The store has changes that never made it to the database
+            self._refresh_store(_local.touched)
+            raise
+        else:
+            for key, tag_id in _local.new_tags.items():
+                _tag_ids.put(key, tag_id)
+        finally:
+            _local.touched = None
+            _local.new_tags = None
+
+    @contextmanager
+    def savepoint(self):
+        '''Undo the queries made in the block if it raises,
+        without giving up the surrounding transaction'''
+        with self.transaction():
+            con = self._connect()
+            outer = _local.touched
+            outer_tags = _local.new_tags
+            _local.touched = set()
+            _local.new_tags = dict(outer_tags)
+            con.execute("SAVEPOINT item")
+            try:
+                yield
+            except BaseException:
+                con.execute("ROLLBACK TO item")
+                self._refresh_store(_local.touched)
+                # The ids added in the block are gone
+                _local.new_tags = outer_tags
+                raise
+            finally:
+                con.execute("RELEASE item")
+                outer.update(_local.touched)
+                _local.touched = outer
+                outer_tags.update(_local.new_tags)
+                _local.new_tags = outer_tags
+
+    def select(self, query, values=(), fetchone=True, use_column_name=False):
+        cur = self._connect().cursor()
+        if use_column_name:
+            cur.row_factory = sqlite3.Row
+        cur.execute(query, values)
+        if fetchone:
+            res = cur.fetchone()
+        else:
+            res = cur.fetchall()
+        if res:
+            return res
         return None
 
-    def execute_query(self, query, values=None):
-        con = sqlite3.connect(self.db)
-        with con:
-            cur = con.cursor()
-            if values:
-                cur.execute(query, values)
-            else:
-                cur.execute(query)
-            return cur.rowcount
+    def execute_query(self, query, values=()):
+        cur = self._connect().cursor()
+        cur.execute(query, values)
+        return cur.rowcount
 
     def execute_many(self, query, values):
-        con = sqlite3.connect(self.db)
-        with con:
-            cur = con.cursor()
+        with self.transaction():
+            cur = self._connect().cursor()
             cur.executemany(query, values)
             return cur.rowcount
 
+    def _active(self):
+        if not _store.loaded:
+            with _store.lock:
+                if not _store.loaded:
+                    self.load_active_alerts()
+        return _store
+
+    def load_active_alerts(self):
+        '''(Re)build the in-memory store from the database'''
+        LOGGER.info("Loading active alerts")
+        query = "select * from active_alerts"
+        result = self.select(query, fetchone=False, use_column_name=True)
+        alerts = {}
+        for r in result or []:
+            a = dict(r)
+            a['tags'] = []
+            alerts[a['hash']] = a
+        query = ("select t.hash, k.key, v.value from active_alert_tags t "
+                 "join tag_keys k on k.id = t.key_id "
+                 "join tag_values v on v.id = t.value_id")
+        for r in self.select(query, fetchone=False) or []:
+            if r[0] in alerts:
+                alerts[r[0]]['tags'].append((r[1], r[2]))
+        for a in alerts.values():
+            a['tags'] = Tags(a['tags'])
+        result = self.select("select hash from flapping_alerts",
+                             fetchone=False)
+        _store.load(alerts.values(), [r[0] for r in result or []])
+
+    def _refresh_store(self, hashes):
+        with _store.lock:
+            if not _store.loaded:
+                return
+            for alhash in hashes:
+                res = self.select("select * from active_alerts "
+                                  "where hash = ?", (alhash,),
+                                  use_column_name=True)
+                if res:
+                    a = dict(res)
+                    a['tags'] = self._select_tags(alhash)
+                    _store.put(a)
+                else:
+                    _store.remove(alhash)
+
+    @staticmethod
+    def _touch(alhash):
+        touched = getattr(_local, 'touched', None)
+        if touched is not None:
+            touched.add(alhash)
+
+    @staticmethod
+    def _to_row(al, tags):
+        return {'hash': al.alhash, 'time': al.time, 'id': al.id,
+                'message': al.message, 'previouslevel': al.previouslevel,
+                'level': al.level, 'duration': al.duration,
+                'pagerduty': al.pd_incident_key, 'jira': al.jira_issue,
+                'grafana': al.grafana_url,
+                'state_duration': al.state_duration, 'sent': al.sent,
+                'tags': tags}
+
     def get_tickets_and_keys(self, al):
         LOGGER.info("Add tickets and keys")
-        query = "select pagerduty, jira, grafana, sent " + \
-            "from active_alerts where hash = '{}'".format(al.alhash)
-        res = self.select(query, use_column_name=True)
+        res = self._active().get(al.alhash)
         if res:
             al.pd_incident_key = res['pagerduty']
             al.jira_issue = res['jira']
@@ -76,6 +295,7 @@ class DBController():
 
     def activate_alert(self, al):
         LOGGER.info("Activate alert")
+        store = self._active()
         query = ("INSERT INTO active_alerts (hash, time, id, message,"
                  "previouslevel, level, duration, pagerduty, jira, grafana, "
                  "state_duration, sent) VALUES(?, ?, ?, ?, ?, ?, ? ,? , "
@@ -86,145 +306,258 @@ class DBController():
                   al.state_duration, al.sent)
         self.execute_query(query, values)
         query = "INSERT OR IGNORE INTO active_alert_tags " + \
-            "(hash, key, value) VALUES (?, ?, ?)"
-        tags = [(al.alhash, x['key'], x['value']) for x in al.tags]
-        self.execute_many(query, tags)
+            "(hash, key_id, value_id) VALUES (?, ?, ?)"
+        self.execute_many(query, [
+            (al.alhash, self._tag_id('tag_keys', k),
+             self._tag_id('tag_values', v)) for k, v in al.tags])
+        self._touch(al.alhash)
+        store.put(self._to_row(al, al.tags))
 
     def update_alert(self, al):
         LOGGER.info("Update alert")
+        store = self._active()
+        # A missing key never replaces a known one, the outbox may have
+        # written it after the alert was read
         query = ("UPDATE active_alerts set time = ? ,message = ?, "
                  "previouslevel = ?, level = ?, duration = ?,"
-                 "pagerduty = ?, jira = ?, grafana = ?, state_duration = ?,"
+                 "pagerduty = coalesce(?, pagerduty), "
+                 "jira = coalesce(?, jira), grafana = ?, state_duration = ?,"
                  "sent = ? where hash = ?")
         values = (al.time, al.message,
                   al.previouslevel, al.level, al.duration,
                   al.pd_incident_key, al.jira_issue, al.grafana_url,
                   al.state_duration, al.sent, al.alhash)
-        self.execute_query(query, values)
+        # The store lock is only taken after the database write, as in
+        # transaction(), or the two locks can be taken in opposite order
+        if not self.execute_query(query, values):
+            return
+        self._touch(al.alhash)
+        with store.lock:
+            prev = store.get(al.alhash)
+            tags = prev['tags'] if prev else self._select_tags(al.alhash)
+            row = self._to_row(al, tags)
+            if prev:
+                row['pagerduty'] = row['pagerduty'] or prev['pagerduty']
+                row['jira'] = row['jira'] or prev['jira']
+            store.put(row)
+
+    def update_ticket(self, alhash, target, key):
+        '''Set the pagerduty incident key or jira issue of an active alert'''
+        column = {'pagerduty': 'pagerduty', 'jira': 'jira'}[target]
+        store = self._active()
+        query = "UPDATE active_alerts set %s = ? where hash = ?" % column
+        if not self.execute_query(query, (key, alhash)):
+            return
+        with store.lock:
+            row = store.get(alhash)
+            if row:
+                row[column] = key
+                store.put(row)
 
     def deactivate_alert(self, al):
         LOGGER.info("Deactivate alert")
-        query = "DELETE FROM active_alerts where hash = '{}'".format(al.alhash)
-        self.execute_query(query)
+        store = self._active()
+        query = "DELETE FROM active_alerts where hash = ?"
+        self.execute_query(query, (al.alhash,))
+        self._touch(al.alhash)
+        store.remove(al.alhash)
 
     def is_active(self, al):
-        query = "SELECT 1 FROM active_alerts where hash = '{}'".format(
-            al.alhash)
-        res = self.select(query)
-        if res:
-            return True
-        return False
+        return self._active().contains(al.alhash)
 
     def state_duration(self, al):
         LOGGER.info("Checking state duration")
-        query = "SELECT state_duration FROM active_alerts " + \
-            "where hash = '{}'".format(al.alhash)
-        res = self.select(query)
+        res = self._active().get(al.alhash)
         if res:
-            return bool(res[0])
+            return bool(res['state_duration'])
         return False
 
     def get_active_alerts(self):
         LOGGER.info("Get active alerts")
-        query = "select id, duration, message, level, previouslevel, " + \
-            "time, grafana, jira, pagerduty from active_alerts"
-        result = self.select(query, fetchone=False)
         res = []
-        if result:
-            for r in result:
-                a = Alert(r[0], r[1], r[2], r[3], r[4], r[5], None)
-                a.grafana_url = r[6]
-                a.jira_issue = r[7]
-                a.pd_incident_key = r[8]
-                a.tags = self.get_tags(a.alhash)
-                res.append(a)
+        for r in self._active().all():
+            a = Alert(r['id'], r['duration'], r['message'], r['level'],
+                      r['previouslevel'], r['time'],
+                      r['tags'], alhash=r['hash'])
+            a.grafana_url = r['grafana']
+            a.jira_issue = r['jira']
+            a.pd_incident_key = r['pagerduty']
+            res.append(a)
         return res
 
     def get_tags(self, alhash):
-        query = "select key, value from active_alert_tags where " + \
-            "hash = '{}'".format(alhash)
-        result = self.select(query, fetchone=False)
-        tags = []
-        if result:
-            for r in result:
-                tags.append({'key': r[0], 'value': r[1]})
-        return tags
+        res = self._active().get(alhash)
+        if res:
+            return res['tags'].as_dicts()
+        return []
+
+    def _select_tags(self, alhash):
+        query = ("select k.key, v.value from active_alert_tags t "
+                 "join tag_keys k on k.id = t.key_id "
+                 "join tag_values v on v.id = t.value_id where t.hash = ?")
+        result = self.select(query, (alhash,), fetchone=False)
+        return Tags(result or [])
 
     def log_alert(self, al):
         LOGGER.info("Logging alert")
-        envir = None
-        host = None
-        for tag in al.tags:
-            if tag['key'] == 'Environment':
-                envir = tag['value']
-            if tag['key'] == 'host':
-                host = tag['value']
+        envir = al.tags.get('Environment')
+        host = al.tags.get('host')
         query = ("INSERT OR IGNORE INTO alert_log(hash, time, id, "
-                 "message, previouslevel, level, environment, host, duration, "
-                 "pagerduty, jira) VALUES( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
-        values = (al.alhash, al.time, al.id, al.message, al.previouslevel,
-                  al.level, envir, host, al.duration, al.pd_incident_key,
-                  al.jira_issue)
+                 "message, previouslevel, level, environment_id, host_id, "
+                 "duration, pagerduty, jira) "
+                 "VALUES( ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+        with self.transaction():
+            values = (al.alhash, al.time, al.id, al.message, al.previouslevel,
+                      al.level, self._tag_id('tag_values', envir),
+                      self._tag_id('tag_values', host), al.duration,
+                      al.pd_incident_key, al.jira_issue)
+            if self.execute_query(query, values):
+                self._update_rollup(al, envir)
+
+    def _update_rollup(self, al, environment):
+        query = ("INSERT INTO alert_log_hourly (bucket, id, environment, "
+                 "previouslevel, level, count, duration) "
+                 "VALUES (?, ?, ?, ?, ?, 1, ?) "
+                 "ON CONFLICT (bucket, id, environment, previouslevel, level) "
+                 "DO UPDATE SET count = count + 1, "
+                 "duration = duration + excluded.duration")
+        values = (int(al.time) - int(al.time) % 3600, al.id,
+                  environment or '', al.previouslevel, al.level, al.duration)
         self.execute_query(query, values)
 
+    def backfill_rollups(self):
+        '''Rebuild the hourly rollups from the alert log. Only the buckets
+        the alert log still covers are rebuilt, the rollups of archived
+        records are kept. The hour of the oldest record may have been
+        archived in part, it is only built when it has no rollups yet'''
+        LOGGER.info("Backfilling hourly alert log rollups")
+        with self.transaction():
+            first = self.select("SELECT min(time) FROM alert_log")[0]
+            if first is None:
+                return 0
+            start = first - first % 3600
+            if self.select("SELECT 1 FROM alert_log_hourly WHERE bucket = ?",
+                           (start,)):
+                start += 3600
+            self.execute_query(
+                "DELETE FROM alert_log_hourly WHERE bucket >= ?", (start,))
+            return self.execute_query(
+                "INSERT INTO alert_log_hourly (bucket, id, environment, "
+                "previouslevel, level, count, duration) "
+                "SELECT l.time - l.time % 3600, l.id, coalesce(e.value, ''), "
+                "l.previouslevel, l.level, count(*), sum(l.duration) "
+                "FROM alert_log l LEFT JOIN tag_values e "
+                "ON e.id = l.environment_id WHERE l.time >= ? "
+                "GROUP BY 1, 2, 3, 4, 5", (start,))
+
     def get_log_count_interval(self):
         # LOGGER.info("Getting alert occurences from alert log")
         now = int(time.time())
+        # diff is the time since the previous OK -> alert change of the
+        # same alert. Both the rows and the previous change are found with
+        # the alert_log_alerting index, which is faster than lag(), see
+        # benchmarks/bench_flapping.py
         query = ("select hash, id, environment, count(*) as num, "
                  "max(diff) as diff "
-                 "from (select l.hash, l.id, l.environment, "
+                 "from (select l.hash, l.id, e.value as environment, "
                  "l.time - (select max(i_l.time) "
                  "from alert_log i_l where i_l.time < l.time and "
-                 "i_l.id = l.id and i_l.time >= {tlimit} and "
+                 "i_l.id = l.id and i_l.time >= :tlimit and "
                  "i_l.previouslevel = 'OK' and i_l.level != 'OK') as diff "
-                 "from alert_log l where l.time >= {tlimit}  and "
+                 "from alert_log l left join tag_values e "
+                 "on e.id = l.environment_id where l.time >= :tlimit and "
                  "l.previouslevel = 'OK' and l.level != 'OK') "
-                 "group by id;".format(tlimit=now - (self.flapping_window * 60)))
-        result = self.select(query, fetchone=False)
+                 "group by id;")
+        values = {'tlimit': now - (self.flapping_window * 60)}
+        result = self.select(query, values, fetchone=False)
         if result:
             return result
         return []
 
-    def get_statistics(self, hours):
+    @staticmethod
+    def _bucket(hours):
+        # Whole hours, so this may include up to an hour more than asked for
         tm = int(time.time() - hours * 3600)
-        query = "select id, previouslevel, environment, avg(duration), " + \
-            "count(*) from alert_log where level = 'OK' and " + \
-            "time >= {} group by id, level, environment".format(tm)
-        result = self.select(query, fetchone=False)
+        return tm - tm % 3600
+
+    def get_statistics(self, hours):
+        query = "select id, previouslevel, nullif(environment, ''), " + \
+            "1.0 * sum(duration) / sum(count), sum(count) " + \
+            "from alert_log_hourly where level = 'OK' and " + \
+            "bucket >= ? group by id, level, environment"
+        result = self.select(query, (self._bucket(hours),), fetchone=False)
         if result:
             return result
         return []
 
-    def get_log_records(self, hours, environment=None):
+    def _archived_records(self, since):
+        '''Archived records newer than since, that are not still in the
+        alert log waiting to be deleted'''
+        res = self.select("select min(time) from alert_log")
+        until = res[0] if res else None
+        if until is not None and since >= until:
+            return []
+        return self.log_archive.read(since, until)
+
+    def get_log_records(self, hours, environment=None, include_archive=False):
         tm = int(time.time() - hours * 3600)
-        query = "select time, id, previouslevel, level, environment " + \
-            " from alert_log where time >= {} order by time desc".format(tm)
+        query = ("select l.time, l.id, l.previouslevel, l.level, e.value "
+                 "from alert_log l left join tag_values e "
+                 "on e.id = l.environment_id where l.time >= ? "
+                 "order by l.time desc")
+        values = (tm,)
         if environment:
-            query = ("select time, id, previouslevel, level, environment "
-                     "from alert_log where time >= {} and environment = '{}' "
-                     "order by time desc".format(tm, environment))
-        result = self.select(query, fetchone=False)
+            query = ("select l.time, l.id, l.previouslevel, l.level, e.value "
+                     "from alert_log l join tag_values e "
+                     "on e.id = l.environment_id "
+                     "where l.time >= ? and e.value = ? "
+                     "order by l.time desc")
+            values = (tm, environment)
+        result = self.select(query, values, fetchone=False) or []
+        if include_archive:
+            result.extend(
+                (r['time'], r['id'], r['previouslevel'], r['level'],
+                 r['environment']) for r in self._archived_records(tm)
+                if not environment or r['environment'] == environment)
+            result.sort(key=lambda r: r[0], reverse=True)
+        return result
+
+    def get_log_batch(self, before, limit):
+        # Same columns as the alert log had before tags were interned
+        query = ("select l.rowid, l.hash, l.time, l.id, l.message, "
+                 "e.value as environment, h.value as host, l.previouslevel, "
+                 "l.level, l.duration, l.pagerduty, l.jira "
+                 "from alert_log l "
+                 "left join tag_values e on e.id = l.environment_id "
+                 "left join tag_values h on h.id = l.host_id "
+                 "where l.time < ? order by l.time limit ?")
+        result = self.select(query, (before, limit), fetchone=False,
+                             use_column_name=True)
         if result:
             return result
         return []
 
+    def log_records_exist(self, keys):
+        '''True if any of the (rowid, time) alert log records exists'''
+        query = "select 1 from alert_log where rowid = ? and time = ?"
+        return any(self.select(query, k) for k in keys)
+
+    def delete_log_records(self, rowids):
+        query = "DELETE FROM alert_log where rowid = ?"
+        rows = self.execute_many(query, [(x,) for x in rowids])
+        LOGGER.debug("Deleted %d alert log records", rows)
+
     def get_alert_summary(self, hours=1):
-        tm = int(time.time() - hours * 3600)
-        query = ("select environment, count(*) "
-                 "from alert_log where time >= {} and level != 'OK' "
-                 "group by environment".format(tm))
-        result = self.select(query, fetchone=False)
+        query = ("select nullif(environment, ''), sum(count) "
+                 "from alert_log_hourly where bucket >= ? and level != 'OK' "
+                 "group by environment")
+        result = self.select(query, (self._bucket(hours),), fetchone=False)
         if result:
             return result
         return []
 
     def is_flapping(self, al):
-        query = "SELECT 1 FROM flapping_alerts where hash = '{}'".format(
-            al.alhash)
-        res = self.select(query)
-        if res:
-            return True
-        return False
+        return self._active().is_flapping(al.alhash)
 
     def get_flapping_alerts(self):
         # LOGGER.info("Get all alerts marked as flapping")
@@ -243,6 +576,7 @@ class DBController():
             "time, quarantine, modified) VALUES (?, ?, ?, ?, ?, ?)"
         values = (alhash, alid, environment, now, quarantine, now)
         self.execute_query(query, values)
+        self._active().set_flapping(alhash)
 
     def update_flapping(self, alhash, interval):
         LOGGER.debug("Updating flapping quarantine interval")
@@ -255,49 +589,102 @@ class DBController():
 
     def unset_flapping(self, alhash, alid):
         LOGGER.info("Unsetting flapping on %s", alid)
-        query = "DELETE FROM flapping_alerts where hash = '{}'".format(alhash)
-        self.execute_query(query)
+        query = "DELETE FROM flapping_alerts where hash = ?"
+        self.execute_query(query, (alhash,))
+        self._active().set_flapping(alhash, False)
 
-    def activate_maintenance(self, key, value, duration, comment):
+    @staticmethod
+    def duration_seconds(duration):
+        '''Seconds in a duration like 30m, 8h, 2d or 1w'''
+        duration_secs = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+        return int(duration[:-1]) * duration_secs[duration[-1]]
+
+    def activate_maintenance(self, key, value, duration, comment, start=None):
         LOGGER.info("Activate maintenance on %s %s for %s",
                     key, value, duration)
-        duration_secs = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
-        start = int(time.time())
-        stop = int(start + (int(duration[:-1]) * duration_secs[duration[-1]]))
+        if start is None:
+            start = int(time.time())
+        stop = int(start + self.duration_seconds(duration))
         query = "INSERT  INTO active_maintenance " + \
             "(start, stop, key, value, comment) VALUES (?, ?, ?, ?, ?)"
         values = (start, stop, key, value, comment)
         self.execute_query(query, values)
+        self._invalidate_maintenance_index()
+        self._schedule_expiry({'start': start, 'stop': stop,
+                               'key': key, 'value': value})
 
     def deactive_maintenance(self, start, stop, key, value):
         LOGGER.info("Deactivate maintenance on %s %s", key, value)
         query = ("DELETE FROM active_maintenance where "
-                 "start = {start} and stop = {stop} and key = '{key}' "
-                 "and value = '{value}'".format(
-                     start=start, stop=stop, key=key, value=value))
-        self.execute_query(query)
+                 "start = ? and stop = ? and key = ? and value = ?")
+        self.execute_query(query, (start, stop, key, value))
+        self._invalidate_maintenance_index()
+
+    def maintenance_exists(self, start, key, value):
+        query = "select 1 from active_maintenance " + \
+            "where start = ? and key = ? and value = ?"
+        return self.select(query, (start, key, value)) is not None
+
+    def expire_maintenance(self, rule):
+        LOGGER.info("Maintenance on %s %s expired", rule['key'], rule['value'])
+        self.deactive_maintenance(rule['start'], rule['stop'],
+                                  rule['key'], rule['value'])
+
+    @staticmethod
+    def _schedule_expiry(rule):
+        # A rule is active up to and including its stop second
+        _expiry.add(rule['stop'] + 1, rule)
+
+    def schedule_maintenance_expiry(self):
+        '''Start expiring the rules already in the database, including
+        those that expired while we were not running'''
+        query = "select start, stop, key, value from active_maintenance"
+        for r in self.select(query, fetchone=False) or []:
+            self._schedule_expiry({'start': r[0], 'stop': r[1],
+                                   'key': r[2], 'value': r[3]})
+
+    @staticmethod
+    def stop_maintenance_expiry():
+        _expiry.stop()
 
     def get_active_maintenance_rules(self):
         # LOGGER.info("Get maintenance rules")
+        # Expired rules are deleted by the expiry timer, until then
+        # they are left out here
         mrules = []
+        now = int(time.time())
         query = "select start, stop, key, value, comment " + \
-            "from active_maintenance"
-        result = self.select(query, fetchone=False)
+            "from active_maintenance where start <= ? and stop >= ?"
+        result = self.select(query, (now, now), fetchone=False)
         if result:
             for r in result:
                 mrules.append({'start': r[0], 'stop': r[1],
                                'key': r[2], 'value': r[3],
                                'comment': r[4]})
-        if mrules:
-            tmp = mrules
-            for i, mr in enumerate(mrules):
-                if not mr['start'] <= int(time.time()) <= mr['stop']:
-                    del tmp[i]
-                    self.deactive_maintenance(mr['start'], mr['stop'],
-                                              mr['key'], mr['value'])
-            mrules = tmp
         return mrules
 
+    def get_maintenance_index(self):
+        '''The active maintenance rules as a MaintenanceIndex'''
+        index = _maintenance['index']
+        if index is not None and int(time.time()) <= _maintenance['expires']:
+            return index
+        generation = _maintenance['generation']
+        rules = self.get_active_maintenance_rules()
+        index = MaintenanceIndex(rules)
+        with _maintenance_lock:
+            # Do not cache it if the rules changed while it was built
+            if generation == _maintenance['generation']:
+                _maintenance['index'] = index
+                _maintenance['expires'] = min(
+                    (r['stop'] for r in rules), default=float('inf'))
+        return index
+
+    @staticmethod
+    def _invalidate_maintenance_index():
+        with _maintenance_lock:
+            _maintenance['generation'] += 1
+            _maintenance['index'] = None
+
     def add_maintenance_schedule(self, starttime, duration,
                                  key, value, comment, repeat, days):
         LOGGER.info("Add maintenance schedule for %s %s", key, value)
@@ -312,8 +699,19 @@ class DBController():
             query = ("INSERT INTO maintenance_schedule_days "
                      "(schedule_id, day, runcounter) VALUES (?, ?, ?)")
             self.execute_many(query, days)
+        _schedules['generation'] += 1
+
+    @staticmethod
+    def get_schedule_generation():
+        '''Changes whenever a maintenance schedule is added or deleted'''
+        return _schedules['generation']
 
     def get_maintenance_schedule(self):
+        days = {}
+        result = self.select("select schedule_id, day "
+                             "from maintenance_schedule_days", fetchone=False)
+        for r in result or []:
+            days.setdefault(r[0], []).append(r[1])
         result = self.select(
             "SELECT * from maintenance_schedule", fetchone=False)
         schedule = []
@@ -322,38 +720,125 @@ class DBController():
                 sched = {'schedule_id': r[0], 'starttime': r[1],
                          'duration': r[2], 'key': r[3], 'value': r[4],
                          'comment': r[5], 'repeat': bool(r[6])}
-                sched['days'] = self.get_schedule_days(r[0])
+                sched['days'] = days.get(r[0], [])
                 schedule.append(sched)
         return schedule
 
     def get_schedule_days(self, schedule_id):
         query = "select day from maintenance_schedule_days " + \
-            "where schedule_id = %d" % schedule_id
-        result = self.select(query, fetchone=False)
+            "where schedule_id = ?"
+        result = self.select(query, (schedule_id,), fetchone=False)
         if result:
             return [x[0] for x in result]
         return []
 
     def get_schedule_runcounter(self, schedule_id):
         query = "select runcounter from maintenance_schedule_days " + \
-            "where schedule_id = %d" % schedule_id
-        result = self.select(query, fetchone=False)
+            "where schedule_id = ?"
+        result = self.select(query, (schedule_id,), fetchone=False)
         if result:
             return [x[0] for x in result]
         return []
 
-    def update_day_runcounter(self, schedule_id, day):
+    def get_day_last_start(self, schedule_id, day):
+        '''Start of the last window the schedule fired on the day, or None
+        if it has not fired since it was added or the database upgraded'''
+        query = "select last_start from maintenance_schedule_days " + \
+            "where schedule_id = ? and day = ?"
+        result = self.select(query, (schedule_id, day))
+        if result:
+            return result[0]
+        return None
+
+    def update_day_runcounter(self, schedule_id, day, start):
         query = "update maintenance_schedule_days " + \
-            "set runcounter = runcounter + 1 " + \
+            "set runcounter = runcounter + 1, last_start = ? " + \
             "where schedule_id = ? and day = ?"
-        values = (schedule_id, day)
+        values = (start, schedule_id, day)
         self.execute_query(query, values)
 
     def delete_maintenance_schedule(self, schedule_id):
         LOGGER.info("Deleting maintenance schedule")
         query = "DELETE FROM maintenance_schedule " + \
-            "WHERE schedule_id = %d" % schedule_id
-        self.execute_query(query)
+            "WHERE schedule_id = ?"
+        self.execute_query(query, (schedule_id,))
+        _schedules['generation'] += 1
+
+    def add_deliveries(self, al, targets):
+        '''Queue the alert for delivery to each of the targets'''
+        now = int(time.time())
+        payload = json.dumps(al.to_dict())
+        query = ("INSERT INTO outbox (target, hash, payload, status, "
+                 "attempts, next_attempt, created, modified) "
+                 "VALUES (?, ?, ?, 'pending', 0, ?, ?, ?)")
+        self.execute_many(query, [(t, al.alhash, payload, now, now, now)
+                                  for t in targets])
+
+    def get_due_deliveries(self, limit):
+        '''Pending deliveries that are due, only the oldest for each
+        target and alert so they are delivered in order'''
+        # +o.id keeps the planner from walking the whole table in rowid
+        # order to skip the sort, the due rows are found with outbox_due
+        query = ("SELECT * FROM outbox o WHERE o.status = 'pending' "
+                 "AND o.next_attempt <= ? AND NOT EXISTS "
+                 "(SELECT 1 FROM outbox p WHERE p.status = 'pending' "
+                 "AND p.target = o.target AND p.hash = o.hash "
+                 "AND p.id < o.id) ORDER BY +o.id LIMIT ?")
+        result = self.select(query, (int(time.time()), limit),
+                             fetchone=False, use_column_name=True)
+        if result:
+            return result
+        return []
+
+    def get_previous_delivery_result(self, target, alhash, before):
+        '''Incident key or issue from the delivery before this one, if
+        that created it'''
+        query = ("SELECT result FROM outbox WHERE target = ? AND hash = ? "
+                 "AND status IN ('done', 'dead') AND id < ? "
+                 "ORDER BY id DESC LIMIT 1")
+        res = self.select(query, (target, alhash, before))
+        return res[0] if res else None
+
+    def delivery_done(self, delivery_id, result):
+        query = ("UPDATE outbox set status = 'done', result = ?, "
+                 "last_error = NULL, modified = ? where id = ?")
+        self.execute_query(query, (result, int(time.time()), delivery_id))
+
+    def delivery_failed(self, delivery_id, attempts, next_attempt, error,
+                        dead=False):
+        query = ("UPDATE outbox set status = ?, attempts = ?, "
+                 "next_attempt = ?, last_error = ?, modified = ? "
+                 "where id = ?")
+        values = ('dead' if dead else 'pending', attempts, next_attempt,
+                  error, int(time.time()), delivery_id)
+        self.execute_query(query, values)
+
+    def get_dead_deliveries(self):
+        query = ("SELECT * FROM outbox where status = 'dead' "
+                 "order by id desc")
+        result = self.select(query, fetchone=False, use_column_name=True)
+        if result:
+            return result
+        return []
+
+    def get_outbox_status(self):
+        query = "SELECT status, count(*) FROM outbox group by status"
+        result = self.select(query, fetchone=False)
+        return dict(result or [])
+
+    def retry_delivery(self, delivery_id):
+        LOGGER.info("Retrying delivery %d", delivery_id)
+        now = int(time.time())
+        query = ("UPDATE outbox set status = 'pending', attempts = 0, "
+                 "next_attempt = ?, modified = ? "
+                 "where id = ? and status = 'dead'")
+        self.execute_query(query, (now, now, delivery_id))
+
+    def delete_deliveries(self, before):
+        '''Delete finished deliveries last changed before before'''
+        query = "DELETE FROM outbox where status = 'done' and modified < ?"
+        rows = self.execute_query(query, (before,))
+        LOGGER.debug("Deleted %d delivered outbox records", rows)
 
     def get_aws_instance_info(self):
         query = "SELECT host, environment, state " + \
@@ -385,11 +870,13 @@ class DBController():
         LOGGER.debug("Deleted %d instance records", rows)
 
 
-CREATE_TABLES_SQL = '''
+# Database migrations, each is run once and in order. The index in the list
+# plus one is the schema version, stored as PRAGMA user_version.
+# Never change a migration that is released, add a new one.
+MIGRATIONS = []
 
--- DROP TABLE IF EXISTS active_alerts;
--- DROP TABLE IF EXISTS active_alert_tags;
--- DROP TRIGGER IF EXISTS delete_active_alert_tags;
+# Version 1, the schema from before migrations was introduced
+MIGRATIONS.append('''
 
 CREATE TABLE IF NOT EXISTS active_alerts(hash TEXT PRIMARY KEY,
 time INTEGER, id TEXT, message TEXT, previouslevel TEXT,
@@ -443,4 +930,123 @@ AFTER UPDATE on aws_instances
 BEGIN
 UPDATE aws_instances set modified = CURRENT_TIMESTAMP where host = new.host;
 END;
-'''
+''')
+
+# Version 2, indexes for time range queries on the alert log
+MIGRATIONS.append('''
+CREATE INDEX IF NOT EXISTS alert_log_time ON alert_log
+(time, id, environment, previouslevel, level, duration);
+
+CREATE INDEX IF NOT EXISTS alert_log_id_time ON alert_log(id, time);
+
+CREATE INDEX IF NOT EXISTS alert_log_environment_time
+ON alert_log(environment, time);
+
+-- Used by the flapping detection, which only looks at OK -> alert changes
+CREATE INDEX IF NOT EXISTS alert_log_alerting ON alert_log
+(id, time, hash, environment)
+WHERE previouslevel = 'OK' AND level != 'OK';
+''')
+
+# Version 3, hourly rollups of the alert log for statistics and summaries.
+# NULL environments are stored as '' to keep the primary key unique
+MIGRATIONS.append('''
+CREATE TABLE IF NOT EXISTS alert_log_hourly
+(bucket INTEGER, id TEXT, environment TEXT, previouslevel TEXT, level TEXT,
+count INTEGER, duration INTEGER,
+PRIMARY KEY (bucket, id, environment, previouslevel, level));
+''')
+
+# Version 4, tag keys and values are stored once in tag_keys/tag_values
+# and referred to by id from active_alert_tags and alert_log
+MIGRATIONS.append('''
+CREATE TABLE IF NOT EXISTS tag_keys
+(id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL);
+
+CREATE TABLE IF NOT EXISTS tag_values
+(id INTEGER PRIMARY KEY, value TEXT UNIQUE NOT NULL);
+
+INSERT OR IGNORE INTO tag_keys (key)
+SELECT DISTINCT key FROM active_alert_tags WHERE key IS NOT NULL;
+
+INSERT OR IGNORE INTO tag_values (value)
+SELECT value FROM active_alert_tags WHERE value IS NOT NULL
+UNION SELECT environment FROM alert_log WHERE environment IS NOT NULL
+UNION SELECT host FROM alert_log WHERE host IS NOT NULL;
+
+DROP TRIGGER IF EXISTS delete_active_alert_tags;
+
+CREATE TABLE active_alert_tags_new(hash TEXT,
+key_id INTEGER, value_id INTEGER,
+UNIQUE(hash, key_id, value_id)
+FOREIGN KEY (hash) REFERENCES active_alerts(hash));
+
+INSERT INTO active_alert_tags_new (hash, key_id, value_id)
+SELECT t.hash, k.id, v.id FROM active_alert_tags t
+JOIN tag_keys k ON k.key = t.key
+JOIN tag_values v ON v.value = t.value;
+
+DROP TABLE active_alert_tags;
+ALTER TABLE active_alert_tags_new RENAME TO active_alert_tags;
+
+CREATE TRIGGER IF NOT EXISTS delete_active_alert_tags
+AFTER DELETE on active_alerts
+BEGIN
+DELETE FROM active_alert_tags where hash = OLD.hash;
+END;
+
+CREATE TABLE alert_log_new(hash TEXT, time INTEGER, id TEXT,
+message TEXT, environment_id INTEGER, host_id INTEGER,
+previouslevel TEXT, level TEXT, duration INTEGER, pagerduty TEXT, jira TEXT,
+UNIQUE (hash, time));
+
+INSERT INTO alert_log_new (hash, time, id, message, environment_id, host_id,
+previouslevel, level, duration, pagerduty, jira)
+SELECT l.hash, l.time, l.id, l.message, e.id, h.id,
+l.previouslevel, l.level, l.duration, l.pagerduty, l.jira
+FROM alert_log l
+LEFT JOIN tag_values e ON e.value = l.environment
+LEFT JOIN tag_values h ON h.value = l.host
+ORDER BY l.rowid;
+
+DROP TABLE alert_log;
+ALTER TABLE alert_log_new RENAME TO alert_log;
+
+CREATE INDEX IF NOT EXISTS alert_log_time ON alert_log
+(time, id, environment_id, previouslevel, level, duration);
+
+CREATE INDEX IF NOT EXISTS alert_log_id_time ON alert_log(id, time);
+
+CREATE INDEX IF NOT EXISTS alert_log_environment_time
+ON alert_log(environment_id, time);
+
+CREATE INDEX IF NOT EXISTS alert_log_alerting ON alert_log
+(id, time, hash, environment_id)
+WHERE previouslevel = 'OK' AND level != 'OK';
+''')
+
+# Version 5, outbox of notifications waiting to be delivered to the targets
+MIGRATIONS.append('''
+CREATE TABLE IF NOT EXISTS outbox
+(id INTEGER PRIMARY KEY, target TEXT, hash TEXT, payload TEXT, status TEXT,
+attempts INTEGER, next_attempt INTEGER, last_error TEXT, result TEXT,
+created INTEGER, modified INTEGER);
+
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox(next_attempt)
+WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS outbox_target_hash ON outbox(target, hash, id);
+''')
+
+# Version 6, start of the window each schedule day last fired, so a window
+# that was ended early is not activated again
+MIGRATIONS.append('''
+ALTER TABLE maintenance_schedule_days ADD COLUMN last_start INTEGER;
+''')
+
+# Version 7, pending deliveries by target and alert, for finding the oldest
+# without reading the deliveries already done
+MIGRATIONS.append('''
+CREATE INDEX IF NOT EXISTS outbox_pending_target_hash
+ON outbox(target, hash, id) WHERE status = 'pending';
+''')
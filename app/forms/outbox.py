@@ -0,0 +1,13 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+# pylint: disable=R0903
+'''
+Module: forms.outbox.py
+'''
+from flask_wtf import FlaskForm
+from wtforms import SubmitField, HiddenField
+from wtforms.validators import DataRequired
+
+
+class RetryDelivery(FlaskForm):
+    delivery_id = HiddenField(validators=[DataRequired()])
+    submit = SubmitField("Retry")
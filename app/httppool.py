@@ -0,0 +1,93 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: httppool.py
+
+Shared outbound HTTP sessions, one per target, with keep-alive connection
+pools, timeouts and latency metrics
+'''
+import time
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app import app
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+class TargetSession():
+    """requests.Session for one target
+
+    Connections are kept alive and reused, up to pool_size per host.
+    Every request gets the target's (connect, read) timeout unless one
+    is given, and its latency is recorded.
+    """
+
+    def __init__(self, name, pool_size, timeout):
+        self.name = name
+        self._timeout = timeout
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._latencies = deque(maxlen=1000)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+        start = time.monotonic()
+        try:
+            res = self._session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self._record(time.monotonic() - start, False)
+            raise
+        self._record(time.monotonic() - start, res.ok)
+        return res
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _record(self, elapsed, ok):
+        with self._lock:
+            self._requests += 1
+            if not ok:
+                self._errors += 1
+            self._latencies.append(elapsed)
+
+    def metrics(self):
+        '''Request and error counts, and latencies in ms of the last
+        1000 requests'''
+        with self._lock:
+            latencies = sorted(self._latencies)
+            res = {'requests': self._requests, 'errors': self._errors}
+        if latencies:
+            res.update(
+                avg_ms=round(1000 * sum(latencies) / len(latencies), 1),
+                p50_ms=round(1000 * latencies[len(latencies) // 2], 1),
+                p95_ms=round(1000 * latencies[int(len(latencies) * .95)], 1),
+                max_ms=round(1000 * latencies[-1], 1))
+        return res
+
+
+def session(name):
+    '''The shared session of a target, created on first use'''
+    with _lock:
+        if name not in _sessions:
+            timeouts = app.config['HTTP_TIMEOUTS']
+            pool_sizes = app.config['HTTP_POOL_SIZES']
+            _sessions[name] = TargetSession(
+                name, pool_sizes.get(name, pool_sizes['default']),
+                tuple(timeouts.get(name, timeouts['default'])))
+        return _sessions[name]
+
+
+def metrics():
+    with _lock:
+        sessions = list(_sessions.values())
+    return {s.name: s.metrics() for s in sessions}
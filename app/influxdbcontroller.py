@@ -6,6 +6,8 @@ Module: influxcontroller.py
 Created: 27.Dec.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 '''
+import threading
+from contextlib import contextmanager
 import requests
 from influxdb import InfluxDBClient
 from influxdb.exceptions import InfluxDBClientError
@@ -19,6 +21,7 @@ class InfluxDBController():
         self._db = InfluxDBClient(host=app.config['INFLUXDB_HOST'],
                                   port=app.config['INFLUXDB_PORT'],
                                   database='kap')
+        self._local = threading.local()
 
     @staticmethod
     def _influxify(al, alhash, measurement, zero_time=False):
@@ -26,13 +29,7 @@ class InfluxDBController():
         # Used to count currently active alerts
         if zero_time:
             LOGGER.debug("Creating zero time data")
-            try:
-                env = [tag['value'] for tag in al.tags
-                       if tag['key'] == 'Environment'][0]
-            except KeyError:
-                env = None
-            if env == ['']:
-                env = None
+            env = al.tags.get('Environment') or None
             json_body = {
                 "measurement": measurement,
                 "tags": {
@@ -55,10 +52,7 @@ class InfluxDBController():
                     "duration": al.duration,
                     "message": al.message}
             }
-            tags = json_body['tags']
-            for t in al.tags:
-                tags[t['key']] = t['value']
-            json_body['tags'] = tags
+            json_body['tags'].update(al.tags)
 
         return json_body
 
@@ -75,10 +69,33 @@ class InfluxDBController():
             else:
                 self._update_db(self._influxify(al, al.alhash, "active", True))
 
+    @contextmanager
+    def batch(self):
+        '''Collect the points written by this thread in the block
+        and send them with a single write_points call'''
+        if getattr(self._local, 'points', None) is not None:
+            yield
+            return
+        self._local.points = []
+        try:
+            yield
+        finally:
+            points = self._local.points
+            self._local.points = None
+            if points:
+                self._write_points(points)
+
     def _update_db(self, data):
+        points = getattr(self._local, 'points', None)
+        if points is not None:
+            points.append(data)
+        else:
+            self._write_points([data])
+
+    def _write_points(self, points):
         LOGGER.debug("Running insert or update")
         try:
-            self._db.write_points([data])
+            self._db.write_points(points)
         except InfluxDBClientError as err:
             LOGGER.error("Error(%s) - %s", err.code, err.content)
         except requests.ConnectionError as err:
@@ -87,6 +104,12 @@ class InfluxDBController():
     def delete_active(self, al):
         if app.config['INFLUXDB_ENABLED'] is True:
             LOGGER.debug("Running delete series")
+            points = getattr(self._local, 'points', None)
+            if points:
+                # Don't let a batched point bring the series back
+                points[:] = [p for p in points
+                             if not (p['measurement'] == "active" and
+                                     p['tags']['hash'] == al.alhash)]
             try:
                 self._db.delete_series(measurement="active",
                                        tags={"hash": al.alhash})
@@ -0,0 +1,83 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: ingestqueue.py
+
+Bounded in-process queue for incoming alerts, drained by worker threads
+'''
+import queue
+import hashlib
+import threading
+
+from app import LOGGER
+
+
+class AlertQueue():
+    """Queue incoming alerts and process them in worker threads
+
+    Alerts are sharded on the alert hash onto one queue per worker, so
+    events for the same alert are always processed in the order they
+    arrived, while different alerts are processed in parallel.
+    """
+
+    def __init__(self, handler, maxsize, workers):
+        self._handler = handler
+        self._lanes = [queue.Queue(maxsize=max(1, maxsize // workers))
+                       for _ in range(workers)]
+        self._maxsize = maxsize
+        self._workers = []
+
+    @property
+    def running(self):
+        return bool(self._workers)
+
+    def depth(self):
+        return sum(lane.qsize() for lane in self._lanes)
+
+    def status(self):
+        return {'depth': self.depth(),
+                'maxsize': self._maxsize,
+                'workers': len(self._workers),
+                'lanes': [lane.qsize() for lane in self._lanes]}
+
+    def start(self):
+        LOGGER.info("Starting %d ingest workers", len(self._lanes))
+        for i, lane in enumerate(self._lanes):
+            t = threading.Thread(target=self._work, args=(lane,),
+                                 name="ingest-%d" % i, daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def _lane(self, alertid):
+        # Same hash as Alert.alhash, so one alert always ends up in one lane
+        alhash = hashlib.sha256(alertid.encode()).hexdigest()
+        return self._lanes[int(alhash[:8], 16) % len(self._lanes)]
+
+    def put(self, content):
+        '''Returns False if the queue is full'''
+        try:
+            self._lane(content['id']).put_nowait(content)
+            return True
+        except queue.Full:
+            LOGGER.error("Ingest queue is full, rejecting alert")
+            return False
+
+    def stop(self):
+        '''Process everything already queued, then stop the workers'''
+        LOGGER.info("Draining ingest queue, %d alerts left", self.depth())
+        for lane in self._lanes:
+            lane.put(None)
+        for t in self._workers:
+            t.join()
+        self._workers = []
+
+    def _work(self, lane):
+        while True:
+            content = lane.get()
+            try:
+                if content is None:
+                    return
+                self._handler(content)
+            except Exception:  # pylint: disable=W0703
+                LOGGER.exception("Failed processing queued alert")
+            finally:
+                lane.task_done()
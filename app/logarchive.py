@@ -0,0 +1,113 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: logarchive.py
+
+Compressed per day archive of old alert log records
+'''
+import os
+import gzip
+import json
+import time
+import threading
+
+from app import LOGGER
+
+
+class LogArchive():
+    """Alert log records stored as gzip'd newline delimited JSON,
+    one file per day (UTC)"""
+
+    def __init__(self, directory):
+        self._dir = directory
+        self._journal = os.path.join(directory, "journal.json")
+        self._lock = threading.Lock()
+
+    def _path(self, day):
+        return os.path.join(self._dir, "alert_log-%s.ndjson.gz" % day)
+
+    @staticmethod
+    def _day(timestamp):
+        return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+    def write(self, records):
+        '''Append records (dicts) to the archive files of their day'''
+        with self._lock:
+            self._append(records)
+        LOGGER.debug("Archived %d alert log records", len(records))
+
+    def move(self, records, keys, delete):
+        '''Append records to the archive, then call delete() to remove
+        them from where they came from. The archive sizes are kept in a
+        journal until delete() returns, so recover() can undo the append
+        of a move that was cut short'''
+        with self._lock:
+            os.makedirs(self._dir, exist_ok=True)
+            sizes = {}
+            for day in {self._day(r['time']) for r in records}:
+                path = self._path(day)
+                sizes[path] = (os.path.getsize(path)
+                               if os.path.exists(path) else 0)
+            tmp = self._journal + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump({'keys': keys, 'sizes': sizes}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._journal)
+            self._append(records)
+            delete()
+            os.remove(self._journal)
+        LOGGER.debug("Archived %d alert log records", len(records))
+
+    def recover(self, exists):
+        '''Finish a move that was cut short. exists(keys) tells if the
+        records of the move are still there, if so they were not deleted
+        and are cut off the archive again, so the next move adds them once'''
+        with self._lock:
+            if not os.path.exists(self._journal):
+                return
+            with open(self._journal) as f:
+                journal = json.load(f)
+            if exists([tuple(k) for k in journal['keys']]):
+                LOGGER.warning("Undoing unfinished archive of %d alert log "
+                               "records", len(journal['keys']))
+                for path, size in journal['sizes'].items():
+                    if not size:
+                        if os.path.exists(path):
+                            os.remove(path)
+                    elif os.path.getsize(path) > size:
+                        os.truncate(path, size)
+            os.remove(self._journal)
+
+    def _append(self, records):
+        days = {}
+        for r in records:
+            days.setdefault(self._day(r['time']), []).append(r)
+        os.makedirs(self._dir, exist_ok=True)
+        for day, recs in days.items():
+            with open(self._path(day), 'ab') as raw:
+                # Appending adds a new gzip member, which gzip reads fine
+                with gzip.open(raw, 'wt') as f:
+                    for r in recs:
+                        f.write(json.dumps(r) + "\n")
+                raw.flush()
+                os.fsync(raw.fileno())
+
+    def read(self, since, until=None):
+        '''Yield archived records with since <= time < until'''
+        if not os.path.isdir(self._dir):
+            return
+        first = self._day(since)
+        last = self._day(until) if until is not None else None
+        for name in sorted(os.listdir(self._dir)):
+            if not (name.startswith("alert_log-") and
+                    name.endswith(".ndjson.gz")):
+                continue
+            day = name[len("alert_log-"):-len(".ndjson.gz")]
+            if day < first or (last is not None and day > last):
+                continue
+            with gzip.open(os.path.join(self._dir, name), 'rt') as f:
+                for line in f:
+                    r = json.loads(line)
+                    if r['time'] >= since and (until is None or
+                                               r['time'] < until):
+                        yield r
@@ -0,0 +1,196 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: maintenance.py
+
+Compiled lookup structure for the active maintenance rules, and a timer
+that expires them
+'''
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+
+from app import LOGGER
+
+
+class _Trie():
+    """Rules keyed by a string, matched by every prefix of a text"""
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, prefix, rule):
+        node = self._root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        # The None key holds the rules ending at this node
+        node.setdefault(None, []).append(rule)
+
+    def match(self, text):
+        node = self._root
+        found = list(node.get(None, ()))
+        for c in text:
+            node = node.get(c)
+            if node is None:
+                break
+            found.extend(node.get(None, ()))
+        return found
+
+
+class _SubstringMatcher():
+    """Aho-Corasick automaton finding every rule whose pattern
+    is a substring of a text in a single pass
+
+    Add every pattern, then build() once before matching. A built
+    matcher is only read, so it can be shared between threads.
+    """
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+
+    def add(self, pattern, rule):
+        state = 0
+        for c in pattern:
+            if c not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[state][c] = len(self._goto) - 1
+            state = self._goto[state][c]
+        self._out[state].append(rule)
+
+    def build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and c not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(c, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def match(self, text):
+        found = list(self._out[0])
+        state = 0
+        for c in text:
+            while state and c not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(c, 0)
+            found.extend(self._out[state])
+        return found
+
+
+class MaintenanceIndex():
+    """Active maintenance rules compiled for matching against alerts
+
+    A rule matches an alert when the alert has the rule's tag key with
+    the exact value, or a value starting with 'foo' for a rule 'foo*', or
+    ending with 'foo' for a rule '*foo'. Rules on 'id' match when the
+    value, without leading or trailing '*', is part of the alert id.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self._exact = {}
+        self._prefix = {}
+        self._suffix = {}
+        self._ids = _SubstringMatcher()
+        for rule in rules:
+            key, value = rule['key'], rule['value']
+            self._exact.setdefault((key, value), []).append(rule)
+            if value.startswith('*'):
+                self._suffix.setdefault(key, _Trie()).add(
+                    value[1:][::-1], rule)
+            if value.endswith('*'):
+                self._prefix.setdefault(key, _Trie()).add(value[:-1], rule)
+            if key == 'id' and value.strip('*'):
+                self._ids.add(value.strip('*'), rule)
+        self._ids.build()
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, al):
+        '''Return the rules matching the alert'''
+        if not self.rules:
+            return []
+        found = []
+        for key, value in al.tags:
+            found.extend(self._exact.get((key, value), ()))
+            if key in self._prefix:
+                found.extend(self._prefix[key].match(value))
+            if key in self._suffix:
+                found.extend(self._suffix[key].match(value[::-1]))
+        found.extend(self._ids.match(al.id))
+        # The same rule may match more than once
+        return list({id(r): r for r in found}.values())
+
+    def matches(self, al):
+        return bool(self.match(al))
+
+
+class ExpiryTimer():
+    """Call expire(item) for each item once its time has passed
+
+    Items are kept in a min-heap on their expiry time, and a single
+    background thread sleeps until the earliest of them is due. The
+    thread is started when the first item is added.
+    """
+
+    def __init__(self, expire):
+        self._expire = expire
+        self._heap = []
+        # Tie breaker, items themselves need not be comparable
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, when, item):
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._seq), item))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="maintenance-expiry", daemon=True)
+                self._thread.start()
+            # Wake the thread in case this is now the earliest item
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _due(self):
+        due = []
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due = self._due()
+                while not due and not self._stopped:
+                    timeout = (self._heap[0][0] - time.time()
+                               if self._heap else None)
+                    self._cond.wait(timeout)
+                    due = self._due()
+                if self._stopped:
+                    return
+            for item in due:
+                try:
+                    self._expire(item)
+                except Exception:  # pylint: disable=W0703
+                    LOGGER.exception("Failed to expire %s", item)
@@ -0,0 +1,67 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: ratelimit.py
+
+Token bucket rate limiting of outbound messages
+'''
+import time
+import threading
+
+_buckets = {}
+_lock = threading.Lock()
+
+
+class TokenBucket():
+    """Allow rate requests per second on average, in bursts of up to
+    capacity requests"""
+
+    def __init__(self, rate, capacity):
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity,
+                           self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def try_acquire(self):
+        '''Take a token if there is one'''
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def acquire(self, timeout=None):
+        '''Wait for a token, at most timeout seconds'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self._rate
+            if deadline is not None:
+                if time.monotonic() + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+    def tokens(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+
+def bucket(name, rate, capacity):
+    '''The bucket shared by everything sending to name, created on first
+    use'''
+    with _lock:
+        if name not in _buckets:
+            _buckets[name] = TokenBucket(rate, capacity)
+        return _buckets[name]
@@ -6,65 +6,79 @@ Module: routes.py
 Created: 23.Mar.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 '''
+import json
 import time
 import calendar
 import operator
+import functools
 from datetime import timedelta
 from flask import Response, request, render_template, redirect, jsonify
-from app import app, LOGGER, TZNAME
+from app import app, LOGGER, TZNAME, httppool, circuitbreaker
 from app.forms.maintenance import ActivateForm, DeactivateForm, DeleteSchedule
 from app.forms.maintenance import QuickActivate
+from app.forms.outbox import RetryDelivery
 from app.alertcontroller import AlertController
 from app.dbcontroller import DBController
+from app.ingestqueue import AlertQueue
 
 
 alertcontroller = AlertController()
 db = DBController()
+alertqueue = AlertQueue(alertcontroller.process,
+                        maxsize=app.config['INGEST_QUEUE_SIZE'],
+                        workers=app.config['INGEST_WORKERS'])
+
+
+def ingest(content):
+    '''Process or queue an incoming alert, returns the http status code'''
+    if alertqueue.running:
+        if not alertcontroller.validate(content):
+            return 400
+        if not alertqueue.put(content):
+            return 503
+        return 202
+    alertcontroller.process(content)
+    return 200
+
+
+@app.teardown_request
+def release_db_connection(_exc):
+    db.release()
 
 
 @app.route("/kap/alert", methods=['post'])
 def alert():
     LOGGER.info("Received new data")
-    al = alertcontroller.create_alert(request.json)
-    if al is not None:
-        al = db.get_tickets_and_keys(al)
-        if not al.grafana_url:
-            al.grafana_url = alertcontroller.add_grafana_url(al)
-        LOGGER.info("Alert info:\n%s\n%s -> %s, Duration: %d\n"
-                    "State duration: %s, Sent: %s\nJIRA: %s, PD: %s",
-                    al.id, al.previouslevel, al.level, al.duration,
-                    al.state_duration, al.sent,
-                    al.jira_issue, al.pd_incident_key)
-        if al.sent:
-            if al.level != al.previouslevel:
-                LOGGER.info("State has changed, notify targets")
-                alertcontroller.dispatch_and_update_status(al)
-            else:
-                LOGGER.info("No change, updating existing alert")
-                alertcontroller.dispatch_and_update_status(al, dispatch=False)
-            return Response(response={'Success': True},
-                            status=200, mimetype='application/json')
-        else:
-            if app.config['FLAPPING_DETECTION_ENABLED'] and db.is_flapping(al):
-                LOGGER.info("Alert is flapping")
-                al.message = "Flapping! " + al.message
-                alertcontroller.dispatch_and_update_status(al, dispatch=False)
-                return Response(response={'Success': True},
-                                status=200, mimetype='application/json')
-            if al.state_duration:
-                LOGGER.info("Alert delayed by state duration, no dispatch")
-                alertcontroller.dispatch_and_update_status(al, dispatch=False)
-            elif al.duration < app.config['ALERTING_DELAY']:
-                LOGGER.info("Alert delayed, no dispatch")
-                alertcontroller.dispatch_and_update_status(al, dispatch=False)
-            elif al.level == 'OK':
-                LOGGER.info("Alert OK without being sent, no dispatch")
-                alertcontroller.dispatch_and_update_status(al, dispatch=False)
-            else:
-                LOGGER.info("New alert, notify targets")
-                alertcontroller.dispatch_and_update_status(al)
-    return Response(response={'Success': True},
-                    status=200, mimetype='application/json')
+    status_code = ingest(request.json)
+    return Response(response={'Success': status_code < 300},
+                    status=status_code, mimetype='application/json')
+
+
+@app.route("/kap/alerts/batch", methods=['post'])
+def alert_batch():
+    LOGGER.info("Received new batch")
+    # Read in blocks, a JSON array may well be a single line
+    blocks = iter(functools.partial(request.stream.read, 65536), b'')
+    results = alertcontroller.process_batch(
+        alertcontroller.parse_batch(blocks))
+    LOGGER.info("Processed batch of %d alerts", len(results))
+    return jsonify(Success=all(r['Success'] for r in results),
+                   results=results)
+
+
+@app.route("/kap/queue", methods=['GET'])
+def queue_status():
+    status = alertqueue.status()
+    status['processed'] = alertcontroller.processed
+    return jsonify(status)
+
+
+@app.route("/kap/targets", methods=['GET'])
+def target_status():
+    targets = httppool.metrics()
+    for name, breaker in circuitbreaker.status().items():
+        targets.setdefault(name, {})['circuit'] = breaker
+    return jsonify(targets)
 
 
 @app.route("/kap/maintenance", methods=['GET', 'POST'])
@@ -102,11 +116,11 @@ def status():
         db.activate_maintenance("id", quickmaintenance.alert_id.data,
                                 "8h", "Muted from status page")
         return redirect('/kap/status')
-    mrules = db.get_active_maintenance_rules()
+    mindex = db.get_maintenance_index()
     aim = []
     active_alerts = db.get_active_alerts()
     for a in active_alerts:
-        if alertcontroller.affected_by_mrules(mrules=mrules, al=a):
+        if alertcontroller.affected_by_mrules(mindex=mindex, al=a):
             aim.append(a)
     return render_template('status.html', title="Active alerts",
                            alerts=active_alerts, maintenance=aim,
@@ -115,22 +129,39 @@ def status():
 
 @app.route("/kap/statistics", methods=['GET'])
 def statistics():
-    stats = db.get_statistics(24)
+    hours = request.args.get('hours', 24, type=int)
+    stats = db.get_statistics(hours)
     stats.sort(key=operator.itemgetter(1, 2, 4))
-    return render_template('statistics.html', title="Last 24 hours",
+    return render_template('statistics.html', title="Last %d hours" % hours,
                            stats=stats)
 
 
 @app.route("/kap/log", methods=['GET'])
 def log():
     environment = request.args.get('environment')
-    records = db.get_log_records(12)
-    if environment:
-        records = db.get_log_records(12, environment)
-    return render_template('log.html', title="Last 12 hours",
+    hours = request.args.get('hours', 12, type=int)
+    records = db.get_log_records(hours, environment,
+                                 'archive' in request.args)
+    return render_template('log.html', title="Last %d hours" % hours,
                            records=records, tzname=TZNAME)
 
 
+@app.route("/kap/outbox", methods=['GET', 'POST'])
+def outbox():
+    rf = RetryDelivery()
+    if rf.validate_on_submit():
+        db.retry_delivery(int(rf.delivery_id.data))
+        return redirect('/kap/outbox')
+    deliveries = []
+    for r in db.get_dead_deliveries():
+        d = dict(r)
+        d['alert'] = json.loads(d.pop('payload'))
+        deliveries.append(d)
+    return render_template('outbox.html', title="Failed deliveries",
+                           deliveries=deliveries, rf=rf,
+                           status=db.get_outbox_status(), tzname=TZNAME)
+
+
 @app.route("/kap/ticks", methods=['GET'])
 def ticks():
     defined_ticks = alertcontroller.get_defined_tick_scripts()
@@ -0,0 +1,80 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: routing.py
+
+Decide which targets an alert is sent to, from the *_ENABLED,
+*_EXCLUDED_TAGS and PAGERDUTY_EXCLUDED_TICKS settings
+'''
+from app import LOGGER
+
+# Targets as bits in a mask
+SLACK = 1
+PAGERDUTY = 2
+JIRA = 4
+KAOS = 8
+
+_TARGETS = ((SLACK, 'SLACK'), (PAGERDUTY, 'PAGERDUTY'),
+            (JIRA, 'JIRA'), (KAOS, 'KAOS'))
+
+
+def names(mask):
+    '''Lower case names of the targets in the mask'''
+    return [name.lower() for target, name in _TARGETS if mask & target]
+
+
+class TargetRouter():
+    """Excluded tags compiled to one lookup for all targets
+
+    Every excluded (key, value) pair maps to the mask of the targets
+    excluding it. MonGroup is a special tag that can have multiple pipe
+    separated values, each of them is looked up on its own. Masks are
+    memoized on the set of tags, since the same host and environment
+    combinations come in over and over again.
+    """
+
+    def __init__(self, config, memo_size=10000):
+        self._enabled = 0
+        self._excluded = {}
+        self._mongroups = {}
+        for target, name in _TARGETS:
+            if config[name + '_ENABLED']:
+                self._enabled |= target
+            for tag in config[name + '_EXCLUDED_TAGS']:
+                pair = (tag['key'], tag['value'])
+                self._excluded[pair] = self._excluded.get(pair, 0) | target
+                if tag['key'] == 'MonGroup':
+                    self._mongroups[tag['value']] = \
+                        self._mongroups.get(tag['value'], 0) | target
+        self._ticks = frozenset(config['PAGERDUTY_EXCLUDED_TICKS'])
+        self._memo = {}
+        self._memo_size = memo_size
+
+    def excluded(self, tags):
+        '''Mask of the targets excluding one or more of the tags,
+        an app.alert.Tags'''
+        mask = self._memo.get(tags)
+        if mask is None:
+            mask = 0
+            for key, value in tags:
+                mask |= self._excluded.get((key, value), 0)
+                if key == 'MonGroup' and self._mongroups:
+                    for group in value.split("|"):
+                        mask |= self._mongroups.get(group, 0)
+            if len(self._memo) >= self._memo_size:
+                self._memo.clear()
+            self._memo[tags] = mask
+        return mask
+
+    def targets(self, al):
+        '''Mask of the enabled targets the alert should be sent to'''
+        mask = self._enabled & ~self.excluded(al.tags)
+        if mask & PAGERDUTY and self._ticks:
+            # This only works if {{ .TaskName }} is the last element of the id
+            tick = al.id.rsplit(None, 1)[-1:]
+            if tick and tick[0] in self._ticks:
+                LOGGER.info("Tick %s is excluded", tick[0])
+                mask &= ~PAGERDUTY
+        if mask != self._enabled:
+            LOGGER.info("Excluded targets for %s: %s", al.id,
+                        ", ".join(names(self._enabled & ~mask)))
+        return mask
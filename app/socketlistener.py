@@ -0,0 +1,82 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: socketlistener.py
+
+Receive alerts from the kapacitor tcp handler, one JSON alert per line
+'''
+import os
+import json
+import threading
+import socketserver
+
+from app import app, LOGGER
+from app.dbcontroller import DBController
+
+
+class AlertStreamHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                content = json.loads(line.decode())
+            except ValueError:
+                LOGGER.error("Received invalid JSON on alert socket")
+                continue
+            try:
+                status = self.server.ingest(content)
+            except Exception:  # pylint: disable=W0703
+                LOGGER.exception("Failed processing alert from socket")
+                continue
+            if status == 400:
+                LOGGER.error("Invalid alert on alert socket: %s",
+                             line.decode())
+            elif status == 503:
+                LOGGER.error("Alert queue is full, alert from socket "
+                             "dropped: %s", content.get('id'))
+
+    def finish(self):
+        super(AlertStreamHandler, self).finish()
+        # Kapacitor opens a connection per alert, give the database
+        # connection of this thread back to the pool
+        DBController.release()
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class SocketListener():
+    """Listen for alerts on a tcp port, or a unix socket if
+    SOCKET_LISTENER_PATH is set, and hand them to ingest"""
+
+    def __init__(self, ingest):
+        path = app.config['SOCKET_LISTENER_PATH']
+        if path:
+            if os.path.exists(path):
+                os.unlink(path)
+            self._server = _UnixServer(path, AlertStreamHandler)
+            LOGGER.info("Listening for alerts on %s", path)
+        else:
+            address = (app.config['SOCKET_LISTENER_ADDRESS'],
+                       app.config['SOCKET_LISTENER_PORT'])
+            self._server = _TCPServer(address, AlertStreamHandler)
+            LOGGER.info("Listening for alerts on %s:%d", *address)
+        self._server.ingest = ingest
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="socket-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
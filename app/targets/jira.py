@@ -8,29 +8,71 @@ Create and update issues with JIRA REST API
 Created: 08.May.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 """
+import time
+import threading
 from jira.client import JIRA
 from jira.exceptions import JIRAError
 from app import LOGGER
 
+# Clients shared by all incidents, by (server, username)
+_clients = {}
+_clients_lock = threading.Lock()
+# {(project, issue type, status): (expires, {name: (id, to status)})}
+_transitions = {}
+_transitions_lock = threading.Lock()
+
 
 class Incident():
-    def __init__(self, server, username, password, project_key, assignee):
+    def __init__(self, server, username, password, project_key, assignee,
+                 transition_ttl=3600):
         LOGGER.info("Initiating jira incident")
         self._server = server
         self._username = username
         self._password = password
         self._project_key = project_key
         self._assignee = assignee
+        self._transition_ttl = transition_ttl
 
     def _connect(self):
+        '''The shared client, connecting on first use'''
+        key = (self._server, self._username)
+        with _clients_lock:
+            conn = _clients.get(key)
+        if conn is not None:
+            return conn
+        # Not under the lock, connecting takes a round trip to JIRA
         LOGGER.info("Connecting to JIRA")
         try:
             conn = JIRA(options={'server': self._server},
                         basic_auth=(self._username, self._password))
-            return conn
         except JIRAError as err:
             LOGGER.error("Failed connecting to JIRA")
             LOGGER.error(err)
+            return None
+        with _clients_lock:
+            # Another thread may have connected in the meantime
+            return _clients.setdefault(key, conn)
+
+    def _disconnect(self, conn):
+        with _clients_lock:
+            if _clients.get((self._server, self._username)) is conn:
+                del _clients[(self._server, self._username)]
+
+    def _call(self, action):
+        '''Return action(jira) with the shared client. If JIRA no longer
+        accepts the client it is replaced, and action is tried once more.
+        Every JIRA request goes through here'''
+        for retry in (True, False):
+            jira = self._connect()
+            if jira is None:
+                return None
+            try:
+                return action(jira)
+            except JIRAError as err:
+                if err.status_code != 401 or not retry:
+                    raise
+                LOGGER.warning("Not authorized by JIRA, connecting again")
+                self._disconnect(jira)
         return None
 
     def _create(self, alert):
@@ -45,61 +87,84 @@ class Incident():
                       'components': [{'name': self._assignee}],
                       'issuetype': {'name': 'Incident'},
                       'security': {'name': 'Internal Issue'}}
-        jira = self._connect()
-        if jira:
+        try:
+            LOGGER.info("Creating JIRA ticket")
+            issue = self._call(
+                lambda jira: jira.create_issue(fields=issue_dict))
+            if issue:
+                return issue.key
+        except JIRAError as err:
+            LOGGER.error("Failed creating JIRA ticket")
+            LOGGER.error(err)
+        return None
+
+    def _get_transition(self, issue, status, name):
+        '''(id, status after) of the transition called name from status.
+        The transitions of each project, issue type and status are cached
+        for transition_ttl seconds, status None skips the cache'''
+        key = (issue.fields.project.key, issue.fields.issuetype.name, status)
+        now = time.monotonic()
+        with _transitions_lock:
+            cached = _transitions.get(key)
+        if status is None or cached is None or cached[0] < now:
             try:
-                LOGGER.info("Creating JIRA ticket")
-                issue = jira.create_issue(fields=issue_dict)
-                if issue:
-                    return issue.key
+                LOGGER.info("Getting available transistions")
+                transitions = self._call(
+                    lambda jira: jira.transitions(issue))
             except JIRAError as err:
-                LOGGER.error("Failed creating JIRA ticket")
                 LOGGER.error(err)
-        return None
+                return None, None
+            if transitions is None:
+                return None, None
+            found = {t['name']: (t['id'], t.get('to', {}).get('name'))
+                     for t in transitions}
+            cached = (now + self._transition_ttl, found)
+            if status is not None:
+                with _transitions_lock:
+                    _transitions[key] = cached
+        return cached[1].get(name, (None, None))
 
     @staticmethod
-    def _get_transistion_id(jira, issue, name):
-        try:
-            LOGGER.info("Getting available transistions")
-            transitions = jira.transitions(issue)
-            t = [t['id'] for t in transitions if t['name'] == name]
-            if t:
-                return t[0]
-        except JIRAError as err:
-            LOGGER.error(err)
-        return None
+    def _forget_transitions(issue, status):
+        # A cached transition was refused, get them again next time
+        with _transitions_lock:
+            _transitions.pop((issue.fields.project.key,
+                              issue.fields.issuetype.name, status), None)
 
-    def _resolve(self, jira, issue):
+    def _resolve(self, issue):
+        '''Returns the status of the issue afterwards, None if unknown'''
+        status = issue.fields.status.name
         try:
             LOGGER.info("Resolving JIRA ticket")
-            t = self._get_transistion_id(jira, issue, 'Resolve Issue')
+            t, to = self._get_transition(issue, status, 'Resolve Issue')
             if t:
-                jira.transition_issue(issue, t)
+                self._call(lambda jira: jira.transition_issue(issue, t))
                 LOGGER.debug("JIRA ticket resolved")
+                return to
         except JIRAError as err:
             LOGGER.error("Failed resolving JIRA ticket")
             LOGGER.error(err)
+            self._forget_transitions(issue, status)
+        return status
 
-    def _close(self, jira, issue):
+    def _close(self, issue, status):
         try:
             LOGGER.info("Closing JIRA ticket")
-            t = self._get_transistion_id(jira, issue, 'Close Issue')
+            t, _ = self._get_transition(issue, status, 'Close Issue')
             if t and len(issue.fields.comment.comments) <= 0:
-                jira.transition_issue(issue, t)
+                self._call(lambda jira: jira.transition_issue(issue, t))
                 LOGGER.debug("JIRA ticket closed")
         except JIRAError as err:
             LOGGER.error("Failed closing JIRA ticket")
             LOGGER.error(err)
+            self._forget_transitions(issue, status)
 
     def _resolve_and_close(self, key):
-        jira = self._connect()
-        if jira:
-            issue = jira.issue(key)
-            if not issue:
-                LOGGER.error("Failed to get issue")
-                return
-            self._resolve(jira, issue)
-            self._close(jira, issue)
+        issue = self._call(lambda jira: jira.issue(key))
+        if not issue:
+            LOGGER.error("Failed to get issue")
+            return
+        self._close(issue, self._resolve(issue))
 
     def post(self, alert):
         if alert.level == 'CRITICAL' and alert.jira_issue is None:
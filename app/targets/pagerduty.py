@@ -9,7 +9,7 @@ Created by: Morten Hersson, <mhersson@gmail.com>
 """
 import json
 import requests
-from app import LOGGER
+from app import LOGGER, httppool
 
 
 class Pagerduty():
@@ -17,6 +17,7 @@ class Pagerduty():
         LOGGER.info("Initiating pagerduty")
         self._url = url
         self._service_key = service_key
+        self._http = httppool.session('pagerduty')
 
     def _create_event(self, alert, event_type="trigger"):
         LOGGER.info("Creating pagerduty event")
@@ -43,6 +44,16 @@ class Pagerduty():
         return pd_json
 
     def post(self, alert):
+        '''Send the event for the alert, returns the incident key'''
+        try:
+            return self.send(alert)
+        except requests.exceptions.RequestException:
+            LOGGER.exception("Failed sending event to pagerduty")
+            return alert.pd_incident_key
+
+    def send(self, alert):
+        '''Like post, but raises RequestException if the event could not
+        be sent'''
         if alert.level == 'CRITICAL':
             message = self._create_event(alert)
         elif (alert.level != 'CRITICAL' and
@@ -52,9 +63,65 @@ class Pagerduty():
             LOGGER.info("None critical event")
             return alert.pd_incident_key
         LOGGER.info("Sending event")
-        res = requests.post(self._url, json=message)
+        res = self._http.post(self._url, json=message)
+        LOGGER.debug("Status code: %d, Content: %s",
+                     res.status_code, res.content.decode())
+        res.raise_for_status()
+        return json.loads(res.content.decode()).get('incident_key')
+
+
+class PagerdutyV2(Pagerduty):
+    """Send events to the pagerduty events API v2
+
+    The alert hash is used as dedup key, so the incident key is known
+    before the event is sent, and sending an event again is harmless.
+    """
+    _severities = {"CRITICAL": "critical", "WARNING": "warning",
+                   "INFO": "info", "OK": "info"}
+
+    def __init__(self, url, routing_key):
+        super(PagerdutyV2, self).__init__(url, routing_key)
+
+    @staticmethod
+    def incident_key(alert):
+        '''The dedup key of events for the alert'''
+        return alert.pd_incident_key or alert.alhash
+
+    def _create_event(self, alert, event_type="trigger"):
+        LOGGER.info("Creating pagerduty event")
+        pd_json = {
+            "routing_key": self._service_key,
+            "event_action": event_type,
+            "dedup_key": self.incident_key(alert)
+        }
+        if event_type == "trigger":
+            LOGGER.debug("Type trigger event")
+            pd_json["payload"] = {
+                "summary": alert.id,
+                "source": alert.tags.get('host') or "kapacitor",
+                "severity": self._severities.get(alert.level, "critical"),
+                "custom_details": {
+                    "message": alert.message
+                }
+            }
+            pd_json["client"] = "KAP"
+        else:
+            LOGGER.debug("Type resolve event")
+        return pd_json
+
+    def send(self, alert):
+        '''Like post, but raises RequestException if the event could not
+        be sent'''
+        if alert.level == 'CRITICAL':
+            message = self._create_event(alert)
+        elif alert.pd_incident_key is not None:
+            message = self._create_event(alert, event_type="resolve")
+        else:
+            LOGGER.info("None critical event")
+            return alert.pd_incident_key
+        LOGGER.info("Sending event")
+        res = self._http.post(self._url, json=message)
         LOGGER.debug("Status code: %d, Content: %s",
                      res.status_code, res.content.decode())
-        if res:
-            return json.loads(res.content.decode()).get('incident_key')
-        return alert.pd_incident_key
+        res.raise_for_status()
+        return message["dedup_key"]
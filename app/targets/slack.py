@@ -7,8 +7,13 @@ Send messages to slack using webhooks
 Created:24.Mar.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 """
+import threading
 import requests
-from app import LOGGER
+from app import LOGGER, httppool, ratelimit
+
+# One digest per webhook and channel, shared by every AlertController
+_digests = {}
+_digests_lock = threading.Lock()
 
 
 class Slack():
@@ -17,21 +22,21 @@ class Slack():
         self._url = url
         self._channel = channel
         self._username = username
+        self._http = httppool.session('slack')
         self._colors = {"OK": "good", "INFO": "#439FE0",
                         "WARNING": "warning", "CRITICAL": "danger"}
 
     def post(self, alert):
-        '''Post alert to slack'''
-        slack_json = {"username": self._username,
-                      "channel": self._channel,
-                      "attachments": [{"fallback": alert.message,
-                                       "color": self._colors[alert.level],
-                                       "text": alert.message}]}
+        '''Post alert to slack, returns True if slack accepted it'''
         LOGGER.info("Posting to channel %s", self._channel)
-        res = requests.post(self._url, json=slack_json)
-        if res:
-            LOGGER.debug("Response from server: %d %s",
-                         res.status_code, res.content.decode())
+        return self._post(self._alert_json(alert))
+
+    def _alert_json(self, alert):
+        return {"username": self._username,
+                "channel": self._channel,
+                "attachments": [{"fallback": alert.message,
+                                 "color": self._colors[alert.level],
+                                 "text": alert.message}]}
 
     def post_message(self, title, message, color='INFO'):
         '''Post message with title to slack '''
@@ -41,7 +46,150 @@ class Slack():
                                        "color": self._colors[color],
                                        "text": message}]}
         LOGGER.info("Posting to channel %s", self._channel)
-        res = requests.post(self._url, json=slack_json)
+        return self._post(slack_json)
+
+    def _post(self, slack_json):
+        try:
+            res = self._http.post(self._url, json=slack_json)
+        except requests.exceptions.RequestException:
+            LOGGER.exception("Failed posting to slack")
+            return False
         if res:
             LOGGER.debug("Response from server: %d %s",
                          res.status_code, res.content.decode())
+        else:
+            LOGGER.error("Slack answered %d %s",
+                         res.status_code, res.content.decode())
+        return res.ok
+
+
+class SlackDigest(Slack):
+    """Slack target that sends one message per window instead of one per
+    alert, with the alerts grouped by environment and level
+
+    Every message is rate limited by a token bucket shared by all posts to
+    the same webhook, and dropped if the bucket is empty. A digest that
+    could not be posted is kept for the next window. CRITICAL alerts are
+    posted right away if critical_bypass is set and the bucket has a token
+    left. Use digest() to get the one shared by all senders.
+    """
+    _levels = ["CRITICAL", "WARNING", "INFO", "OK"]
+
+    def __init__(self, url, channel, username, window, max_lines,
+                 rate, burst, critical_bypass):
+        super(SlackDigest, self).__init__(url, channel, username)
+        self._window = window
+        self._max_lines = max_lines
+        self._critical_bypass = critical_bypass
+        self._bucket = ratelimit.bucket("slack:" + url, rate, burst)
+        # {(environment, level): {'count': n, 'lines': [message, ...]}}
+        self._digest = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def post(self, alert):
+        '''Add the alert to the next digest, always returns True'''
+        if (self._critical_bypass and alert.level == 'CRITICAL' and
+                self._bucket.try_acquire()):
+            LOGGER.info("Posting CRITICAL alert to channel %s", self._channel)
+            # The token is already taken, skip the limiter
+            return Slack._post(self, self._alert_json(alert))
+        group = (alert.tags.get('Environment') or '-', alert.level)
+        with self._lock:
+            entry = self._digest.setdefault(group, {'count': 0, 'lines': []})
+            entry['count'] += 1
+            if len(entry['lines']) < self._max_lines:
+                entry['lines'].append(alert.message)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="slack-digest", daemon=True)
+                self._thread.start()
+        return True
+
+    def _post(self, slack_json, timeout=0):
+        # Does not wait for a token unless told to, a busy webhook must
+        # not hold up the caller, like a JIRA delivery posting the url of
+        # its new issue
+        if timeout:
+            allowed = self._bucket.acquire(timeout=timeout)
+        else:
+            allowed = self._bucket.try_acquire()
+        if not allowed:
+            LOGGER.warning("Slack rate limit reached, message not sent")
+            return False
+        return super(SlackDigest, self)._post(slack_json)
+
+    def _run(self):
+        while not self._stopped.wait(self._window):
+            self.flush()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            # Let a flush in progress finish
+            thread.join()
+        # The last chance to post it, wait for a token
+        self.flush(timeout=self._window)
+
+    def flush(self, timeout=0):
+        '''Post the alerts collected since the last flush'''
+        with self._lock:
+            digest, self._digest = self._digest, {}
+        if not digest:
+            return
+        LOGGER.info("Posting digest to channel %s", self._channel)
+        if not self._post(self._digest_json(digest), timeout=timeout):
+            # Try again with the next window
+            with self._lock:
+                for group, entry in digest.items():
+                    new = self._digest.setdefault(
+                        group, {'count': 0, 'lines': []})
+                    new['count'] += entry['count']
+                    new['lines'] = (entry['lines'] +
+                                    new['lines'])[:self._max_lines]
+
+    def _digest_json(self, digest):
+        attachments = []
+        for env, level in sorted(digest, key=lambda g: (
+                self._levels.index(g[1]) if g[1] in self._levels
+                else len(self._levels), g[0])):
+            entry = digest[(env, level)]
+            lines = entry['lines']
+            more = entry['count'] - len(lines)
+            text = "\n".join(lines)
+            if more > 0:
+                text += "\n... and %d more" % more
+            attachments.append({
+                "title": "%s %s: %d" % (env, level, entry['count']),
+                "fallback": "%s %s: %d" % (env, level, entry['count']),
+                "color": self._colors.get(level, self._colors['INFO']),
+                "text": text})
+        total = sum(e['count'] for e in digest.values())
+        return {"username": self._username,
+                "channel": self._channel,
+                "text": "%d alerts in the last %d seconds" % (
+                    total, self._window),
+                "attachments": attachments}
+
+
+def digest(url, channel, username, window, max_lines, rate, burst,
+           critical_bypass):
+    '''The digest posting to the webhook and channel, created on first
+    use'''
+    with _digests_lock:
+        if (url, channel) not in _digests:
+            _digests[(url, channel)] = SlackDigest(
+                url, channel, username, window, max_lines, rate, burst,
+                critical_bypass)
+        return _digests[(url, channel)]
+
+
+def stop_digests():
+    '''Stop every digest and post the alerts it still holds'''
+    with _digests_lock:
+        digests = list(_digests.values())
+    for d in digests:
+        d.stop()
@@ -6,15 +6,21 @@ Created by: Morten Hersson, <morten@escenic.com>
 
 Copyright (c) 2018 Morten Hersson
 """
+import json
 import time
+import heapq
+import random
 import boto3
 import calendar
 import datetime
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import NoCredentialsError, ProfileNotFound
 from botocore.exceptions import NoRegionError, ClientError
 
 from app import app, LOGGER
+from app import routing, httppool, circuitbreaker
+from app.alert import Alert, Tags
 from app.alertcontroller import AlertController
 from app.dbcontroller import DBController
 
@@ -81,6 +87,59 @@ class AWSInfoCollector():
             self._db.delete_aws_instance_info(deletes)
 
 
+class StaleAlertCleaner():
+    """Remove active alerts from terminated instances, and resolve their
+    Pagerduty incidents and JIRA tickets
+
+    The tickets and incidents are resolved through deliver(), so the rate
+    limits and circuit breakers of the targets apply, by up to
+    STALE_CLEANUP_WORKERS threads.
+    """
+
+    def __init__(self):
+        LOGGER.info("Initiating stale alert cleaner")
+        self.alertctrl = AlertController()
+        self.workers = app.config['STALE_CLEANUP_WORKERS']
+
+    def run(self):
+        instances = self.alertctrl.update_aws_instance_info()
+        if not instances:
+            # Everything would look stale
+            LOGGER.warning("No aws instance info, skipping stale alerts")
+            return
+        stale = self.alertctrl.get_stale_alerts(instances)
+        if not stale:
+            return
+        start = time.monotonic()
+        self.alertctrl.remove_stale_alerts(stale)
+        issues = [al for al in stale if al.jira_issue]
+        closed = self._resolve('jira', issues, lambda al: al.jira_issue)
+        incidents = [al for al in stale if al.pd_incident_key]
+        resolved = self._resolve('pagerduty', incidents,
+                                 lambda al: al.pd_incident_key)
+        LOGGER.info("Removed %d stale alerts, transitioned %d of %d JIRA "
+                    "tickets and resolved %d of %d Pagerduty incidents in "
+                    "%.1f seconds", len(stale), closed, len(issues),
+                    resolved, len(incidents), time.monotonic() - start)
+
+    def _resolve(self, target, alerts, key):
+        '''Send the alerts, now OK, to the target. Returns the number sent'''
+        def resolve(al):
+            try:
+                self.alertctrl.deliver(target, al)
+                return True
+            except Exception as err:  # pylint: disable=W0703
+                LOGGER.error("Failed resolving %s ticket %s: %s",
+                             target, key(al), err)
+                return False
+
+        if not alerts:
+            return 0
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix="stale") as pool:
+            return sum(pool.map(resolve, alerts))
+
+
 class FlapDetective():
     """Flapping detection class """
 
@@ -91,7 +150,6 @@ class FlapDetective():
         self.db = DBController()
         self.limit = app.config['FLAPPING_LIMIT']
         self.slack_enabled = app.config['SLACK_ENABLED']
-        self.excluded_tags = app.config['SLACK_EXCLUDED_TAGS']
 
     def run(self):
         LOGGER.info("Searching for flapping alerts")
@@ -125,8 +183,8 @@ class FlapDetective():
             self.db.unset_flapping(a[0], a[1])
 
     def notify(self, alertid, environ, count, flapping=True, reminder=False):
-        tag = [{'key': 'Environment', 'value': environ}]
-        ignore = self.alertctrl.contains_excluded_tags(self.excluded_tags, tag)
+        tag = Tags([('Environment', environ)])
+        ignore = self.alertctrl.router.excluded(tag) & routing.SLACK
         if self.slack_enabled and not ignore:
             if flapping:
                 title = "Flapping detected"
@@ -177,14 +235,13 @@ class KAOS():
 
     def run(self):
         kaos_report = {app.config['KAOS_CUSTOMER']: []}
-        mrules = self.db.get_active_maintenance_rules()
+        mindex = self.db.get_maintenance_index()
         for v in self.db.get_active_alerts():
-            if not self.alertctrl.affected_by_mrules(mrules, v):
-                if self.alertctrl.contains_excluded_tags(
-                        app.config['KAOS_EXCLUDED_TAGS'], v.tags):
+            if not self.alertctrl.affected_by_mrules(mindex, v):
+                if self.alertctrl.router.excluded(v.tags) & routing.KAOS:
                     continue
                 # Create a copy we can play with
-                al_dict = dict(v.__dict__)
+                al_dict = v.to_dict()
                 al_dict['message'] = self.truncate_string(
                     al_dict['message'])
                 al_dict['time'] = self._fixtimezone(al_dict['time'])
@@ -202,9 +259,9 @@ class KAOS():
     def _send_report(kaos_report):
         LOGGER.info("Sending KAOS report")
         try:
-            requests.post(app.config['KAOS_URL'],
-                          verify=app.config['KAOS_CERT'],
-                          json=kaos_report, timeout=5)
+            httppool.session('kaos').post(app.config['KAOS_URL'],
+                                          verify=app.config['KAOS_CERT'],
+                                          json=kaos_report)
         except requests.exceptions.RequestException:
             LOGGER.exception("Failed posting to KAOS")
 
@@ -221,36 +278,198 @@ class KAOS():
         return s
 
 
+class LogArchiver():
+    """Move alert log records past retention to the log archive"""
+
+    def __init__(self):
+        LOGGER.info("Initiating log archiver")
+        self.db = DBController()
+        self.retention = app.config['LOG_RETENTION_DAYS'] * 86400
+        self.batch_size = app.config['LOG_ARCHIVE_BATCH_SIZE']
+
+    def run(self):
+        LOGGER.info("Archiving old alert log records")
+        # A run that stopped between archiving and deleting a batch
+        self.db.log_archive.recover(self.db.log_records_exist)
+        before = int(time.time()) - self.retention
+        total = 0
+        while True:
+            # Small batches, so the write lock is only held for a moment
+            records = [dict(r) for r in
+                       self.db.get_log_batch(before, self.batch_size)]
+            if not records:
+                break
+            rowids = [r.pop('rowid') for r in records]
+            keys = [(rowid, r['time']) for rowid, r in zip(rowids, records)]
+            self.db.log_archive.move(
+                records, keys, lambda: self.db.delete_log_records(rowids))
+            total += len(records)
+        LOGGER.info("Archived %d alert log records", total)
+
+
+class OutboxDelivery():
+    """Deliver queued notifications from the outbox to the targets
+
+    Failed deliveries are retried with exponential backoff and jitter,
+    until OUTBOX_MAX_ATTEMPTS, then they are marked dead and can be
+    retried from /kap/outbox. Deliveries for the same target and alert
+    are made in the order they were queued. Deliveries to a target with
+    an open circuit are put off until it is half-open, without counting
+    as an attempt.
+    """
+
+    def __init__(self):
+        LOGGER.info("Initiating outbox delivery")
+        self.db = DBController()
+        self.alertctrl = AlertController()
+        self.batch_size = app.config['OUTBOX_BATCH_SIZE']
+        self.max_attempts = app.config['OUTBOX_MAX_ATTEMPTS']
+        self.backoff = app.config['OUTBOX_BACKOFF']
+        self.max_backoff = app.config['OUTBOX_MAX_BACKOFF']
+        self.retention = app.config['OUTBOX_RETENTION_DAYS'] * 86400
+        self.deadlines = app.config['TARGET_DEADLINES']
+        self._pool = ThreadPoolExecutor(
+            max_workers=app.config['DISPATCH_WORKERS'],
+            thread_name_prefix="outbox")
+        self._purged = 0
+
+    def run(self):
+        deliveries = []
+        for r in self.db.get_due_deliveries(self.batch_size):
+            al = Alert.from_dict(json.loads(r['payload']))
+            self._add_key(r, al)
+            deliveries.append((r, al, self._pool.submit(
+                self.alertctrl.deliver, r['target'], al)))
+        for r, al, future in deliveries:
+            try:
+                result = future.result(timeout=self.deadlines[r['target']])
+            except circuitbreaker.CircuitOpen:
+                self._defer(r)
+                continue
+            except Exception as err:  # pylint: disable=W0703
+                self._failed(r, al, err)
+                continue
+            if al.level != 'CRITICAL':
+                # Only the delivery that creates an incident or issue
+                # passes its key on to the next one
+                result = None
+            self.db.delivery_done(r['id'], result)
+            if result:
+                self.db.update_ticket(al.alhash, r['target'], result)
+        if time.time() - self._purged > 3600:
+            self._purged = time.time()
+            self.db.delete_deliveries(int(time.time()) - self.retention)
+
+    def _add_key(self, r, al):
+        # The alert may have been queued before the delivery that
+        # created its incident or issue was made
+        if r['target'] == 'pagerduty' and al.pd_incident_key is None:
+            al.pd_incident_key = self.db.get_previous_delivery_result(
+                r['target'], r['hash'], r['id'])
+        elif r['target'] == 'jira' and al.jira_issue is None:
+            al.jira_issue = self.db.get_previous_delivery_result(
+                r['target'], r['hash'], r['id'])
+
+    def _defer(self, r):
+        # Not an attempt, try again when the circuit is half-open
+        retry_in = max(1, circuitbreaker.breaker(r['target']).retry_in())
+        self.db.delivery_failed(r['id'], r['attempts'],
+                                int(time.time() + retry_in), "Circuit open")
+
+    def _failed(self, r, al, err):
+        attempts = r['attempts'] + 1
+        if attempts >= self.max_attempts:
+            LOGGER.error("Giving up delivering %s to %s after %d attempts: %s",
+                         al.id, r['target'], attempts, err)
+            self.db.delivery_failed(r['id'], attempts, r['next_attempt'],
+                                    str(err), dead=True)
+            return
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        LOGGER.warning("Delivering %s to %s failed, retry in %d seconds: %s",
+                       al.id, r['target'], delay, err)
+        self.db.delivery_failed(r['id'], attempts, int(time.time() + delay),
+                                str(err))
+
+
 class MaintenanceScheduler():
+    """Activate scheduled maintenance at the start time of each schedule
+
+    Every (schedule, day) pair is kept in a heap ordered on the next time
+    it fires. The heap is rebuilt when schedules are added or deleted.
+    A window that was missed, because we were late or not running, is
+    still activated if it has not ended yet, with its original start.
+    The start of the last window of each day is stored with the day, so
+    a window is never activated twice, even if it was ended early.
+    """
 
     def __init__(self):
         LOGGER.info("Initiating maintenance scheduler")
         self.db = DBController()
+        self._heap = []
+        self._generation = None
 
     def run(self):
-        now = datetime.datetime.today()
-        LOGGER.info("Checking maintenance schedule")
+        now = datetime.datetime.now()
+        generation = self.db.get_schedule_generation()
+        if generation != self._generation:
+            self._generation = generation
+            self._build(now)
+        while self._heap and self._heap[0][0] <= now:
+            fire, _, schedule, day = heapq.heappop(self._heap)
+            if self._activate(now, fire, schedule, day):
+                heapq.heappush(self._heap, (fire + datetime.timedelta(days=7),
+                                            schedule['schedule_id'],
+                                            schedule, day))
+
+    def _build(self, now):
+        LOGGER.info("Loading maintenance schedule")
+        self._heap = []
         for schedule in self.db.get_maintenance_schedule():
-            if (self._check_day(now, schedule['days'])
-                    and self._check_starttime(now, schedule['starttime'])):
-                LOGGER.info("Activating scheduled maintenance")
-                self.db.activate_maintenance(
-                    schedule['key'], schedule['value'],
-                    schedule['duration'], schedule['comment'])
-                self.db.update_day_runcounter(
-                    schedule['schedule_id'], now.weekday())
-                if 0 not in self.db.get_schedule_runcounter(
-                        schedule['schedule_id']) and not schedule['repeat']:
-                    self.db.delete_maintenance_schedule(
-                        schedule['schedule_id'])
+            window = datetime.timedelta(
+                seconds=self.db.duration_seconds(schedule['duration']))
+            for day in schedule['days']:
+                fire = self._last_fire(now, day, schedule['starttime'])
+                if fire + window <= now:
+                    fire += datetime.timedelta(days=7)
+                self._heap.append((fire, schedule['schedule_id'],
+                                   schedule, day))
+        heapq.heapify(self._heap)
 
-    @staticmethod
-    def _check_day(now, days):
-        return bool(now.weekday() in days)
+    def _activate(self, now, fire, schedule, day):
+        '''Returns False if the schedule is deleted'''
+        start = int(time.mktime(fire.timetuple()))
+        if now.timestamp() >= start + self.db.duration_seconds(
+                schedule['duration']):
+            LOGGER.warning("Missed scheduled maintenance on %s %s at %s",
+                           schedule['key'], schedule['value'], fire)
+            return True
+        last_start = self.db.get_day_last_start(schedule['schedule_id'], day)
+        if last_start is not None and last_start >= start:
+            return True
+        if last_start is None and self.db.maintenance_exists(
+                start, schedule['key'], schedule['value']):
+            # Activated before the last start was stored
+            return True
+        LOGGER.info("Activating scheduled maintenance")
+        self.db.activate_maintenance(
+            schedule['key'], schedule['value'],
+            schedule['duration'], schedule['comment'], start=start)
+        self.db.update_day_runcounter(schedule['schedule_id'], day, start)
+        if 0 not in self.db.get_schedule_runcounter(
+                schedule['schedule_id']) and not schedule['repeat']:
+            self.db.delete_maintenance_schedule(schedule['schedule_id'])
+            return False
+        return True
 
     @staticmethod
-    def _check_starttime(now, starttime):
+    def _last_fire(now, day, starttime):
+        '''The latest start of the schedule on weekday day, at or before
+        now'''
         hour, minute = starttime.split(":")
-        if int(hour) == now.hour and int(minute) == now.minute:
-            return True
-        return False
+        date = now.date() + datetime.timedelta(days=day - now.weekday())
+        fire = datetime.datetime.combine(
+            date, datetime.time(int(hour), int(minute)))
+        if fire > now:
+            fire -= datetime.timedelta(days=7)
+        return fire
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: bench_alert.py
+
+Memory, construction time and tag lookups of alerts, built the way
+AlertController.create_alert builds them. Compare with the list of tag
+dicts alerts had before Tags
+
+    python benchmarks/bench_alert.py --mode tags
+    python benchmarks/bench_alert.py --mode dicts
+'''
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.path.pardir))
+
+from app.alert import Alert, Tags  # noqa: E402
+
+
+class DictAlert():
+    # The alert from before Tags, tags as a list of {'key', 'value'} dicts
+    def __init__(self, alertid, duration, message,
+                 level, previouslevel, alerttime, tags):
+        self.id = alertid
+        self.duration = duration
+        self.message = message
+        self.level = level
+        self.previouslevel = previouslevel
+        self.time = alerttime
+        self.tags = tags
+        self.pd_incident_key = None
+        self.jira_issue = None
+        self.grafana_url = None
+        self.state_duration = False
+        self.sent = False
+
+
+def series(i):
+    return [{'tags': {'host': "server%05d" % i,
+                      'Environment': ("prod", "test", "dev")[i % 3],
+                      'cpu': "cpu-total"}}]
+
+
+def build_tags(data):
+    pairs = []
+    for s in data:
+        pairs.extend(s['tags'].items())
+    return Alert("server%05d cpu" % len(pairs), 600, "cpu is high",
+                 'CRITICAL', 'OK', 0, Tags(pairs))
+
+
+def build_dicts(data):
+    tags = []
+    for s in data:
+        tags.extend({'key': k, 'value': v} for k, v in s['tags'].items())
+    return DictAlert("server%05d cpu" % len(tags), 600, "cpu is high",
+                     'CRITICAL', 'OK', 0, tags)
+
+
+def environment_tags(al):
+    return al.tags.get('Environment')
+
+
+def environment_dicts(al):
+    return [t['value'] for t in al.tags if t['key'] == 'Environment'][0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", default="tags", choices=['tags', 'dicts'])
+    parser.add_argument("-c", default=100000, dest="count", type=int)
+    options = parser.parse_args()
+    build = {'tags': build_tags, 'dicts': build_dicts}[options.mode]
+    environment = {'tags': environment_tags,
+                   'dicts': environment_dicts}[options.mode]
+    data = [series(i) for i in range(options.count)]
+
+    start = time.perf_counter()
+    alerts = [build(d) for d in data]
+    built = time.perf_counter() - start
+    del alerts
+
+    tracemalloc.start()
+    alerts = [build(d) for d in data]
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for al in alerts:
+        environment(al)
+    lookup = time.perf_counter() - start
+    print("%s: %d alerts, built in %.2f secs, %.1f MB, Environment of all "
+          "in %.0f ms" % (options.mode, options.count, built,
+                          memory / 2 ** 20, lookup * 1000))
+
+
+if __name__ == '__main__':
+    main()
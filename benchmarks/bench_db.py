@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: bench_db.py
+
+Alerts/sec through AlertController.process on a scratch database, the way
+the http server runs it: a new thread for every alert. Compare
+
+    python benchmarks/bench_db.py --mode thread    one long lived thread
+    python benchmarks/bench_db.py --mode request   thread per alert, the
+                                                   connection is pooled
+    python benchmarks/bench_db.py --mode nopool    thread per alert, a new
+                                                   connection every time
+'''
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.path.pardir))
+
+from app import app, dbcontroller  # noqa: E402
+from app.alertcontroller import AlertController  # noqa: E402
+from app.dbcontroller import DBController  # noqa: E402
+
+
+def create_alert(i, level):
+    host = "bench-%d" % (i % 100)
+    return {'id': "%s cpu" % host,
+            'message': "%s cpu is %s" % (host, level),
+            'level': level,
+            'previousLevel': 'OK' if level == 'CRITICAL' else 'CRITICAL',
+            'time': "2019-01-01T12:00:00Z",
+            'duration': 600 * 10 ** 9,
+            'data': {'series': [{'tags': {'host': host,
+                                          'Environment': 'bench'}}]}}
+
+
+def run(ctrl, alerts, mode):
+    if mode == 'thread':
+        for content in alerts:
+            ctrl.process(content)
+        return
+
+    def request(content):
+        ctrl.process(content)
+        if mode == 'request':
+            # What the teardown_request handler in routes does
+            DBController.release()
+
+    for content in alerts:
+        t = threading.Thread(target=request, args=(content,))
+        t.start()
+        t.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", default="request",
+                        choices=['thread', 'request', 'nopool'])
+    parser.add_argument("-c", default=3000, dest="count", type=int)
+    options = parser.parse_args()
+    app.config['FLAPPING_DETECTION_ENABLED'] = False
+    with tempfile.TemporaryDirectory() as tmp:
+        os.mkdir(os.path.join(tmp, 'db'))
+        dbcontroller.INSTALLDIR = tmp
+        DBController().migrate()
+        ctrl = AlertController()
+        alerts = [create_alert(i, 'CRITICAL' if i % 200 < 100 else 'OK')
+                  for i in range(options.count)]
+        start = time.time()
+        run(ctrl, alerts, options.mode)
+        elapsed = time.time() - start
+    print("%s: %d alerts in %.2f secs, %.0f alerts/sec" % (
+        options.mode, options.count, elapsed, options.count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
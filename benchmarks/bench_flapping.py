@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Module: bench_flapping.py
+
+Time of the flap detection query of get_log_count_interval, which finds
+the previous OK -> alert change with a correlated subquery, against the
+same query with lag(), on a scratch alert log
+
+    python benchmarks/bench_flapping.py -n 1000000 --hours 1
+'''
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.path.pardir))
+
+from app import app, dbcontroller  # noqa: E402
+from app.dbcontroller import DBController  # noqa: E402
+
+LAG = ("select hash, id, environment, count(*) as num, max(diff) as diff "
+       "from (select l.hash, l.id, e.value as environment, "
+       "l.time - lag(l.time) over (partition by l.id "
+       "order by l.time) as diff "
+       "from alert_log l left join tag_values e "
+       "on e.id = l.environment_id where l.time >= :tlimit and "
+       "l.previouslevel = 'OK' and l.level != 'OK') "
+       "group by id;")
+
+CORRELATED = (
+    "select hash, id, environment, count(*) as num, max(diff) as diff "
+    "from (select l.hash, l.id, e.value as environment, "
+    "l.time - (select max(i_l.time) "
+    "from alert_log i_l where i_l.time < l.time and "
+    "i_l.id = l.id and i_l.time >= :tlimit and "
+    "i_l.previouslevel = 'OK' and i_l.level != 'OK') as diff "
+    "from alert_log l left join tag_values e on e.id = l.environment_id "
+    "where l.time >= :tlimit and "
+    "l.previouslevel = 'OK' and l.level != 'OK') "
+    "group by id;")
+
+
+def fill(db, rows, alerts, span):
+    rnd = random.Random(1)
+    now = int(time.time())
+    env_ids = [db._tag_id('tag_values', e) for e in ('prod', 'test', 'dev')]
+    ids = ["cpu server%05d" % i for i in range(alerts)]
+    hashes = [hashlib.sha256(i.encode()).hexdigest() for i in ids]
+    levels = ['OK', 'WARNING', 'CRITICAL']
+    values = []
+    for _ in range(rows):
+        i = rnd.randrange(alerts)
+        values.append((hashes[i], now - rnd.randrange(span), ids[i],
+                       env_ids[i % 3], rnd.choice(levels), rnd.choice(levels)))
+    db.execute_many("INSERT OR IGNORE INTO alert_log (hash, time, id, "
+                    "environment_id, previouslevel, level) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", values)
+
+
+def timed(db, query, tlimit, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        db.select(query, {'tlimit': tlimit}, fetchone=False)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", default=1000000, dest="rows", type=int,
+                        help="alert log rows")
+    parser.add_argument("-a", default=2000, dest="alerts", type=int,
+                        help="distinct alerts")
+    parser.add_argument("--hours", default=24, type=float,
+                        help="hours of log the rows are spread over, the "
+                        "query looks at the last FLAPPING_WINDOW minutes")
+    parser.add_argument("-r", default=3, dest="repeat", type=int)
+    options = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.mkdir(os.path.join(tmp, 'db'))
+        dbcontroller.INSTALLDIR = tmp
+        db = DBController()
+        db.migrate()
+        fill(db, options.rows, options.alerts, int(options.hours * 3600))
+        db.execute_query("ANALYZE")
+        tlimit = int(time.time()) - app.config['FLAPPING_WINDOW'] * 60
+        for name, query in (('lag', LAG), ('correlated', CORRELATED)):
+            print("%s: %d rows, %.3f secs" % (
+                name, options.rows, timed(db, query, tlimit,
+                                          options.repeat)))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,12 +16,84 @@ class Config():
     SERVER_PORT = 9095
     SECRET_KEY = "Something-really-clever"
 
+    # With the ingest queue enabled /kap/alert only validates the incoming
+    # alert and puts it on an in-process queue, answering 202 right away.
+    # A pool of worker threads then does the actual processing.
+    # If the queue is full the alert is rejected with 503
+    INGEST_QUEUE_ENABLED = False
+    INGEST_QUEUE_SIZE = 10000
+    INGEST_WORKERS = 4
+
+    # Receive alerts from the kapacitor tcp handler, one JSON alert per line.
+    # Listens on a unix socket instead of tcp if SOCKET_LISTENER_PATH is set
+    SOCKET_LISTENER_ENABLED = False
+    SOCKET_LISTENER_ADDRESS = "0.0.0.0"
+    SOCKET_LISTENER_PORT = 9096
+    SOCKET_LISTENER_PATH = ""
+
+    # SQLite page cache per connection, negative values are in KiB
+    SQLITE_CACHE_SIZE = -16000
+    # Connections kept for reuse by the http request threads
+    SQLITE_POOL_SIZE = 8
+    # Number of tag key and value ids kept in memory
+    TAG_CACHE_SIZE = 100000
+
+    # Outbound HTTP to slack, pagerduty and kaos. Connections are kept
+    # alive and reused. (connect, read) timeouts in seconds and the
+    # max number of pooled connections per host, by target
+    HTTP_TIMEOUTS = {'default': (3.05, 10), 'kaos': (3.05, 5)}
+    HTTP_POOL_SIZES = {'default': 4}
+    # Notifications to slack, pagerduty and jira are sent in parallel by
+    # DISPATCH_WORKERS threads. Processing of an alert waits at most this
+    # many seconds for each target before it carries on without its answer
+    DISPATCH_WORKERS = 8
+    TARGET_DEADLINES = {'slack': 15, 'pagerduty': 15, 'jira': 60}
+    # Notifications per second and burst size per target, as (rate, burst).
+    # A notification waits up to the target's deadline for its turn.
+    # With SLACK_DIGEST_ENABLED, SLACK_RATE_LIMIT is used for slack instead
+    TARGET_RATE_LIMITS = {'slack': (1, 20), 'pagerduty': (10, 50),
+                          'jira': (5, 20)}
+
+    # A target's circuit opens when CIRCUIT_BREAKER_ERROR_RATE of its last
+    # CIRCUIT_BREAKER_WINDOW notifications, and at least
+    # CIRCUIT_BREAKER_MIN_CALLS of them, failed or took longer than
+    # CIRCUIT_BREAKER_SLOW_CALL seconds. Notifications to it are then
+    # skipped, or put off with the outbox, for CIRCUIT_BREAKER_OPEN_TIME
+    # seconds before one is let through to test it again
+    CIRCUIT_BREAKER_WINDOW = 20
+    CIRCUIT_BREAKER_MIN_CALLS = 5
+    CIRCUIT_BREAKER_ERROR_RATE = 0.5
+    CIRCUIT_BREAKER_SLOW_CALL = 10
+    CIRCUIT_BREAKER_OPEN_TIME = 30
+
+    # With the outbox enabled notifications are stored in the database and
+    # delivered by a background job, which retries failed deliveries with
+    # exponential backoff starting at OUTBOX_BACKOFF seconds. After
+    # OUTBOX_MAX_ATTEMPTS a delivery is given up, see /kap/outbox
+    OUTBOX_ENABLED = False
+    OUTBOX_BATCH_SIZE = 100
+    OUTBOX_MAX_ATTEMPTS = 10
+    OUTBOX_BACKOFF = 30
+    OUTBOX_MAX_BACKOFF = 3600
+    # Delivered notifications are kept this long
+    OUTBOX_RETENTION_DAYS = 7
+
+    # Alert log records older than LOG_RETENTION_DAYS are moved to
+    # compressed archive files, one per day, in LOG_ARCHIVE_DIR.
+    # 0 keeps everything in the database
+    LOG_RETENTION_DAYS = 0
+    LOG_ARCHIVE_DIR = "db/archive"
+    LOG_ARCHIVE_BATCH_SIZE = 5000
+
     # This is used to gather instance info, suppress alerts from
     # terminated auto-scaling instances, and remove stale alerts from
     # all types of terminated instances - AWS API Gateway prices apply
     # https://aws.amazon.com/api-gateway/pricing/
     AWS_API_ENABLED = False
     AWS_REGION = "eu-west-1"
+    # Stale alerts are removed every minute, and their JIRA tickets and
+    # Pagerduty incidents resolved by this many threads
+    STALE_CLEANUP_WORKERS = 4
 
     # Maintenance tags (value, displayed text)
     MAINTENANCE_TAGS = [('Environment', 'Environment'),
@@ -70,9 +142,26 @@ class Config():
     # Send summary message with stats for the last hour for all environments
     # This will include environments event if they are among the excluded tags
     SLACK_SUMMARY = True
+    # Collect alerts for SLACK_DIGEST_WINDOW seconds and post them as one
+    # message, grouped by environment and level, with at most
+    # SLACK_DIGEST_MAX_LINES alert messages per group
+    SLACK_DIGEST_ENABLED = False
+    SLACK_DIGEST_WINDOW = 10
+    SLACK_DIGEST_MAX_LINES = 10
+    # Post CRITICAL alerts right away instead of in the digest, as long as
+    # the rate limit allows it
+    SLACK_DIGEST_CRITICAL_BYPASS = True
+    # Digest mode messages per second, and the burst allowed above that
+    SLACK_RATE_LIMIT = 1
+    SLACK_RATE_BURST = 5
 
     # Pagerduty
     PAGERDUTY_ENABLED = False
+    # 1 for the legacy generic events API at PAGERDUTY_URL, 2 for the
+    # events API v2 at PAGERDUTY_V2_URL. With version 2 the service key is
+    # the integration (routing) key, and the alert hash is the dedup key
+    PAGERDUTY_API_VERSION = 1
+    PAGERDUTY_V2_URL = "https://events.pagerduty.com/v2/enqueue"
     PAGERDUTY_URL = "https://events.pagerduty.com/generic/2010-04-15/create_event.json"  # noqa
     PAGERDUTY_SERVICE_KEY = ""
     # List of tagkey tagkey/value dictionaries that will not trigger pagerduty
@@ -88,6 +177,9 @@ class Config():
     JIRA_PASSWORD = ""
     JIRA_PROJECT_KEY = ""
     JIRA_ASSIGNEE = ""
+    # Seconds the available transitions of an issue type and status are
+    # cached
+    JIRA_TRANSITION_CACHE_TTL = 3600
     # List of tagkey tagvalue dictionaries that will not trigger an alert
     JIRA_EXCLUDED_TAGS = [{'key': 'Environment', 'value': 'test'},
                           {'key': 'Environment', 'value': 'staging'}]
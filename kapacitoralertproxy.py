@@ -6,18 +6,35 @@ Module: kapacitoralertproxy.py
 Created: 27.Mar.2018
 Created by: Morten Hersson, <mhersson@gmail.com>
 '''
+import argparse
 from app import app
+from app.routes import alertqueue, ingest
 from app.dbcontroller import DBController
 from app.tasks import MaintenanceScheduler, KAOS, FlapDetective
-from app.tasks import AWSInfoCollector, SlackAlertSummary
+from app.tasks import AWSInfoCollector, SlackAlertSummary, LogArchiver
+from app.tasks import OutboxDelivery, StaleAlertCleaner
+from app.socketlistener import SocketListener
+from app.targets.slack import stop_digests
 from apscheduler.schedulers.background import BackgroundScheduler
 
 
 if __name__ == '__main__':
-    DBController().create_tables()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backfill-rollups", action="store_true",
+                        help="rebuild the hourly statistics from the "
+                        "alert log and exit")
+    options = parser.parse_args()
+    db = DBController()
+    db.migrate()
+    if options.backfill_rollups:
+        print("Backfilled %d hourly rollups" % db.backfill_rollups())
+        raise SystemExit
+    db.load_active_alerts()
+    db.schedule_maintenance_expiry()
     scheduler = BackgroundScheduler()
     ms = MaintenanceScheduler()
-    scheduler.add_job(ms.run, 'interval', seconds=60)
+    # Cheap when nothing is due, see MaintenanceScheduler
+    scheduler.add_job(ms.run, 'interval', seconds=5)
     if app.config['FLAPPING_DETECTION_ENABLED']:
         fp = FlapDetective()
         scheduler.add_job(fp.run, 'interval', seconds=60)
@@ -28,10 +45,31 @@ if __name__ == '__main__':
         awscollector = AWSInfoCollector()
         awscollector.run()  # Run on startup to get updated info
         scheduler.add_job(awscollector.run, 'interval', seconds=60)
+        stalecleaner = StaleAlertCleaner()
+        scheduler.add_job(stalecleaner.run, 'interval', seconds=60)
     if app.config['SLACK_ENABLED'] and app.config['SLACK_SUMMARY']:
         slacksummary = SlackAlertSummary()
         scheduler.add_job(slacksummary.run, 'interval', seconds=60)
+    if app.config['OUTBOX_ENABLED']:
+        outbox = OutboxDelivery()
+        scheduler.add_job(outbox.run, 'interval', seconds=1)
+    if app.config['LOG_RETENTION_DAYS']:
+        archiver = LogArchiver()
+        scheduler.add_job(archiver.run, 'interval', hours=1)
     scheduler.start()
+    if app.config['INGEST_QUEUE_ENABLED']:
+        alertqueue.start()
+    listener = None
+    if app.config['SOCKET_LISTENER_ENABLED']:
+        listener = SocketListener(ingest)
+        listener.start()
     app.run(host=app.config['SERVER_ADDRESS'], port=app.config['SERVER_PORT'],
             debug=False, threaded=True)
+    if listener:
+        listener.stop()
+    if alertqueue.running:
+        alertqueue.stop()
     scheduler.shutdown()
+    # Nothing adds to the digests any more, post what they hold
+    stop_digests()
+    db.stop_maintenance_expiry()
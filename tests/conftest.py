@@ -0,0 +1,49 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Shared fixtures: a fresh database in a temporary directory for every test,
+and kapacitor alerts to feed the controllers with
+'''
+import queue
+import threading
+
+import pytest
+
+from app import dbcontroller, routes
+from app.alertstore import ActiveAlertStore
+from app.dbcontroller import DBController
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    '''A migrated, empty database, with the module level connection and
+    caches of dbcontroller reset'''
+    (tmp_path / 'db').mkdir()
+    monkeypatch.setattr(dbcontroller, 'INSTALLDIR', str(tmp_path))
+    monkeypatch.setattr(dbcontroller, '_local', threading.local())
+    monkeypatch.setattr(dbcontroller, '_pool', queue.LifoQueue(maxsize=8))
+    monkeypatch.setattr(dbcontroller, '_store', ActiveAlertStore())
+    monkeypatch.setattr(dbcontroller, '_tag_ids', dbcontroller._LRUCache(
+        dbcontroller.app.config['TAG_CACHE_SIZE']))
+    monkeypatch.setattr(dbcontroller, '_maintenance',
+                        {'index': None, 'expires': 0, 'generation': 0})
+    controller = DBController()
+    # Controllers created when the app was imported
+    monkeypatch.setattr(routes.db, 'db', controller.db)
+    monkeypatch.setattr(routes.alertcontroller._db, 'db', controller.db)
+    controller.migrate()
+    yield controller
+    con = getattr(dbcontroller._local, 'con', None)
+    if con is not None:
+        con.close()
+
+
+def kapacitor_alert(alertid, level, previous, tags=None,
+                    time="2019-01-01T12:00:00Z", duration=600):
+    '''An alert as posted by the kapacitor http and tcp handlers'''
+    return {'id': alertid,
+            'message': "%s is %s" % (alertid, level),
+            'level': level,
+            'previousLevel': previous,
+            'time': time,
+            'duration': duration * 10 ** 9,
+            'data': {'series': [{'tags': tags or {'host': 'server01'}}]}}
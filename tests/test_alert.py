@@ -0,0 +1,43 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Alert tags
+'''
+from app.alert import Alert, Tags
+
+
+def test_tags_keep_the_first_value_of_a_key():
+    tags = Tags([('host', 'a'), ('Environment', 'prod'), ('host', 'b'),
+                 ('host', 'a')])
+    assert tags.get('host') == 'a'
+    assert tags.getall('host') == ['a', 'b']
+    assert [(t.key, t.value) for t in tags] == [
+        ('host', 'a'), ('Environment', 'prod'), ('host', 'b')]
+    assert len(tags) == 3
+    assert 'Environment' in tags and 'cpu' not in tags
+
+
+def test_tags_are_equal_whatever_the_order():
+    a = Tags([('host', 'a'), ('Environment', 'prod')])
+    b = Tags.from_dicts([{'key': 'Environment', 'value': 'prod'},
+                         {'key': 'host', 'value': 'a'}])
+    assert a == b and hash(a) == hash(b)
+    assert a != Tags([('host', 'a')])
+    dup = Tags([('host', 'a'), ('host', 'b')])
+    assert dup == Tags(iter([('host', 'b'), ('host', 'a')]))
+    assert hash(dup) == hash(Tags([('host', 'b'), ('host', 'a')]))
+    assert dup != Tags([('host', 'a')])
+
+
+def test_with_tag_replaces_every_value_of_the_key():
+    tags = Tags([('host', 'a'), ('host', 'b'), ('Environment', 'prod')])
+    new = tags.with_tag('host', 'c')
+    assert new.as_dicts() == [{'key': 'Environment', 'value': 'prod'},
+                              {'key': 'host', 'value': 'c'}]
+    assert tags.getall('host') == ['a', 'b']
+
+
+def test_alert_accepts_tag_dicts():
+    al = Alert("cpu", 600, "", 'CRITICAL', 'OK', 0,
+               [{'key': 'host', 'value': 'a'}])
+    assert al.tags == Tags([('host', 'a')])
+    assert Alert.from_dict(al.to_dict()).tags == al.tags
@@ -0,0 +1,121 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Batches are parsed as they are read, written in one transaction, and
+notified after it is committed
+'''
+import json
+import sqlite3
+import threading
+
+from app import app
+from app.alertcontroller import AlertController
+from conftest import kapacitor_alert
+
+
+def test_targets_are_notified_after_commit(db, monkeypatch):
+    ctrl = AlertController()
+    writable = []
+
+    def notify_targets(al, targets):
+        # Another connection, as another request thread would have
+        def write():
+            con = sqlite3.connect(db.db, timeout=0.1)
+            try:
+                con.execute("INSERT INTO flapping_alerts (hash) VALUES (?)",
+                            ("x" + al.alhash,))
+                con.commit()
+                writable.append(True)
+            except sqlite3.OperationalError:
+                writable.append(False)
+            finally:
+                con.close()
+        t = threading.Thread(target=write)
+        t.start()
+        t.join()
+        al.pd_incident_key = "incident-" + al.id
+
+    monkeypatch.setattr(ctrl, 'notify_targets', notify_targets)
+    monkeypatch.setattr(ctrl.router, 'targets', lambda al: 2)
+    results = ctrl.process_batch([
+        kapacitor_alert("cpu server01", 'CRITICAL', 'OK'),
+        kapacitor_alert("cpu server02", 'CRITICAL', 'OK')])
+    assert all(r['Success'] for r in results)
+    assert writable == [True, True]
+    assert {a.id: a.pd_incident_key for a in db.get_active_alerts()} == {
+        "cpu server01": "incident-cpu server01",
+        "cpu server02": "incident-cpu server02"}
+
+
+def test_ticket_of_earlier_alert_in_batch_is_resolved(db, monkeypatch):
+    ctrl = AlertController()
+    sent = []
+
+    def notify_targets(al, targets):
+        sent.append((al.level, al.pd_incident_key))
+        if al.level == 'CRITICAL':
+            al.pd_incident_key = "incident-1"
+
+    monkeypatch.setattr(ctrl, 'notify_targets', notify_targets)
+    monkeypatch.setattr(ctrl.router, 'targets', lambda al: 2)
+    ctrl.process_batch([
+        kapacitor_alert("cpu server01", 'CRITICAL', 'OK'),
+        kapacitor_alert("cpu server01", 'OK', 'CRITICAL')])
+    assert sent == [('CRITICAL', None), ('OK', "incident-1")]
+    assert db.get_active_alerts() == []
+
+
+def chunked(data, size):
+    data = data.encode()
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_json_array_is_parsed_across_chunks():
+    alerts = [kapacitor_alert("cpu sérver%02d" % i, 'CRITICAL', 'OK')
+              for i in range(5)] + [12345]
+    body = " [\n" + ",\n".join(json.dumps(a, ensure_ascii=False)
+                                for a in alerts) + "\n]\n"
+    for size in (1, 7, 64, len(body)):
+        assert list(AlertController.parse_batch(
+            chunked(body, size))) == alerts
+
+
+def test_json_array_elements_are_yielded_as_they_are_read():
+    read = []
+
+    def chunks():
+        yield '[' + json.dumps(kapacitor_alert("cpu", 'CRITICAL', 'OK'))
+        read.append(1)
+        yield ', {"id": '
+        read.append(2)
+        yield '"disk"}]'
+        read.append(3)
+
+    parsed = AlertController.parse_batch(chunks())
+    assert next(parsed)['id'] == "cpu"
+    assert read == []
+    assert next(parsed) == {'id': "disk"}
+    assert read == [1, 2]
+
+
+def test_invalid_json_array_element_ends_the_batch():
+    assert list(AlertController.parse_batch(
+        ['[{"id": "cpu"}, {"id": ', '"disk"'])) == [{'id': "cpu"}, None]
+
+
+def test_ndjson_is_parsed_across_chunks():
+    body = '{"id": "cpu"}\n\nnot json\n{"id": "disk"}'
+    for size in (1, 5, len(body)):
+        assert list(AlertController.parse_batch(chunked(body, size))) == [
+            {'id': "cpu"}, None, {'id': "disk"}]
+
+
+def test_batch_route_reads_a_json_array(db, monkeypatch):
+    from app import routes
+    monkeypatch.setattr(routes.alertcontroller, 'notify_targets',
+                        lambda al, targets: None)
+    alerts = [kapacitor_alert("cpu server%02d" % i, 'CRITICAL', 'OK')
+              for i in range(3)]
+    res = app.test_client().post("/kap/alerts/batch",
+                                 data=json.dumps(alerts))
+    assert res.get_json()['Success']
+    assert len(db.get_active_alerts()) == 3
@@ -0,0 +1,104 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+The circuit breaker state machine, on a fake clock
+'''
+import pytest
+
+from app import circuitbreaker
+from app.circuitbreaker import CircuitBreaker, CircuitOpen
+
+
+class FakeTime():
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(circuitbreaker, 'time', fake)
+    return fake
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker("target", window=10, min_calls=4, error_rate=0.5,
+                          slow_call=5, open_time=30)
+
+
+def ok():
+    return "ok"
+
+
+def fail():
+    raise ValueError("target failed")
+
+
+def calls(breaker, *funcs):
+    for func in funcs:
+        try:
+            breaker.call(func)
+        except ValueError:
+            pass
+
+
+def test_opens_when_enough_calls_fail(breaker):
+    calls(breaker, ok, fail, fail)
+    # Not before min_calls were made
+    assert breaker.state == circuitbreaker.CLOSED
+    calls(breaker, ok)
+    assert breaker.state == circuitbreaker.OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.call(pytest.fail)
+    assert breaker.status()['rejected'] == 1
+    assert breaker.retry_in() == 30
+
+
+def test_stays_closed_below_the_error_rate(breaker):
+    calls(breaker, ok, ok, ok, fail, ok, ok, ok, fail)
+    assert breaker.state == circuitbreaker.CLOSED
+
+
+def test_slow_calls_count_as_failed(breaker, clock):
+    def slow():
+        clock.now += 5
+        return "late"
+
+    assert breaker.call(slow) == "late"
+    assert breaker.call(slow) == "late"
+    calls(breaker, ok, ok)
+    assert breaker.state == circuitbreaker.OPEN
+
+
+def test_half_open_after_open_time_lets_one_call_through(breaker, clock):
+    calls(breaker, fail, fail, fail, fail)
+    clock.now += 29
+    assert breaker.state == circuitbreaker.OPEN
+    assert breaker.retry_in() == 1
+    clock.now += 1
+    assert breaker.state == circuitbreaker.HALF_OPEN
+    assert breaker.allow()
+    # The probe has not returned yet
+    assert not breaker.allow()
+    breaker.record(0.1, True)
+    assert breaker.state == circuitbreaker.CLOSED
+    assert breaker.call(ok) == "ok"
+
+
+def test_failed_probe_opens_again(breaker, clock):
+    calls(breaker, fail, fail, fail, fail)
+    clock.now += 30
+    calls(breaker, fail)
+    assert breaker.state == circuitbreaker.OPEN
+    assert breaker.retry_in() == 30
+    with pytest.raises(CircuitOpen):
+        breaker.call(ok)
+    clock.now += 30
+    assert breaker.call(ok) == "ok"
+    assert breaker.state == circuitbreaker.CLOSED
+    # The calls from before it opened are forgotten
+    calls(breaker, fail, ok, ok)
+    assert breaker.state == circuitbreaker.CLOSED
@@ -0,0 +1,131 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+DBController connections, queries and caches
+'''
+import time
+import threading
+
+import pytest
+
+from app import app, dbcontroller
+from app.alert import Alert
+from conftest import kapacitor_alert
+
+
+def test_request_threads_reuse_pooled_connection(db):
+    client = app.test_client()
+    connections = []
+
+    def post():
+        client.post("/kap/alert", json=kapacitor_alert(
+            "cpu server01", 'CRITICAL', 'OK'))
+        connections.append(dbcontroller._pool.queue[-1])
+
+    for _ in range(3):
+        # Every request runs in a new thread, as with threaded=True
+        t = threading.Thread(target=post)
+        t.start()
+        t.join()
+    assert len(set(map(id, connections))) == 1
+    assert dbcontroller._pool.qsize() == 1
+    assert [a.id for a in db.get_active_alerts()] == ["cpu server01"]
+
+
+def test_backfill_keeps_rollups_of_archived_records(db):
+    hour = 1546344000
+    times = [hour + 100, hour + 3600 + 1800,
+             hour + 3600 + 2000, hour + 7200 + 10]
+    db.execute_many("INSERT INTO alert_log (hash, time, id, previouslevel, "
+                    "level, duration) VALUES ('h', ?, 'cpu', 'OK', "
+                    "'CRITICAL', 60)", [(t,) for t in times])
+    assert db.backfill_rollups() == 3
+    # Archive up to the middle of the second hour
+    db.execute_query("DELETE FROM alert_log WHERE time < ?",
+                     (hour + 3600 + 1900,))
+    db.execute_query("UPDATE alert_log_hourly SET count = 0 WHERE bucket = ?",
+                     (hour + 7200,))
+    assert db.backfill_rollups() == 1
+    assert db.select("SELECT bucket, count FROM alert_log_hourly "
+                     "ORDER BY bucket", fetchone=False) == [
+        (hour, 1), (hour + 3600, 2), (hour + 7200, 1)]
+
+
+def test_tag_ids_are_cached_after_commit(db):
+    with db.transaction():
+        prod = db._tag_id('tag_values', 'prod')
+        assert dbcontroller._tag_ids.get(('tag_values', 'prod')) is None
+        with pytest.raises(ValueError):
+            with db.savepoint():
+                db._tag_id('tag_values', 'test')
+                raise ValueError
+    assert dbcontroller._tag_ids.get(('tag_values', 'prod')) == prod
+    assert dbcontroller._tag_ids.get(('tag_values', 'test')) is None
+
+
+def test_tag_ids_are_not_cached_after_rollback(db):
+    with pytest.raises(ValueError):
+        with db.transaction():
+            db._tag_id('tag_values', 'prod')
+            raise ValueError
+    assert dbcontroller._tag_ids.get(('tag_values', 'prod')) is None
+    assert db.select("SELECT id FROM tag_values WHERE value = 'prod'") is None
+
+
+def test_store_lock_is_not_held_while_waiting_for_the_database(db):
+    al = Alert("cpu server01", 600, "cpu is high", 'CRITICAL', 'OK', 0, [])
+    db.activate_alert(al)
+    store = db._active()
+    done = threading.Event()
+
+    def update_ticket():
+        db.update_ticket(al.alhash, 'pagerduty', "incident-1")
+        done.set()
+
+    with db.transaction():
+        # Holds the write lock, as a batch does
+        db.update_alert(al)
+        t = threading.Thread(target=update_ticket)
+        t.start()
+        time.sleep(0.2)
+        assert store.lock.acquire(timeout=1)
+        store.lock.release()
+    t.join()
+    assert done.is_set()
+    assert store.get(al.alhash)['pagerduty'] == "incident-1"
+
+
+def test_rollback_restores_active_alert_store(db):
+    updated = Alert("cpu server01", 600, "cpu is high", 'CRITICAL', 'OK', 0,
+                    [])
+    removed = Alert("cpu server02", 600, "cpu is high", 'CRITICAL', 'OK', 0,
+                    [{'key': 'host', 'value': 'server02'}])
+    db.activate_alert(updated)
+    db.activate_alert(removed)
+    with pytest.raises(ValueError):
+        with db.transaction():
+            db.activate_alert(Alert("cpu server03", 600, "cpu is high",
+                                    'CRITICAL', 'OK', 0, []))
+            updated.level = 'WARNING'
+            db.update_alert(updated)
+            db.deactivate_alert(removed)
+            raise ValueError
+    store = db._active()
+    assert sorted(a['id'] for a in store.all()) == [
+        "cpu server01", "cpu server02"]
+    assert store.get(updated.alhash)['level'] == 'CRITICAL'
+    assert list(store.get(removed.alhash)['tags']) == [('host', 'server02')]
+
+
+def test_savepoint_rollback_restores_only_its_alerts(db):
+    kept = Alert("cpu server01", 600, "cpu is high", 'CRITICAL', 'OK', 0, [])
+    undone = Alert("cpu server02", 600, "cpu is high", 'CRITICAL', 'OK', 0,
+                   [])
+    with db.transaction():
+        db.activate_alert(kept)
+        with pytest.raises(ValueError):
+            with db.savepoint():
+                db.activate_alert(undone)
+                raise ValueError
+    assert [a['id'] for a in db._active().all()] == ["cpu server01"]
+    assert db.select("SELECT id FROM active_alerts", fetchone=False) == [
+        ("cpu server01",)]
@@ -0,0 +1,109 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Notifications sent straight to the targets, without the outbox
+'''
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, routing, ratelimit, alertcontroller
+from app.alert import Alert
+from app.alertcontroller import AlertController
+from app.targets.pagerduty import PagerdutyV2
+from app.targets.slack import SlackDigest
+from conftest import kapacitor_alert
+
+
+def test_late_issue_is_stored(db, monkeypatch):
+    monkeypatch.setitem(app.config['TARGET_DEADLINES'], 'jira', 0.1)
+    ctrl = AlertController()
+    sent = threading.Event()
+
+    def send(target, al):
+        time.sleep(0.3)
+        sent.set()
+        return "KAP-1"
+
+    monkeypatch.setattr(ctrl, '_send', send)
+    monkeypatch.setattr(ctrl.router, 'targets', lambda al: routing.JIRA)
+    ctrl.process(kapacitor_alert("cpu server01", 'CRITICAL', 'OK'))
+    assert db.get_active_alerts()[0].jira_issue is None
+    assert sent.wait(5)
+    for _ in range(50):
+        if db.get_active_alerts()[0].jira_issue:
+            break
+        time.sleep(0.1)
+    assert db.get_active_alerts()[0].jira_issue == "KAP-1"
+
+
+def test_digest_alerts_are_not_rate_limited(monkeypatch):
+    monkeypatch.setattr(ratelimit, '_buckets', {})
+    monkeypatch.setitem(app.config['TARGET_DEADLINES'], 'slack', 0.1)
+    ctrl = AlertController()
+    ctrl.slack = SlackDigest("http://localhost/hook", "#alerts", "kapacitor",
+                             window=3600, max_lines=10, rate=1, burst=5,
+                             critical_bypass=False)
+    monkeypatch.setattr(ctrl.slack, '_post', lambda js, timeout=0: True)
+    burst = app.config['TARGET_RATE_LIMITS']['slack'][1]
+    for i in range(burst * 2):
+        ctrl.deliver('slack', Alert("cpu server%02d" % i, 0, "cpu is high",
+                                    'WARNING', 'OK', 0, []))
+    assert sum(e['count'] for e in ctrl.slack._digest.values()) == burst * 2
+    ctrl.slack.stop()
+
+
+def test_pagerduty_v2_sends_of_an_alert_keep_their_order(monkeypatch):
+    ctrl = AlertController()
+    ctrl.pagerduty = PagerdutyV2("http://localhost/enqueue", "key")
+    sent = []
+    done = threading.Event()
+
+    def send(target, al):
+        if al.level == 'CRITICAL':
+            # The trigger is slow, the resolve must still come after it
+            time.sleep(0.3)
+        sent.append((al.id, al.level))
+        if len(sent) == 4:
+            done.set()
+        return al.alhash
+
+    monkeypatch.setattr(ctrl, '_send', send)
+    for level, previous in [('CRITICAL', 'OK'), ('OK', 'CRITICAL')]:
+        for alertid in ("cpu server01", "cpu server02"):
+            ctrl.notify_targets(Alert(alertid, 600, "cpu", level, previous,
+                                      0, []), routing.PAGERDUTY)
+    assert done.wait(5)
+    for alertid in ("cpu server01", "cpu server02"):
+        assert [lvl for i, lvl in sent if i == alertid] == ['CRITICAL', 'OK']
+
+
+def test_queued_pagerduty_v2_sends_do_not_hold_workers(monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(alertcontroller, '_dispatch_pool', pool)
+    ctrl = AlertController()
+    ctrl.pagerduty = PagerdutyV2("http://localhost/enqueue", "key")
+    slow = threading.Event()
+    sent = []
+
+    def send(target, al):
+        if target == 'pagerduty' and not sent:
+            # Pagerduty hangs on the first event
+            slow.wait(5)
+        sent.append((target, al.level))
+        return al.alhash
+
+    monkeypatch.setattr(ctrl, '_send', send)
+    for level, previous in [('CRITICAL', 'OK'), ('OK', 'CRITICAL')] * 3:
+        ctrl.notify_targets(Alert("cpu server01", 600, "cpu", level,
+                                  previous, 0, []), routing.PAGERDUTY)
+    # One worker is taken by the hanging event, the other is free
+    assert pool.submit(send, 'slack', Alert(
+        "cpu server02", 600, "cpu", 'CRITICAL', 'OK', 0, [])).result(1)
+    slow.set()
+    for _ in range(100):
+        if len(sent) == 7:
+            break
+        time.sleep(0.02)
+    pool.shutdown()
+    assert [lvl for t, lvl in sent if t == 'pagerduty'] == \
+        ['CRITICAL', 'OK'] * 3
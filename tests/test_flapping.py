@@ -0,0 +1,58 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+The flap detection query against a plain Python count of the alert log
+'''
+import random
+import time
+import hashlib
+
+import pytest
+
+
+def fill_log(db, seed, rows=2000, ids=40):
+    rnd = random.Random(seed)
+    now = int(time.time())
+    levels = ['OK', 'WARNING', 'CRITICAL']
+    envs = {db._tag_id('tag_values', e): e for e in ('prod', 'test')}
+    values = {}
+    for _ in range(rows):
+        alertid = "cpu server%02d" % rnd.randrange(ids)
+        alhash = hashlib.sha256(alertid.encode()).hexdigest()
+        # Each alert has one environment, or none
+        env = (list(envs) + [None])[int(alhash, 16) % 3]
+        # The log has one row per alert and second
+        values[(alhash, now - rnd.randrange(2 * 3600))] = (
+            alertid, env, rnd.choice(levels), rnd.choice(levels))
+    db.execute_many("INSERT INTO alert_log (hash, time, id, environment_id, "
+                    "previouslevel, level) VALUES (?, ?, ?, ?, ?, ?)",
+                    [k + v for k, v in values.items()])
+    return [(alhash, t, alertid, envs.get(env), previous, level)
+            for (alhash, t), (alertid, env, previous, level)
+            in values.items()]
+
+
+def expected(rows, tlimit):
+    changes = {}
+    for alhash, t, alertid, env, previous, level in rows:
+        if t >= tlimit and previous == 'OK' and level != 'OK':
+            changes.setdefault(alertid, []).append((t, alhash, env))
+    result = []
+    for alertid, found in changes.items():
+        found.sort()
+        diffs = [b[0] - a[0] for a, b in zip(found, found[1:])]
+        result.append((found[0][1], alertid, found[0][2], len(found),
+                       max(diffs) if diffs else None))
+    return sorted(result)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('window', [10, 60])
+def test_flapping_counts(db, monkeypatch, seed, window):
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now)
+    rows = fill_log(db, seed)
+    db.flapping_window = window
+    found = sorted(db.get_log_count_interval())
+    tlimit = int(now) - window * 60
+    assert found
+    assert found == expected(rows, tlimit)
@@ -0,0 +1,59 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Outbound requests reuse keep-alive connections
+'''
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from app import httppool
+from app.alert import Alert
+from app.targets.slack import Slack
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        # The client port tells the connections apart
+        self.server.ports.append(self.client_address[1])
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_url(monkeypatch):
+    monkeypatch.setattr(httppool, '_sessions', {})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.ports = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%d/hook" % server.server_port, server.ports
+    server.shutdown()
+    server.server_close()
+
+
+def test_stub_tells_new_connections_apart(stub_url):
+    url, ports = stub_url
+    for _ in range(3):
+        requests.post(url, json={}, timeout=5)
+    assert len(set(ports)) == 3
+
+
+def test_target_reuses_connection(stub_url):
+    url, ports = stub_url
+    slack = Slack(url, "#alerts", "kapacitor")
+    for i in range(20):
+        assert slack.post(Alert("cpu server%02d" % i, 0, "cpu is high",
+                                'CRITICAL', 'OK', 0, []))
+    assert len(ports) == 20
+    assert len(set(ports)) == 1
+    assert httppool.metrics()['slack']['requests'] == 20
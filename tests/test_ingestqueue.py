@@ -0,0 +1,62 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Events for one alert must be processed in the order they arrived, whatever
+lane and worker the other alerts end up in
+'''
+import random
+
+import pytest
+
+from app.alertcontroller import AlertController
+from app.ingestqueue import AlertQueue
+from conftest import kapacitor_alert
+
+LEVELS = ['OK', 'WARNING', 'CRITICAL']
+
+
+def interleaved_streams(seed, alerts=10, events=30):
+    '''Level changes for every alert, shuffled together while keeping
+    the order of each alert's own events. Returns the events and the
+    last level of every alert'''
+    rnd = random.Random(seed)
+    streams = {}
+    for n in range(alerts):
+        alertid = "cpu server%02d" % n
+        previous = 'OK'
+        stream = []
+        for _ in range(events):
+            level = rnd.choice([x for x in LEVELS if x != previous])
+            stream.append(kapacitor_alert(alertid, level, previous))
+            previous = level
+        streams[alertid] = stream
+    merged = []
+    pending = {k: list(v) for k, v in streams.items()}
+    while pending:
+        alertid = rnd.choice(sorted(pending))
+        merged.append(pending[alertid].pop(0))
+        if not pending[alertid]:
+            del pending[alertid]
+    last = {k: v[-1]['level'] for k, v in streams.items()}
+    return merged, last
+
+
+def active_levels(db):
+    rows = db.select("SELECT id, level FROM active_alerts",
+                     fetchone=False) or []
+    return dict(rows)
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+@pytest.mark.parametrize('workers', [1, 4])
+def test_interleaved_streams_end_in_the_same_state(db, seed, workers):
+    events, last = interleaved_streams(seed)
+    expected = {k: v for k, v in last.items() if v != 'OK'}
+    # Room for every event in every lane
+    q = AlertQueue(AlertController().process,
+                   maxsize=len(events) * workers, workers=workers)
+    q.start()
+    for content in events:
+        assert q.put(content)
+    q.stop()
+    assert active_levels(db) == expected
+    assert {a.id: a.level for a in db.get_active_alerts()} == expected
@@ -0,0 +1,89 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+JIRA requests through the shared client, with a fake JIRA
+'''
+from types import SimpleNamespace
+
+import pytest
+from jira.exceptions import JIRAError
+
+from app.targets import jira as jiratarget
+
+
+class FakeJIRA():
+    """Issues have a Resolve Issue transition to Resolved, and once
+    transitioned, a Close Issue transition to Closed"""
+    clients = []
+
+    def __init__(self, options, basic_auth):
+        # Connecting must not block the other JIRA users
+        assert not jiratarget._clients_lock.locked()
+        self.expired = False
+        self.transitioned = []
+        self.listed = 0
+        FakeJIRA.clients.append(self)
+
+    def _check(self):
+        if self.expired:
+            raise JIRAError("Unauthorized", status_code=401)
+
+    def issue(self, key):
+        self._check()
+        return issue(key)
+
+    def transitions(self, issue):
+        self._check()
+        self.listed += 1
+        if issue.key not in dict(self.transitioned):
+            return [{'id': '11', 'name': 'Resolve Issue',
+                     'to': {'name': 'Resolved'}}]
+        return [{'id': '21', 'name': 'Close Issue',
+                 'to': {'name': 'Closed'}}]
+
+    def transition_issue(self, issue, transition):
+        self._check()
+        self.transitioned.append((issue.key, transition))
+
+
+def issue(key):
+    return SimpleNamespace(key=key, fields=SimpleNamespace(
+        project=SimpleNamespace(key='OPS'),
+        issuetype=SimpleNamespace(name='Incident'),
+        status=SimpleNamespace(name='Open'),
+        comment=SimpleNamespace(comments=[])))
+
+
+@pytest.fixture
+def incident(monkeypatch):
+    monkeypatch.setattr(jiratarget, 'JIRA', FakeJIRA)
+    monkeypatch.setattr(jiratarget, '_clients', {})
+    monkeypatch.setattr(jiratarget, '_transitions', {})
+    monkeypatch.setattr(FakeJIRA, 'clients', [])
+    return jiratarget.Incident("http://jira", "user", "secret", "OPS", "ops")
+
+
+def test_issue_is_resolved_and_closed(incident):
+    incident._resolve_and_close("OPS-1")
+    incident._resolve_and_close("OPS-2")
+    client, = FakeJIRA.clients
+    assert client.transitioned == [("OPS-1", '11'), ("OPS-1", '21'),
+                                   ("OPS-2", '11'), ("OPS-2", '21')]
+    # The transitions of each status are only fetched once
+    assert client.listed == 2
+
+
+def test_transition_is_retried_with_new_client_on_401(incident):
+    incident._resolve_and_close("OPS-1")
+    old = FakeJIRA.clients[0]
+    old.expired = True
+    incident._resolve_and_close("OPS-2")
+    assert len(FakeJIRA.clients) == 2
+    assert FakeJIRA.clients[1].transitioned == [("OPS-2", '11'),
+                                                ("OPS-2", '21')]
+
+
+def test_transitions_are_listed_with_new_client_on_401(incident):
+    incident._connect().expired = True
+    assert incident._get_transition(issue("OPS-1"), 'Open',
+                                    'Resolve Issue') == ('11', 'Resolved')
+    assert len(FakeJIRA.clients) == 2
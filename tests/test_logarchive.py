@@ -0,0 +1,86 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Moving old alert log records to the log archive, also when a run was cut
+short between archiving and deleting a batch
+'''
+import os
+import time
+
+import pytest
+
+from app.tasks import LogArchiver
+
+DAY = 86400
+
+
+def fill_log(db, count, age):
+    now = int(time.time())
+    db.execute_many("INSERT INTO alert_log (hash, time, id, previouslevel, "
+                    "level) VALUES (?, ?, ?, 'OK', 'CRITICAL')",
+                    [("h%d" % i, now - age - i, "cpu server%02d" % i)
+                     for i in range(count)])
+
+
+@pytest.fixture
+def archiver(db):
+    archiver = LogArchiver()
+    archiver.retention = 30 * DAY
+    archiver.batch_size = 4
+    return archiver
+
+
+def archived(db):
+    return sorted(r['id'] for r in db.log_archive.read(0))
+
+
+def log_count(db):
+    return db.select("select count(*) from alert_log")[0]
+
+
+def test_old_records_are_moved(db, archiver):
+    fill_log(db, 10, 40 * DAY)
+    db.execute_query("INSERT INTO alert_log (hash, time, id, previouslevel, "
+                     "level) VALUES ('new', ?, 'new', 'OK', 'CRITICAL')",
+                     (int(time.time()),))
+    archiver.run()
+    assert archived(db) == ["cpu server%02d" % i for i in range(10)]
+    assert log_count(db) == 1
+    assert not os.path.exists(db.log_archive._journal)
+
+
+def test_batch_not_deleted_is_archived_once(db, archiver, monkeypatch):
+    fill_log(db, 10, 40 * DAY)
+
+    def crash(rowids):
+        raise SystemExit
+    with monkeypatch.context() as m:
+        m.setattr(archiver.db, 'delete_log_records', crash)
+        with pytest.raises(SystemExit):
+            archiver.run()
+    assert log_count(db) == 10
+    archiver.run()
+    assert archived(db) == ["cpu server%02d" % i for i in range(10)]
+    assert log_count(db) == 0
+
+
+def test_deleted_batch_is_kept(db, archiver, monkeypatch):
+    fill_log(db, 10, 40 * DAY)
+    remove = os.remove
+
+    def crash(path):
+        if path == db.log_archive._journal:
+            raise SystemExit
+        remove(path)
+    with monkeypatch.context() as m:
+        m.setattr(os, 'remove', crash)
+        with pytest.raises(SystemExit):
+            archiver.run()
+    assert log_count(db) == 6
+    archiver.run()
+    assert archived(db) == ["cpu server%02d" % i for i in range(10)]
+    assert log_count(db) == 0
+
+
+def test_retention_is_off_by_default():
+    from app import app
+    assert app.config['LOG_RETENTION_DAYS'] == 0
@@ -0,0 +1,137 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Matching alerts against the compiled maintenance rules, and expiring them
+'''
+import time
+import threading
+
+from app import dbcontroller
+from app.alert import Alert, Tags
+from app.maintenance import ExpiryTimer, MaintenanceIndex
+
+
+def rule(key, value):
+    return {'key': key, 'value': value}
+
+
+def alert(alertid, **tags):
+    return Alert(alertid, 0, "", 'CRITICAL', 'OK', 0, Tags(tags.items()))
+
+
+def test_index_matches_tags_and_id_substrings():
+    rules = [rule('host', 'server01'), rule('host', 'web*'),
+             rule('host', '*02'), rule('id', '*disk*'), rule('id', 'isk u')]
+    index = MaintenanceIndex(rules)
+    found = index.match(alert("disk usage on web02", host='web02'))
+    assert sorted(r['value'] for r in found) == [
+        '*02', '*disk*', 'isk u', 'web*']
+    assert not index.matches(alert("cpu usage", host='server02x'))
+
+
+def test_id_matcher_is_built_before_it_is_shared():
+    rules = [rule('id', "pattern%d" % i) for i in range(200)]
+    index = MaintenanceIndex(rules)
+    fail = list(index._ids._fail)
+    results = []
+
+    def match():
+        results.append(len(index.match(alert("xpattern12pattern150"))))
+
+    threads = [threading.Thread(target=match) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # pattern1, pattern12, pattern15 and pattern150
+    assert results == [4] * 8
+    assert index._ids._fail == fail
+
+
+class Expired():
+    def __init__(self):
+        self.items = []
+        self.times = []
+        self.event = threading.Event()
+
+    def __call__(self, item):
+        self.items.append(item)
+        self.times.append(time.time())
+        self.event.set()
+
+    def wait(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.items) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.items
+
+
+def test_expiry_timer_fires_in_time_order():
+    expired = Expired()
+    timer = ExpiryTimer(expired)
+    now = time.time()
+    for offset in (0.3, 0.1, 0.2, 0.1):
+        timer.add(now + offset, offset)
+    try:
+        assert expired.wait(4) == [0.1, 0.1, 0.2, 0.3]
+        for offset, fired in zip(expired.items, expired.times):
+            assert fired >= now + offset
+        assert not timer
+    finally:
+        timer.stop()
+
+
+def test_earlier_item_wakes_the_timer():
+    expired = Expired()
+    timer = ExpiryTimer(expired)
+    timer.add(time.time() + 60, 'later')
+    # The thread is asleep until 'later' now
+    time.sleep(0.1)
+    timer.add(time.time() + 0.1, 'sooner')
+    try:
+        assert expired.event.wait(2)
+        assert expired.items == ['sooner']
+        assert len(timer) == 1
+    finally:
+        timer.stop()
+
+
+def test_stopped_timer_expires_nothing():
+    expired = Expired()
+    timer = ExpiryTimer(expired)
+    timer.add(time.time() + 0.2, 'rule')
+    timer.stop()
+    time.sleep(0.3)
+    assert not expired.items
+
+
+def test_failed_expiry_does_not_stop_the_timer():
+    expired = Expired()
+
+    def expire(item):
+        if item == 'bad':
+            raise ValueError(item)
+        expired(item)
+    timer = ExpiryTimer(expire)
+    now = time.time()
+    timer.add(now, 'bad')
+    timer.add(now + 0.1, 'good')
+    try:
+        assert expired.wait(1) == ['good']
+    finally:
+        timer.stop()
+
+
+def test_expiry_of_a_replaced_rule_keeps_the_new_one(db, monkeypatch):
+    scheduled = []
+    monkeypatch.setattr(dbcontroller._expiry, 'add',
+                        lambda when, rule: scheduled.append((when, rule)))
+    start = int(time.time())
+    db.activate_maintenance('host', 'server01', '1h', "patching", start)
+    # Cancelled, and put back for longer
+    db.deactive_maintenance(start, start + 3600, 'host', 'server01')
+    db.activate_maintenance('host', 'server01', '2h', "patching", start + 1)
+    assert [when for when, _ in scheduled] == [start + 3601, start + 7202]
+    db.expire_maintenance(scheduled[0][1])
+    assert db.maintenance_exists(start + 1, 'host', 'server01')
+    db.expire_maintenance(scheduled[1][1])
+    assert not db.maintenance_exists(start + 1, 'host', 'server01')
@@ -0,0 +1,127 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Deliveries from the outbox: in order per target and alert, retried with
+backoff, and given up after OUTBOX_MAX_ATTEMPTS
+'''
+import time
+
+import pytest
+
+from app import circuitbreaker
+from app.alert import Alert
+from app.tasks import OutboxDelivery
+
+
+def alert(level, previous, alertid="cpu server01"):
+    return Alert(alertid, 600, "cpu is high", level, previous, 0, [])
+
+
+def outbox(db):
+    return [dict(r) for r in db.select(
+        "select id, status, attempts, next_attempt, last_error, result "
+        "from outbox order by id", fetchone=False, use_column_name=True)]
+
+
+@pytest.fixture
+def delivery(db, monkeypatch):
+    '''OutboxDelivery with deliver() replaced by the sent list. Failures
+    are made by putting exceptions in fail'''
+    od = OutboxDelivery()
+    od.sent = []
+    od.fail = []
+
+    def deliver(target, al):
+        if od.fail:
+            raise od.fail.pop(0)
+        od.sent.append((target, al.level, al.pd_incident_key))
+        return "incident-1" if al.level == 'CRITICAL' else None
+
+    monkeypatch.setattr(od.alertctrl, 'deliver', deliver)
+    yield od
+    od._pool.shutdown()
+
+
+def test_deliveries_of_an_alert_are_made_in_order(db, delivery):
+    db.add_deliveries(alert('CRITICAL', 'OK'), ['pagerduty'])
+    db.add_deliveries(alert('OK', 'CRITICAL'), ['pagerduty'])
+    db.add_deliveries(alert('CRITICAL', 'OK', "cpu server02"), ['pagerduty'])
+    delivery.run()
+    # The resolve waits for the trigger, the other alert does not
+    assert delivery.sent == [('pagerduty', 'CRITICAL', None),
+                             ('pagerduty', 'CRITICAL', None)]
+    delivery.run()
+    # and gets the incident key the trigger returned
+    assert delivery.sent[2:] == [('pagerduty', 'OK', "incident-1")]
+    assert [r['status'] for r in outbox(db)] == ['done'] * 3
+    assert [r['result'] for r in outbox(db)] == ["incident-1", None,
+                                                  "incident-1"]
+
+
+def test_failed_delivery_is_retried_with_backoff(db, delivery):
+    backoff = delivery.backoff
+    db.add_deliveries(alert('CRITICAL', 'OK'), ['pagerduty'])
+    db.add_deliveries(alert('OK', 'CRITICAL'), ['pagerduty'])
+    for attempt in (1, 2):
+        delivery.fail.append(ValueError("Pagerduty is down"))
+        now = time.time()
+        delivery.run()
+        row = outbox(db)[0]
+        assert (row['status'], row['attempts']) == ('pending', attempt)
+        assert row['last_error'] == "Pagerduty is down"
+        delay = backoff * 2 ** (attempt - 1)
+        assert now + delay / 2 - 1 <= row['next_attempt'] <= now + delay + 1
+        # Nothing more is sent for the alert until it is delivered
+        delivery.run()
+        assert delivery.sent == []
+        db.execute_query("update outbox set next_attempt = 0 where id = ?",
+                         (row['id'],))
+    delivery.run()
+    delivery.run()
+    assert [s[1] for s in delivery.sent] == ['CRITICAL', 'OK']
+
+
+def test_open_circuit_is_not_an_attempt(db, delivery):
+    db.add_deliveries(alert('CRITICAL', 'OK'), ['pagerduty'])
+    delivery.fail.append(circuitbreaker.CircuitOpen("open"))
+    delivery.run()
+    row = outbox(db)[0]
+    assert (row['status'], row['attempts']) == ('pending', 0)
+    assert row['next_attempt'] > time.time()
+
+
+def test_delivery_is_dead_after_max_attempts_and_can_be_retried(
+        db, delivery):
+    delivery.max_attempts = 2
+    db.add_deliveries(alert('CRITICAL', 'OK'), ['pagerduty'])
+    db.add_deliveries(alert('OK', 'CRITICAL'), ['pagerduty'])
+    for _ in range(2):
+        delivery.fail.append(ValueError("Pagerduty is down"))
+        db.execute_query("update outbox set next_attempt = 0 "
+                         "where status = 'pending'")
+        delivery.run()
+    dead = db.get_dead_deliveries()
+    assert [(r['status'], r['attempts']) for r in dead] == [('dead', 2)]
+    assert db.get_outbox_status() == {'dead': 1, 'pending': 1}
+    # A dead delivery does not hold up the next one
+    delivery.run()
+    assert delivery.sent == [('pagerduty', 'OK', None)]
+
+    db.retry_delivery(dead[0]['id'])
+    row = outbox(db)[0]
+    assert (row['status'], row['attempts']) == ('pending', 0)
+    delivery.run()
+    assert delivery.sent[1:] == [('pagerduty', 'CRITICAL', None)]
+    assert db.get_outbox_status() == {'done': 2}
+
+
+def test_key_of_a_dead_delivery_is_passed_on(db, delivery):
+    db.add_deliveries(alert('CRITICAL', 'OK'), ['jira'])
+    db.add_deliveries(alert('OK', 'CRITICAL'), ['jira'])
+    first, second = outbox(db)
+    # Created the issue, then died on a later step
+    db.delivery_failed(first['id'], 10, 0, "timeout", dead=True)
+    db.execute_query("update outbox set result = 'KAP-1' where id = ?",
+                     (first['id'],))
+    al = alert('OK', 'CRITICAL')
+    delivery._add_key(dict(second, target='jira', hash=al.alhash), al)
+    assert al.jira_issue == "KAP-1"
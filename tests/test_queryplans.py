@@ -0,0 +1,50 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+The time range queries on the alert log and its rollups, and the due
+deliveries in the outbox, must be answered from an index, not by scanning
+the table. The statements are captured from the DBController methods
+themselves, and checked with EXPLAIN QUERY PLAN.
+'''
+import pytest
+
+QUERIES = {
+    'log_count_interval': lambda db: db.get_log_count_interval(),
+    'statistics': lambda db: db.get_statistics(24),
+    'log_records': lambda db: db.get_log_records(24),
+    'log_records_environment': lambda db: db.get_log_records(24, 'prod'),
+    'log_batch': lambda db: db.get_log_batch(1546344000, 100),
+    'alert_summary': lambda db: db.get_alert_summary(1),
+    'due_deliveries': lambda db: db.get_due_deliveries(100),
+}
+
+
+def captured_selects(db, method):
+    con = db._connect()
+    statements = []
+    con.set_trace_callback(statements.append)
+    try:
+        method(db)
+    finally:
+        con.set_trace_callback(None)
+    return [s for s in statements if s.lstrip().lower().startswith('select')]
+
+
+def table_scans(db, statement):
+    '''Plan steps reading a whole table, or a whole index that was not made
+    for the query: the index of a UNIQUE constraint, or an automatic index
+    built for the query and thrown away. Scanning one of our partial
+    indexes, like alert_log_alerting for the flapping detection, is fine'''
+    plan = db._connect().execute("EXPLAIN QUERY PLAN " + statement)
+    return [row[3] for row in plan
+            if 'AUTOMATIC' in row[3] or
+            (row[3].startswith('SCAN ') and
+             not row[3].startswith('SCAN (subquery') and
+             ('INDEX' not in row[3] or 'sqlite_autoindex' in row[3]))]
+
+
+@pytest.mark.parametrize('name', sorted(QUERIES))
+def test_query_uses_index(db, name):
+    statements = captured_selects(db, QUERIES[name])
+    assert statements
+    for statement in statements:
+        assert table_scans(db, statement) == [], statement
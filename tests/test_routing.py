@@ -0,0 +1,81 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Which targets an alert is sent to, from the excluded tags and ticks
+'''
+from app import routing
+from app.alert import Alert, Tags
+from app.routing import SLACK, PAGERDUTY, JIRA, KAOS, TargetRouter
+
+ALL = SLACK | PAGERDUTY | JIRA | KAOS
+
+
+def config(**settings):
+    conf = {'PAGERDUTY_EXCLUDED_TICKS': []}
+    for name in ('SLACK', 'PAGERDUTY', 'JIRA', 'KAOS'):
+        conf[name + '_ENABLED'] = True
+        conf[name + '_EXCLUDED_TAGS'] = []
+    conf.update(settings)
+    return conf
+
+
+def tag(key, value):
+    return {'key': key, 'value': value}
+
+
+def alert(alertid, **tags):
+    return Alert(alertid, 0, "", 'CRITICAL', 'OK', 0, Tags(tags.items()))
+
+
+def test_enabled_targets():
+    router = TargetRouter(config(JIRA_ENABLED=False, KAOS_ENABLED=False))
+    assert router.targets(alert("cpu server01", host='server01')) == \
+        SLACK | PAGERDUTY
+    assert routing.names(SLACK | PAGERDUTY) == ['slack', 'pagerduty']
+
+
+def test_excluded_tags_per_target():
+    router = TargetRouter(config(
+        SLACK_EXCLUDED_TAGS=[tag('environment', 'test')],
+        PAGERDUTY_EXCLUDED_TAGS=[tag('environment', 'test'),
+                                 tag('host', 'server02')],
+        JIRA_EXCLUDED_TAGS=[tag('host', 'server02')]))
+    assert router.targets(alert("cpu", environment='test',
+                                host='server01')) == JIRA | KAOS
+    assert router.targets(alert("cpu", environment='prod',
+                                host='server02')) == SLACK | KAOS
+    # Both key and value have to match
+    assert router.targets(alert("cpu", environment='server02',
+                                host='test')) == ALL
+
+
+def test_mongroup_values_are_matched_on_their_own():
+    router = TargetRouter(config(
+        SLACK_EXCLUDED_TAGS=[tag('MonGroup', 'batch')],
+        PAGERDUTY_EXCLUDED_TAGS=[tag('MonGroup', 'dev')]))
+    assert router.targets(alert("cpu", MonGroup='web|batch')) == \
+        PAGERDUTY | JIRA | KAOS
+    assert router.targets(alert("cpu", MonGroup='dev|batch')) == JIRA | KAOS
+    assert router.targets(alert("cpu", MonGroup='batches')) == ALL
+
+
+def test_excluded_ticks_only_stop_pagerduty():
+    router = TargetRouter(config(PAGERDUTY_EXCLUDED_TICKS=['disk_tick']))
+    assert router.targets(alert("disk usage server01 disk_tick")) == \
+        SLACK | JIRA | KAOS
+    # Only the last element of the id is the tick
+    assert router.targets(alert("disk_tick usage server01 cpu_tick")) == ALL
+
+
+def test_masks_are_memoized_on_the_tags():
+    router = TargetRouter(config(SLACK_EXCLUDED_TAGS=[tag('host', 'a')]),
+                          memo_size=2)
+    assert router.excluded(Tags([('host', 'a')])) == SLACK
+    assert router.excluded(Tags([('host', 'b')])) == 0
+    assert len(router._memo) == 2
+    # Equal tags of another alert hit the memo
+    router._memo[Tags([('host', 'a')])] = JIRA
+    assert router.excluded(Tags([('host', 'a')])) == JIRA
+    # A full memo starts over
+    assert router.excluded(Tags([('host', 'c')])) == 0
+    assert len(router._memo) == 1
+    assert router.excluded(Tags([('host', 'a')])) == SLACK
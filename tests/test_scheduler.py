@@ -0,0 +1,34 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Scheduled maintenance windows are activated once
+'''
+import time
+import datetime
+
+from app.tasks import MaintenanceScheduler
+
+
+def add_schedule(db, started_ago):
+    fire = datetime.datetime.now().replace(second=0, microsecond=0) - \
+        datetime.timedelta(minutes=started_ago)
+    db.add_maintenance_schedule(fire.strftime("%H:%M"), "8h", 'host',
+                                'server01', "patching", True, [fire.weekday()])
+    return int(time.mktime(fire.timetuple()))
+
+
+def test_window_ended_early_is_not_activated_again(db):
+    start = add_schedule(db, 5)
+    schedule_id = db.get_maintenance_schedule()[0]['schedule_id']
+    MaintenanceScheduler().run()
+    rules = db.get_active_maintenance_rules()
+    assert [r['start'] for r in rules] == [start]
+    assert db.get_schedule_runcounter(schedule_id) == [1]
+
+    rule = rules[0]
+    db.deactive_maintenance(rule['start'], rule['stop'],
+                            rule['key'], rule['value'])
+    # As after a restart, the heap is built again with the window
+    # still open
+    MaintenanceScheduler().run()
+    assert db.get_active_maintenance_rules() == []
+    assert db.get_schedule_runcounter(schedule_id) == [1]
@@ -0,0 +1,63 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Slack digests
+'''
+import time
+
+import pytest
+
+from app import app, ratelimit
+from app.alert import Alert, Tags
+from app.alertcontroller import AlertController
+from app.targets import slack
+
+
+@pytest.fixture
+def digest(monkeypatch):
+    monkeypatch.setattr(slack, '_digests', {})
+    monkeypatch.setattr(ratelimit, '_buckets', {})
+    d = slack.digest("http://localhost/hook", "#alerts", "kapacitor",
+                     window=3600, max_lines=10, rate=1, burst=2,
+                     critical_bypass=False)
+    d.posted = []
+
+    def post(js):
+        d.posted.append(js)
+        return True
+
+    # Only the http post, the rate limit is kept
+    monkeypatch.setattr(slack.Slack, '_post', lambda self, js: post(js))
+    yield d
+    d.stop()
+
+
+def alert(i):
+    return Alert("cpu server%02d" % i, 0, "cpu is high", 'CRITICAL', 'OK', 0,
+                 Tags([('Environment', 'prod')]))
+
+
+def test_digest_is_posted_on_shutdown(digest):
+    for i in range(3):
+        assert digest.post(alert(i))
+    assert digest.posted == []
+    slack.stop_digests()
+    assert len(digest.posted) == 1
+    assert digest.posted[0]['attachments'][0]['title'] == "prod CRITICAL: 3"
+
+
+def test_controllers_share_the_digest(digest, monkeypatch):
+    monkeypatch.setitem(app.config, 'SLACK_DIGEST_ENABLED', True)
+    monkeypatch.setitem(app.config, 'SLACK_URL', "http://localhost/hook")
+    monkeypatch.setitem(app.config, 'SLACK_CHANNEL', "#alerts")
+    assert AlertController().slack is digest
+    assert AlertController().slack is digest
+
+
+def test_messages_do_not_wait_for_the_rate_limit(digest):
+    assert digest.post_message("title", "one")
+    assert digest.post_message("title", "two")
+    start = time.monotonic()
+    # The bucket is empty, the message is dropped instead of waiting
+    assert not digest.post_message("title", "three")
+    assert time.monotonic() - start < 0.5
+    assert len(digest.posted) == 2
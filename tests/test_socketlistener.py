@@ -0,0 +1,81 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Alerts sent to the socket listener, one JSON alert per line
+'''
+import json
+import time
+import socket
+import logging
+
+import pytest
+
+from app import app, dbcontroller, routes
+from app.socketlistener import SocketListener
+from conftest import kapacitor_alert
+
+
+@pytest.fixture
+def listen(monkeypatch):
+    monkeypatch.setitem(app.config, 'SOCKET_LISTENER_ADDRESS', "127.0.0.1")
+    monkeypatch.setitem(app.config, 'SOCKET_LISTENER_PORT', 0)
+    monkeypatch.setitem(app.config, 'SOCKET_LISTENER_PATH', "")
+    listeners = []
+
+    def start(ingest):
+        listener = SocketListener(ingest)
+        listener.start()
+        listeners.append(listener)
+        return listener._server.server_address
+
+    yield start
+    for listener in listeners:
+        listener.stop()
+
+
+def send(address, *lines):
+    with socket.create_connection(address) as sock:
+        sock.sendall(b"".join(line.encode() + b"\n" for line in lines))
+
+
+def wait_for(check, timeout=5):
+    end = time.time() + timeout
+    while not check():
+        assert time.time() < end
+        time.sleep(0.02)
+
+
+def test_alerts_are_processed_and_connection_released(db, listen):
+    address = listen(routes.ingest)
+    # Kapacitor's tcp handler connects once per alert, every connection
+    # gets a new thread which reuses the pooled database connection
+    for i, alertid in enumerate(("cpu server01", "cpu server02"), 1):
+        send(address, json.dumps(kapacitor_alert(alertid, 'CRITICAL', 'OK')))
+        wait_for(lambda: len(db.get_active_alerts()) == i)
+        wait_for(lambda: dbcontroller._pool.qsize() == 1)
+
+
+def errors(caplog):
+    return [r.getMessage() for r in caplog.records
+            if r.levelno >= logging.ERROR]
+
+
+def test_rejected_alerts_are_logged(listen, monkeypatch, caplog):
+    monkeypatch.setattr(logging.getLogger("KAP"), 'propagate', True)
+    statuses = [400, 503, 202]
+    received = []
+
+    def ingest(content):
+        received.append(content['id'])
+        return statuses.pop(0)
+
+    address = listen(ingest)
+    with caplog.at_level(logging.ERROR, logger="KAP"):
+        send(address, json.dumps({'id': "bad"}), "not json",
+             json.dumps({'id': "full"}), "", json.dumps({'id': "ok"}))
+        wait_for(lambda: len(received) == 3)
+        wait_for(lambda: len(errors(caplog)) == 3)
+    messages = errors(caplog)
+    assert messages[0].startswith("Invalid alert on alert socket")
+    assert messages[1] == "Received invalid JSON on alert socket"
+    assert messages[2] == ("Alert queue is full, alert from socket dropped: "
+                           "full")
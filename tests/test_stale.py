@@ -0,0 +1,72 @@
+# vim:set shiftwidth=4 softtabstop=4 expandtab:
+'''
+Removing stale alerts of terminated instances, and resolving their tickets
+through the rate limits and circuit breakers of the targets
+'''
+import pytest
+
+from app import app, ratelimit, circuitbreaker
+from app.alert import Alert
+from app.tasks import StaleAlertCleaner
+
+
+class FakeTarget():
+    def __init__(self):
+        self.sent = []
+
+    def post(self, al):
+        self.sent.append((al.id, al.level))
+        return al.jira_issue
+
+    def send(self, al):
+        self.sent.append((al.id, al.level))
+        return al.pd_incident_key
+
+
+def alert(alertid, host, jira=None, pagerduty=None):
+    al = Alert(alertid, 600, "cpu is high", 'CRITICAL', 'OK', 0,
+               [{'key': 'host', 'value': host}])
+    al.jira_issue = jira
+    al.pd_incident_key = pagerduty
+    return al
+
+
+@pytest.fixture
+def cleaner(db, monkeypatch):
+    monkeypatch.setattr(ratelimit, '_buckets', {})
+    monkeypatch.setattr(circuitbreaker, '_breakers', {})
+    db.activate_alert(alert("cpu server01", 'server01', "KAP-1", "pd-1"))
+    db.activate_alert(alert("cpu server02", 'server02', "KAP-2", "pd-2"))
+    db.activate_alert(alert("disk server02", 'server02', "KAP-3"))
+    db.activate_alert(alert("cpu server03", 'server03'))
+    cleaner = StaleAlertCleaner()
+    # server01 is running, the others are gone
+    monkeypatch.setattr(cleaner.alertctrl, 'update_aws_instance_info',
+                        lambda: {'server01': {'env': 'prod', 'state': 16}})
+    cleaner.alertctrl.jira = FakeTarget()
+    cleaner.alertctrl.pagerduty = FakeTarget()
+    return cleaner
+
+
+def test_stale_alerts_are_removed_and_resolved(db, cleaner):
+    cleaner.run()
+    assert [a.id for a in db.get_active_alerts()] == ["cpu server01"]
+    assert sorted(cleaner.alertctrl.jira.sent) == [
+        ("cpu server02", 'OK'), ("disk server02", 'OK')]
+    assert cleaner.alertctrl.pagerduty.sent == [("cpu server02", 'OK')]
+
+
+def test_jira_rate_limit_applies(cleaner, monkeypatch):
+    monkeypatch.setitem(app.config['TARGET_RATE_LIMITS'], 'jira', (0.01, 1))
+    monkeypatch.setitem(app.config['TARGET_DEADLINES'], 'jira', 0.1)
+    cleaner.run()
+    assert len(cleaner.alertctrl.jira.sent) == 1
+    assert cleaner.alertctrl.pagerduty.sent == [("cpu server02", 'OK')]
+
+
+def test_open_jira_circuit_is_not_called(db, cleaner):
+    circuitbreaker.breaker('jira')._open()
+    cleaner.run()
+    assert [a.id for a in db.get_active_alerts()] == ["cpu server01"]
+    assert cleaner.alertctrl.jira.sent == []
+    assert cleaner.alertctrl.pagerduty.sent == [("cpu server02", 'OK')]